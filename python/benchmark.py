@@ -0,0 +1,1689 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the hot paths of the XMPP handling code: parsing, dispatch,
+serializing elements and building outgoing stanzas, and for connecting and
+logging in bots against a local `XmppServer`.
+
+The incoming streams are canned, generated from a fixed seed so every run
+sees exactly the same bytes: a login handshake, joining a room with history,
+a presence storm and a chatty room. Streams are fed in reads of several
+sizes, as they would arrive from a socket.
+
+Results can be saved as JSON with --json, and compared against a previous
+run with --compare, which fails if anything got slower than --threshold.
+"""
+import argparse
+import asyncio
+import functools
+import gc
+import json
+import logging
+import multiprocessing
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from xml.sax import ContentHandler, make_parser
+from xml.sax.saxutils import escape
+
+import botruntime
+import scram
+import xmpphandler
+import xmpptls
+from jumperbot import BotManager
+from loadprofile import LoadProfile, RoomChooser
+from outboundqueue import OutboundQueue
+from streammanagement import StreamManagement
+from xmppcontenthandler import StanzaQueue, XmppContentHandler
+from xmpphandler import XmppHandler
+from xmppmetrics import XmppMetrics
+from xmpprouter import compile_layout
+from xmppserver import XmppServer
+from xmppstreamreader import XmppStanza, XmppStreamReader
+
+logger = logging.getLogger(__name__)
+
+HOST = "localhost"
+USERNAME = "benchbot@localhost"
+ROOM = "bot_room_0@conference.localhost"
+SEED = 4242
+
+STREAM_HEADER = "<?xml version='1.0'?>" \
+                "<stream:stream xmlns:stream='http://etherx.jabber.org/streams' " \
+                "version='1.0' from='localhost' id='{0}' xml:lang='en' " \
+                "xmlns='jabber:client'>"
+
+LOGIN_STREAM = [
+    STREAM_HEADER.format("s1"),
+    "<stream:features>"
+    "<mechanisms xmlns='urn:ietf:params:xml:ns:xmpp-sasl'>"
+    "<mechanism>PLAIN</mechanism></mechanisms>"
+    "</stream:features>",
+    "<success xmlns='urn:ietf:params:xml:ns:xmpp-sasl'/>",
+    STREAM_HEADER.format("s2"),
+    "<stream:features>"
+    "<bind xmlns='urn:ietf:params:xml:ns:xmpp-bind'/>"
+    "<session xmlns='urn:ietf:params:xml:ns:xmpp-session'/>"
+    "</stream:features>",
+    "<iq id='id1' type='result'>"
+    "<bind xmlns='urn:ietf:params:xml:ns:xmpp-bind'>"
+    "<jid>benchbot@localhost/bench</jid></bind></iq>",
+    "<iq id='id2' type='result'/>",
+]
+
+WORDS = [
+    "jump", "room", "hello", "what's", "up", "dude", "42", "shoot", "all",
+    "perspective", "lobsters", "Titanic", "algebra", "&", "<3", "'quoted'",
+    "naïve", "café", "smörgåsbord", "Þór", "日本語", "🙂",
+]
+
+BENCHMARKS = {}
+RESULTS = []
+
+
+def benchmark(name):
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+    return register
+
+
+class ListQueue(list):
+    """
+    The original stanza queue: a list with insert(0)/pop(), kept here to
+    compare against `StanzaQueue`.
+    """
+    max_depth = None
+    high_water = 0
+    pauses = 0
+
+    def push(self, element):
+        self.insert(0, element)
+
+    def is_full(self):
+        return False
+
+
+class LegacyElement(object):
+    """
+    The original element representation, with a `__dict__` and the SAX
+    attributes object, kept here to compare memory use against.
+    """
+
+    def __init__(self):
+        self.tag = None
+        self.attributes = []
+        self.text = None
+        self.children = []
+
+
+class LegacyContentHandler(ContentHandler):
+    def __init__(self):
+        ContentHandler.__init__(self)
+        self.stanzas = []
+        self.element_stack = [None]
+
+    def startElement(self, name, attrs):
+        element = LegacyElement()
+        element.tag = name
+        element.attributes = attrs
+        if name != "stream:stream":
+            self.element_stack.append(element)
+
+    def endElement(self, name):
+        element = self.element_stack.pop()
+        parent = self.element_stack[-1]
+        if parent is not None:
+            parent.children.append(element)
+        else:
+            self.stanzas.append(element)
+
+    def characters(self, content):
+        element = self.element_stack[-1]
+        if element is None:
+            return
+        if element.text:
+            element.text += content
+        else:
+            element.text = content
+
+
+class LegacySaxReader(object):
+    """
+    The original way of reading a stream: an `xml.sax` parser for every
+    connection, with a new `XmppContentHandler` for every stream.
+    """
+
+    def __init__(self, queue):
+        self.queue = queue
+        self.parser = make_parser()
+
+    def reset(self):
+        self.parser.reset()
+        self.parser.setContentHandler(XmppContentHandler(self.queue))
+
+    def feed(self, data):
+        self.parser.feed(data)
+
+
+class CountingTransport(object):
+    def __init__(self):
+        self.writes = 0
+        self.bytes = 0
+
+    def write(self, data):
+        self.writes += 1
+        self.bytes += len(data)
+
+
+def legacy_groupchat(handler, receiver, text):
+    """
+    How groupchat stanzas were originally built, as text that `transmit`
+    encodes.
+    """
+    template = "<message from='{0}' to='{1}' " \
+               "type='groupchat' xml:lang='en'><body>{2}</body></message>"
+    package = template.format(handler.username, receiver, escape(text))
+    handler.transmit(package)
+
+
+def legacy_to_xml(element, indent=0):
+    """
+    The original recursive serializer, building its result with `+=`.
+    """
+    spaces = " " * indent
+    attributes = ""
+    for a in element.attributes.getNames():
+        attributes += "{0}={1} ".format(a, element.attributes.getValue(a))
+    result = spaces + "<{0} {1}".format(element.tag, attributes).strip()
+    if element.children or element.text:
+        result += ">\n"
+        for child in element.children:
+            result += legacy_to_xml(child, indent=indent + 4)
+        if element.text:
+            result += " " * (indent + 4) + element.text + "\n"
+        result += spaces + "</{0}>\n".format(element.tag)
+    else:
+        result += "/>\n"
+
+    return result
+
+
+def legacy_route(response, extra, handle):
+    """
+    How stanzas were routed once logged in: an if/elif chain on the tag,
+    here with `extra` (tag, type) pairs checked first, as if further
+    handlers had been added to the chain.
+    """
+    for tag, stanza_type in extra:
+        if response.tag == tag and response.attributes.get("type") == \
+                stanza_type:
+            handle(response)
+            return True
+
+    if response.tag == "message":
+        handle(response)
+        return True
+
+    elif response.tag == "presence":
+        handle(response)
+        return True
+
+    elif response.tag == "stream:closed":
+        return True
+
+    elif response.tag == "stream:error":
+        return True
+
+
+def random_text(rng, min_words=1, max_words=20):
+    return " ".join(
+        rng.choice(WORDS) for i in range(rng.randint(min_words, max_words)))
+
+
+def room_join_stream(num_stanzas):
+    """
+    What a bot receives when joining a busy room: presence for every
+    occupant followed by the room history.
+    """
+    stanzas = []
+    num_occupants = num_stanzas // 2
+    for i in range(num_occupants):
+        stanzas.append(
+            "<presence from='{0}/bot_{1}' to='{2}/bench'>"
+            "<x xmlns='http://jabber.org/protocol/muc#user'>"
+            "<item affiliation='none' role='participant'/></x>"
+            "</presence>".format(ROOM, i, USERNAME))
+    for i in range(num_stanzas - num_occupants):
+        stanzas.append(
+            "<message from='{0}/bot_{1}' to='{2}/bench' type='groupchat'>"
+            "<body>History message number {1}</body>"
+            "<delay xmlns='urn:xmpp:delay' stamp='2017-10-01T12:00:00Z'/>"
+            "</message>".format(ROOM, i, USERNAME))
+    return "".join(stanzas).encode()
+
+
+def presence_storm_stream(num_stanzas):
+    """
+    Occupants of a room coming and going, changing status as they do.
+    """
+    rng = random.Random(SEED)
+    stanzas = []
+    for i in range(num_stanzas):
+        nick = "bot_{0}".format(rng.randrange(500))
+        if rng.random() < 0.3:
+            stanzas.append(
+                "<presence from='{0}/{1}' to='{2}/bench' type='unavailable'>"
+                "<x xmlns='http://jabber.org/protocol/muc#user'>"
+                "<item affiliation='none' role='none'/></x>"
+                "</presence>".format(ROOM, nick, USERNAME))
+        else:
+            stanzas.append(
+                "<presence from='{0}/{1}' to='{2}/bench'>"
+                "<show>{3}</show><status>{4}</status>"
+                "<c xmlns='http://jabber.org/protocol/caps' hash='sha-1' "
+                "node='http://example.com/bot' ver='QgayPKawpkPSDYmwT/WM94uAlu0='/>"
+                "<x xmlns='http://jabber.org/protocol/muc#user'>"
+                "<item affiliation='none' role='participant'/></x>"
+                "</presence>".format(
+                    ROOM, nick, USERNAME,
+                    rng.choice(("away", "chat", "dnd", "xa")),
+                    escape(random_text(rng, 1, 5))))
+    return "".join(stanzas).encode()
+
+
+def chatty_room_stream(num_stanzas):
+    """
+    Groupchat messages of varying length, with some non-ASCII text.
+    """
+    rng = random.Random(SEED)
+    stanzas = []
+    for i in range(num_stanzas):
+        stanzas.append(
+            "<message from='{0}/bot_{1}' to='{2}/bench' type='groupchat' "
+            "id='m{3}' xml:lang='en'><body>{4}</body></message>".format(
+                ROOM, rng.randrange(50), USERNAME, i,
+                escape(random_text(rng))))
+    return "".join(stanzas).encode()
+
+
+def disco_result_stream(num_items):
+    """
+    A single disco#items result listing many rooms.
+    """
+    items = "".join(
+        "<item jid='bot_room_{0}@conference.localhost' "
+        "name='Room &amp; {0}'/>".format(i) for i in range(num_items))
+    return "<iq from='conference.localhost' to='{0}/bench' id='disco1' " \
+           "type='result'><query xmlns='http://jabber.org/protocol/disco#items'>" \
+           "{1}</query></iq>".format(USERNAME, items).encode()
+
+
+def nested_stream(depth):
+    """
+    A single stanza nested `depth` elements deep.
+    """
+    return ("<message to='{0}/bench'>".format(USERNAME) +
+            "<x>" * depth + "text" + "</x>" * depth +
+            "</message>").encode()
+
+
+def login_stream(num_stanzas):
+    """
+    The server side of a login handshake after authentication.
+    """
+    return "".join(LOGIN_STREAM[4:]).encode()
+
+
+STREAMS = {
+    "login": login_stream,
+    "muc-join": room_join_stream,
+    "presence-storm": presence_storm_stream,
+    "chatty-room": chatty_room_stream,
+}
+
+
+def logged_in_handler(reader="sax", queue=None):
+    handler = XmppHandler(reader=reader, queue=queue)
+    handler.send = lambda package: None
+    handler.connect(HOST, USERNAME, "password")
+    for data in LOGIN_STREAM:
+        handler.handle_raw_response(data.encode())
+    assert handler.state == "ready"
+    return handler
+
+
+def chunks(data, chunk_size):
+    if not chunk_size:
+        return [data]
+    view = memoryview(data)
+    return [view[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+
+
+def feed(handler, data, chunk_size):
+    for chunk in chunks(data, chunk_size):
+        handler.handle_raw_response(chunk)
+
+
+def measure(func, repeat):
+    best = None
+    for i in range(repeat):
+        # Like timeit, without the collector's pauses, which vary with
+        # whatever garbage earlier runs left
+        gc.collect()
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            func()
+            elapsed = time.perf_counter() - start
+        finally:
+            gc.enable()
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def report(name, elapsed, count, unit="stanzas", **params):
+    rate = count / elapsed
+    RESULTS.append({
+        "name": name,
+        "params": params,
+        "seconds": elapsed,
+        "count": count,
+        "unit": unit,
+        "rate": rate,
+    })
+    print("{0:<52} {1:10.2f} ms {2:12.0f} {3}/s".format(
+        name, elapsed * 1000.0, rate, unit))
+
+
+def report_value(name, value, unit, **params):
+    """
+    Reports a measurement where lower is better, such as memory use.
+    """
+    RESULTS.append({
+        "name": name,
+        "params": params,
+        "value": value,
+        "unit": unit,
+    })
+    print("{0:<52} {1:12.0f} {2}".format(name, value, unit))
+
+
+def count_stanzas(data):
+    reader = XmppStreamReader()
+    reader.feed(STREAM_HEADER.format("count").encode())
+    reader.feed(data)
+    return len(reader.queue) - 1
+
+
+@benchmark("parse")
+def bench_parse(args):
+    """
+    Parses the canned streams into a stanza queue, without dispatching.
+    """
+    header = STREAM_HEADER.format("parse").encode()
+    for stream_name, make_stream in sorted(STREAMS.items()):
+        data = make_stream(args.stanzas)
+        count = count_stanzas(data)
+        for reader in XmppHandler.READERS:
+            for chunk_size in args.chunk_sizes:
+                pieces = chunks(data, chunk_size)
+
+                def run():
+                    if reader == "pull":
+                        parser = XmppStreamReader()
+                    else:
+                        parser = make_parser()
+                        parser.setContentHandler(XmppContentHandler())
+                    parser.feed(header)
+                    for piece in pieces:
+                        parser.feed(piece)
+
+                elapsed = measure(run, args.repeat)
+                report("parse {0} {1} chunk={2}".format(
+                    stream_name, reader, chunk_size or "all"),
+                    elapsed, count, stream=stream_name, reader=reader,
+                    chunk_size=chunk_size)
+
+
+@benchmark("dispatch")
+def bench_dispatch(args):
+    """
+    Feeds the canned streams to a logged in `XmppHandler`, which parses and
+    dispatches them to its handlers.
+    """
+    for stream_name in ("muc-join", "presence-storm", "chatty-room"):
+        data = STREAMS[stream_name](args.stanzas)
+        count = count_stanzas(data)
+        for reader in XmppHandler.READERS:
+            for chunk_size in args.chunk_sizes:
+                def run():
+                    handler = logged_in_handler(reader)
+                    feed(handler, data, chunk_size)
+
+                elapsed = measure(run, args.repeat)
+                report("dispatch {0} {1} chunk={2}".format(
+                    stream_name, reader, chunk_size or "all"),
+                    elapsed, count, stream=stream_name, reader=reader,
+                    chunk_size=chunk_size)
+
+
+@benchmark("router")
+def bench_router(args):
+    """
+    Routes parsed stanzas in the ready state, through the `StanzaRouter` of
+    a logged in handler and through an if/elif chain like the one it
+    replaced, with increasing numbers of extra handlers registered for other
+    stanzas. Compiling the router's table, on the first dispatch after its
+    routes change, is timed on its own.
+
+    With no extra handlers the chain is faster: it is what the router does
+    at best, without looking at the state or calling the handler's hooks,
+    which the router does for every stanza. The router only wins once
+    there are a dozen or so handlers to go through.
+    """
+    stanzas = []
+    for stream_name in ("presence-storm", "chatty-room"):
+        reader = XmppStreamReader()
+        reader.feed(STREAM_HEADER.format("router").encode())
+        reader.feed(STREAMS[stream_name](args.stanzas // 2))
+        reader.queue.pop()
+        while len(reader.queue):
+            stanzas.append(reader.queue.pop())
+    received = []
+
+    for num_extra in (0, 16, 256):
+        extra = [("extra{0}".format(i), "type{0}".format(i % 4))
+                 for i in range(num_extra)]
+
+        handler = logged_in_handler()
+        handler.handle_message = received.append
+        handler.handle_presence = received.append
+        for tag, stanza_type in extra:
+            handler.add_route(received.append, tag=tag, type=stanza_type)
+
+        def run_router():
+            router = handler.router
+            state = handler.state
+            for stanza in stanzas:
+                router.dispatch(state, stanza)
+
+        def run_compile():
+            # As for the first connection with these routes
+            compile_layout.cache_clear()
+            handler.router.compile()
+            run_router()
+
+        elapsed = measure(run_compile, args.repeat)
+        report("router compile+first pass extra={0}".format(num_extra),
+               elapsed, len(stanzas), router="compile", extra=num_extra)
+
+        def run_chain():
+            for stanza in stanzas:
+                legacy_route(stanza, extra, received.append)
+
+        for name, run in (("chain", run_chain), ("router", run_router)):
+            elapsed = measure(run, args.repeat)
+            del received[:]
+            report("router {0} extra={1}".format(name, num_extra), elapsed,
+                   len(stanzas), router=name, extra=num_extra)
+    print("(the chain ignores the state and calls no hooks, so it is faster "
+          "with few handlers)")
+
+
+@benchmark("login")
+def bench_login(args):
+    """
+    Runs complete login handshakes against the canned server stream.
+    """
+    count = max(1, args.stanzas // 10)
+    for reader in XmppHandler.READERS:
+        def run():
+            for i in range(count):
+                logged_in_handler(reader)
+
+        elapsed = measure(run, args.repeat)
+        report("login {0}".format(reader), elapsed, count, "logins",
+               reader=reader)
+
+
+@benchmark("toxml")
+def bench_toxml(args):
+    """
+    Serializes parsed elements: with the original recursive `toXml`, pretty
+    and compact with the streaming serializer, and as raw bytes straight
+    from the pull reader. Also serializes single large stanzas (a disco
+    result and a deeply nested element) built from the same number of
+    elements.
+    """
+    streams = [(name, STREAMS[name](args.stanzas))
+               for name in ("muc-join", "presence-storm", "chatty-room")]
+    streams.append(("disco-result", disco_result_stream(args.stanzas)))
+    streams.append(("nested", nested_stream(args.stanzas)))
+    for stream_name, data in streams:
+        reader = XmppStreamReader()
+        reader.feed(STREAM_HEADER.format("toxml").encode())
+        reader.feed(data)
+        reader.queue.pop()
+        stanzas = []
+        while len(reader.queue):
+            stanzas.append(reader.queue.pop())
+        elements = [stanza.element for stanza in stanzas]
+        fresh = [XmppStanza(stanza.tag, stanza.attributes, stanza.raw)
+                 for stanza in stanzas]
+
+        def run_legacy():
+            for element in elements:
+                legacy_to_xml(element)
+
+        def run_pretty():
+            for element in elements:
+                element.toXml()
+
+        def run_compact():
+            for element in elements:
+                element.to_bytes()
+
+        def run_raw():
+            for stanza in fresh:
+                stanza.to_bytes()
+
+        count = len(elements)
+        if stream_name == "nested" and args.stanzas > 500:
+            # Recursion in the original serializer can't go this deep
+            variants = ()
+        else:
+            variants = (("legacy", run_legacy),)
+        variants += (("pretty", run_pretty), ("compact", run_compact),
+                     ("raw", run_raw))
+        for name, run in variants:
+            elapsed = measure(run, args.repeat)
+            report("toxml {0} {1}".format(stream_name, name), elapsed, count,
+                   stream=stream_name, serializer=name)
+
+
+@benchmark("memory")
+def bench_memory(args):
+    """
+    Measures the memory held per parsed stanza, with the original element
+    representation, the compact `XmppElement`, and the stanza views of the
+    pull reader before and after their elements have been built.
+    """
+    header = STREAM_HEADER.format("memory").encode()
+    for stream_name in ("muc-join", "presence-storm", "chatty-room"):
+        data = STREAMS[stream_name](args.stanzas)
+
+        def parse_legacy():
+            parser = make_parser()
+            handler = LegacyContentHandler()
+            parser.setContentHandler(handler)
+            parser.feed(header)
+            parser.feed(data)
+            return handler.stanzas
+
+        def parse_sax():
+            parser = make_parser()
+            handler = XmppContentHandler()
+            parser.setContentHandler(handler)
+            parser.feed(header)
+            parser.feed(data)
+            return list(handler.queue.items)[1:]
+
+        def parse_pull():
+            reader = XmppStreamReader()
+            reader.feed(header)
+            reader.feed(data)
+            return list(reader.queue.items)[1:]
+
+        def parse_pull_built():
+            stanzas = parse_pull()
+            for stanza in stanzas:
+                stanza.element
+            return stanzas
+
+        for name, parse in (("legacy", parse_legacy), ("sax", parse_sax),
+                            ("pull", parse_pull),
+                            ("pull+elements", parse_pull_built)):
+            tracemalloc.start()
+            stanzas = parse()
+            size = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            report_value("memory {0} {1}".format(stream_name, name),
+                         size / len(stanzas), "bytes/stanza",
+                         stream=stream_name, representation=name)
+            del stanzas
+
+
+@benchmark("idle")
+def bench_idle(args):
+    """
+    Measures the memory held by each idle, logged-in connection, and the
+    time to create one and log it in, with the original per-connection
+    `xml.sax` parser and with the readers that share pooled parsers. The
+    connections share their metrics, as the bots' do.
+    """
+    metrics = XmppMetrics()
+
+    def log_in(reader):
+        handler = XmppHandler(reader="sax" if reader == "legacy" else reader,
+                              metrics=metrics)
+        if reader == "legacy":
+            handler.parser = LegacySaxReader(handler.queue)
+        handler.send = lambda package: None
+        handler.connect(HOST, USERNAME, "password")
+        for data in LOGIN_STREAM:
+            handler.handle_raw_response(data.encode())
+        return handler
+
+    for reader in ("legacy",) + XmppHandler.READERS:
+        log_in(reader)
+        handlers = []
+
+        def run():
+            handlers[:] = [log_in(reader) for i in range(args.bots)]
+
+        elapsed = measure(run, args.repeat)
+        report("idle log in {0}".format(reader), elapsed, args.bots,
+               "bots", reader=reader)
+        del handlers[:]
+
+        tracemalloc.start()
+        handlers = [log_in(reader) for i in range(args.bots)]
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        report_value("idle memory {0}".format(reader), size / args.bots,
+                     "bytes/bot", reader=reader)
+        del handlers
+
+
+# A busy room: the presence of every occupant and the history, joined with
+# all of it arriving in one read
+ROOM_JOIN_STANZAS = 10000
+
+
+@benchmark("room-join")
+def bench_room_join(args):
+    """
+    Replays joining a busy room, 10k stanzas of presence and history, read
+    in one go or in chunks, with the original list queue and the FIFO queue,
+    with each reader. Parsing and dispatch take most of that time, so the
+    queues are also timed on their own, with everything from one read
+    queued before any of it is handled, where the list is quadratic.
+    """
+    count = ROOM_JOIN_STANZAS
+    data = room_join_stream(count)
+    queues = (("list", ListQueue), ("fifo", StanzaQueue))
+    for reader in XmppHandler.READERS:
+        for queue_name, queue_type in queues:
+            for chunk_size in args.chunk_sizes:
+                def run():
+                    handler = logged_in_handler(reader, queue_type())
+                    feed(handler, data, chunk_size)
+
+                elapsed = measure(run, args.repeat)
+                report("room-join {0} {1} chunk={2}".format(
+                    reader, queue_name, chunk_size or "all"),
+                    elapsed, count, reader=reader, queue=queue_name,
+                    chunk_size=chunk_size)
+
+        # The stanzas as this reader queues them
+        handler = logged_in_handler(reader)
+        handler.process_queue = lambda: None
+        feed(handler, data, 0)
+        stanzas = list(handler.queue.items)
+        for queue_name, queue_type in queues:
+            def run():
+                queue = queue_type()
+                for stanza in stanzas:
+                    queue.push(stanza)
+                while len(queue):
+                    queue.pop()
+
+            elapsed = measure(run, args.repeat)
+            report("room-join queue {0} {1}".format(reader, queue_name),
+                   elapsed, len(stanzas), reader=reader, queue=queue_name)
+
+
+@benchmark("outbound")
+def bench_outbound(args):
+    """
+    Sends bursts of messages through a handler, built the original way with
+    format and encode and with the pre-encoded templates, with and without
+    write coalescing.
+    """
+    rng = random.Random(SEED)
+    texts = [random_text(rng) for i in range(100)]
+    num_bursts = max(1, args.stanzas // len(texts))
+    count = num_bursts * len(texts)
+
+    def run_handler(method, coalesce):
+        transport = CountingTransport()
+        handler = logged_in_handler()
+        handler.send = transport.write
+        handler.coalesce_writes = coalesce
+        if method == "legacy groupchat":
+            send = functools.partial(legacy_groupchat, handler)
+        else:
+            send = getattr(handler, method)
+
+        async def bursts():
+            for i in range(num_bursts):
+                for text in texts:
+                    send(ROOM, text)
+                await asyncio.sleep(0)
+
+        loop.run_until_complete(bursts())
+        return transport
+
+    loop = asyncio.new_event_loop()
+    cases = []
+    for method in ("legacy groupchat", "groupchat", "message"):
+        for coalesce in (False, True):
+            cases.append((
+                "{0}{1}".format(method, " coalesced" if coalesce else ""),
+                lambda method=method, coalesce=coalesce:
+                    run_handler(method, coalesce)))
+
+    for name, func in cases:
+        writes = func().writes
+        elapsed = measure(func, args.repeat)
+        report("outbound {0} ({1} writes)".format(name, writes),
+               elapsed, count, case=name, writes=writes)
+    loop.close()
+
+
+class LoginProtocol(asyncio.Protocol):
+    """
+    A bot that only logs in, for the connect benchmark.
+    """
+
+    def __init__(self, username, logged_in, tls_context=None, metrics=None,
+                 pipeline=False, outbound=None):
+        self.username = username
+        self.logged_in = logged_in
+        self.tls_context = tls_context
+        self.metrics = metrics
+        self.pipeline = pipeline
+        self.outbound = outbound
+        self.handler = None
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.handler = XmppHandler(metrics=self.metrics)
+        self.handler.send = self.write
+        self.handler.use_tls = self.tls_context is not None
+        self.handler.start_tls = self.start_tls
+        self.handler.pipeline_login = self.pipeline
+        self.handler.outbound = self.outbound
+        self.handler.connect(HOST, self.username, "benchbot")
+        asyncio.get_event_loop().create_task(self.wait_ready())
+
+    def write(self, data):
+        self.transport.write(data)
+
+    def pause_writing(self):
+        self.handler.pause_writing()
+
+    def resume_writing(self):
+        self.handler.resume_writing()
+
+    def start_tls(self):
+        asyncio.get_event_loop().create_task(self.upgrade())
+
+    async def upgrade(self):
+        self.transport = await xmpptls.start_tls(
+            self.transport, self, self.tls_context, HOST, self.handler.metrics)
+        self.handler.handle_tls_established()
+
+    async def wait_ready(self):
+        try:
+            await self.handler.wait_ready()
+        except ConnectionError as e:
+            self.logged_in.set_exception(e)
+        else:
+            if self.handler.tls_active:
+                self.tls_context.remember(self.transport, HOST)
+            self.logged_in.set_result(self)
+
+    def data_received(self, data):
+        self.handler.handle_raw_response(data)
+
+    def connection_lost(self, exc):
+        self.handler.connection_lost()
+
+
+class RoomBot(LoginProtocol):
+    """
+    A bot that logs in and joins a room, or resumes the stream it was in the
+    room with, for the resume benchmark. It counts the groupchat messages it
+    gets.
+    """
+
+    def __init__(self, username, room, logged_in, stream_management=None,
+                 metrics=None):
+        super().__init__(username, logged_in, metrics=metrics)
+        self.room = room
+        self.occupant = "{0}/{1}".format(room, username.split("@")[0])
+        self.stream_management = stream_management
+        self.received = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.handler = handler = XmppHandler(metrics=self.metrics)
+        handler.send = self.write
+        handler.stream_management = self.stream_management
+        handler.handle_logged_in = self.handle_logged_in
+        handler.add_route(self.handle_groupchat, tag="message",
+                          type="groupchat")
+        handler.add_route(self.handle_joined, tag="presence",
+                          filter=lambda response: response.attributes.get(
+                              "from") == self.occupant)
+        handler.connect(HOST, self.username, "benchbot")
+
+    def handle_logged_in(self):
+        if self.handler.resumed:
+            # Still in the room
+            self.logged_in.set_result(self)
+        else:
+            self.handler.join_room(self.room)
+
+    def handle_joined(self, response):
+        if not self.logged_in.done():
+            self.logged_in.set_result(self)
+
+    def handle_groupchat(self, response):
+        self.received += 1
+
+    def close(self):
+        self.handler.close_stream()
+        self.transport.close()
+
+
+class ChatBot(LoginProtocol):
+    """
+    A bot that logs in and sends itself chat messages, for the rate limit
+    benchmark. It counts the ones it gets back, and whether the server cut
+    it off for sending too fast.
+    """
+
+    def __init__(self, username, logged_in, outbound=None):
+        super().__init__(username, logged_in, outbound=outbound)
+        self.received = 0
+        self.cut_off = False
+
+    def connection_made(self, transport):
+        super().connection_made(transport)
+        self.handler.handle_message = self.handle_message
+        self.handler.handle_stream_error = self.handle_stream_error
+
+    def handle_message(self, response):
+        self.received += 1
+
+    def handle_stream_error(self, response):
+        self.cut_off = True
+        self.transport.close()
+
+    async def talk(self, rate, duration):
+        """
+        Tries to send `rate` messages a second for `duration` seconds, waiting
+        whenever the connection is congested.
+        """
+        loop = asyncio.get_event_loop()
+        end = loop.time() + duration
+        while loop.time() < end and not self.transport.is_closing():
+            await self.handler.drain()
+            self.handler.message(self.username, "Are we there yet?")
+            await asyncio.sleep(1 / rate)
+
+
+def serve(port, ready, certfile=None, latency=0.0, rate_limit=None):
+    """
+    Runs an `XmppServer` on `port`, in a process of its own, offering
+    STARTTLS if given a certificate, answering `latency` seconds late and
+    disconnecting clients that send more than `rate_limit` stanzas a second.
+    """
+    loop = botruntime.create_event_loop("asyncio")
+    tls_context = None
+    if certfile is not None:
+        tls_context = xmpptls.create_server_context(certfile)
+    server = XmppServer(HOST, latency=latency, tls_context=tls_context,
+                        rate_limit=rate_limit)
+    loop.run_until_complete(server.start("127.0.0.1", port))
+    ready.set()
+    botruntime.run_forever(loop)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@benchmark("connect")
+def bench_connect(args):
+    """
+    Connects bots to a local server, with plain `create_connection` and with
+    the bot runtime (cached address, tuned sockets), on each event loop that
+    is installed. Reports connections per second for bare TCP connections,
+    logins per second and the CPU each login and each idle bot costs this
+    process. The server runs in another process but shares the machine, so
+    it is the same for every variant rather than out of the picture.
+    """
+    port = free_port()
+    ready = multiprocessing.Event()
+    server = multiprocessing.Process(target=serve, args=(port, ready),
+                                     daemon=True)
+    server.start()
+    ready.wait()
+    botruntime.raise_file_limit(args.bots)
+    runs = iter(range(1000000))
+
+    def plain(factory):
+        return asyncio.get_event_loop().create_connection(factory, HOST, port)
+
+    def tuned(options):
+        return lambda factory: botruntime.open_connection(factory, HOST, port,
+                                                          options)
+
+    async def close_all(transports):
+        for transport in transports:
+            transport.close()
+        await asyncio.sleep(0.1)
+
+    async def connect_only(connect):
+        limit = asyncio.Semaphore(100)
+
+        async def one():
+            async with limit:
+                transport, protocol = await connect(asyncio.Protocol)
+                return transport
+
+        start = time.perf_counter()
+        transports = await asyncio.gather(*(one() for i in range(args.bots)))
+        elapsed = time.perf_counter() - start
+        await close_all(transports)
+        return elapsed
+
+    async def log_in(connect):
+        loop = asyncio.get_event_loop()
+        limit = asyncio.Semaphore(100)
+        run = next(runs)
+
+        async def one(index):
+            logged_in = loop.create_future()
+            name = "benchbot_{0}_{1}@{2}".format(run, index, HOST)
+            async with limit:
+                await connect(lambda: LoginProtocol(name, logged_in))
+                return await logged_in
+
+        start = time.perf_counter()
+        cpu_start = time.process_time()
+        bots = await asyncio.gather(*(one(i) for i in range(args.bots)))
+        elapsed = time.perf_counter() - start
+        cpu = time.process_time() - cpu_start
+
+        cpu_start = time.process_time()
+        await asyncio.sleep(1.0)
+        idle_cpu = time.process_time() - cpu_start
+        await close_all([bot.transport for bot in bots])
+        return elapsed, cpu, idle_cpu
+
+    loops = ["asyncio"]
+    if botruntime.uvloop is not None:
+        loops.append("uvloop")
+    connects = (
+        ("create_connection", lambda: plain),
+        ("runtime", lambda: tuned(botruntime.SocketOptions())),
+        ("runtime 16k buffers", lambda: tuned(botruntime.SocketOptions(
+            send_buffer=16384, receive_buffer=16384))),
+    )
+    try:
+        for loop_name in loops:
+            loop = botruntime.create_event_loop(loop_name)
+            for connect_name, make_connect in connects:
+                connect = make_connect()
+                name = "{0} {1}".format(loop_name, connect_name)
+                elapsed = min(
+                    loop.run_until_complete(connect_only(connect))
+                    for i in range(args.repeat))
+                report("connect {0}".format(name), elapsed, args.bots,
+                       "connections", loop=loop_name, connect=connect_name)
+
+                results = [loop.run_until_complete(log_in(connect))
+                           for i in range(args.repeat)]
+                elapsed, cpu, idle_cpu = min(results)
+                report("login {0}".format(name), elapsed, args.bots,
+                       "logins", loop=loop_name, connect=connect_name)
+                report_value("login cpu {0}".format(name),
+                             min(r[1] for r in results) / args.bots * 1e6,
+                             "us/bot", loop=loop_name, connect=connect_name)
+                report_value("idle cpu {0}".format(name),
+                             min(r[2] for r in results) / args.bots * 1e6,
+                             "us/bot/s", loop=loop_name, connect=connect_name)
+            loop.close()
+    finally:
+        botruntime.install_event_loop("asyncio")
+        asyncio.set_event_loop(None)
+        server.terminate()
+        server.join()
+
+
+@benchmark("bots")
+def bench_bots(args):
+    """
+    Measures the memory held per simulated user by a `BotManager` whose
+    bots are logged in and sitting in rooms, with a connection per bot and
+    with bots sharing component connections, against a local server.
+    """
+    port = free_port()
+    ready = multiprocessing.Event()
+    server = multiprocessing.Process(target=serve, args=(port, ready),
+                                     daemon=True)
+    server.start()
+    ready.wait()
+    botruntime.raise_file_limit(args.bots)
+
+    def bot_args(component):
+        rooms = RoomChooser(10)
+        return argparse.Namespace(
+            num_bots=args.bots, workers=1, host_name=HOST, server_name=None,
+            port=port, connect_rate=0, connect_burst=args.bots,
+            max_handshakes=args.bots, handshake_timeout=0, backoff_base=1.0,
+            backoff_max=60.0, send_buffer=None, receive_buffer=None,
+            profile=LoadProfile.steady(args.bots, 0, rooms, 0.0),
+            component=component, component_secret="secret",
+            bots_per_connection=500, tls=False, tls_ca=None,
+            tls_no_verify=False, mechanisms=XmppHandler.MECHANISMS,
+            scram_threads=None, stream_management=False,
+            pipeline_login=False, send_rate=None, send_burst=5,
+            send_queue=100, trace=None, trace_tags=None,
+            trace_sample=1)
+
+    async def run(manager, component):
+        manager.create_bots(bot_args(component))
+        while len(manager.bots_logged_in) < args.bots:
+            await asyncio.sleep(0.05)
+        # Let the room presence settle
+        await asyncio.sleep(0.5)
+
+    try:
+        for mode, component in (("client", None),
+                                ("component", "bots." + HOST)):
+            loop = botruntime.create_event_loop("asyncio")
+            manager = BotManager()
+            tracemalloc.start()
+            start = time.perf_counter()
+            loop.run_until_complete(run(manager, component))
+            elapsed = time.perf_counter() - start
+            size = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            report("bots log in {0}".format(mode), elapsed, args.bots,
+                   "bots", mode=mode)
+            report_value("bots memory {0}".format(mode), size / args.bots,
+                         "bytes/bot", mode=mode)
+            loop.run_until_complete(manager.shutdown())
+            botruntime.cancel_tasks(loop)
+            loop.close()
+    finally:
+        asyncio.set_event_loop(None)
+        server.terminate()
+        server.join()
+
+
+@benchmark("scram")
+def bench_scram(args):
+    """
+    Runs SCRAM exchanges for `--bots` users, each with a salt of its own,
+    deriving their keys in the event loop itself, in the loop's thread pool
+    through a `KeyCache`, and taken from the warm cache, as when bots
+    reconnect. Reports exchanges per second and the longest the event loop
+    went without running anything else.
+    """
+    password = "benchbot"
+    salts = [random.Random(SEED + i).randbytes(16) for i in range(args.bots)]
+
+    def exchange(salt, keys):
+        client = scram.ScramClient("SCRAM-SHA-256", USERNAME, password)
+        server = scram.ScramServer("SCRAM-SHA-256")
+        server.read_first_message(client.first_message())
+        client.read_challenge(server.challenge(salt))
+        client.verify(server.read_final_message(client.final_message(keys),
+                                                keys))
+
+    async def watch(lags, interval=0.001):
+        loop = asyncio.get_event_loop()
+        while True:
+            before = loop.time()
+            await asyncio.sleep(interval)
+            lags.append(loop.time() - before - interval)
+
+    async def log_in(cache):
+        loop = asyncio.get_event_loop()
+        lags = []
+        watcher = loop.create_task(watch(lags))
+        await asyncio.sleep(0.01)
+
+        async def one(salt):
+            keys = None
+            if cache is None:
+                keys = scram.derive_keys("sha256", password, salt,
+                                         scram.DEFAULT_ITERATIONS)
+            else:
+                keys = cache.get("sha256", password, salt,
+                                 scram.DEFAULT_ITERATIONS)
+                if keys is None:
+                    keys = await cache.derive("sha256", password, salt,
+                                              scram.DEFAULT_ITERATIONS)
+            exchange(salt, keys)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one(salt) for salt in salts))
+        elapsed = time.perf_counter() - start
+        # Until the watcher has seen the last stall
+        await asyncio.sleep(0.01)
+        watcher.cancel()
+        return elapsed, max(lags or [0.0])
+
+    loop = botruntime.create_event_loop("asyncio")
+    try:
+        warm = scram.KeyCache()
+        for mode in ("inline", "executor", "cached"):
+            results = []
+            for i in range(args.repeat):
+                cache = None
+                if mode == "executor":
+                    cache = scram.KeyCache()
+                elif mode == "cached":
+                    cache = warm
+                    loop.run_until_complete(log_in(warm))
+                results.append(loop.run_until_complete(log_in(cache)))
+            elapsed, lag = min(results)
+            report("scram login {0}".format(mode), elapsed, args.bots,
+                   "logins", mode=mode)
+            report_value("scram loop stall {0}".format(mode),
+                         min(result[1] for result in results) * 1e6, "us",
+                         mode=mode)
+    finally:
+        loop.close()
+        asyncio.set_event_loop(None)
+
+
+def create_certificate(directory):
+    """
+    Makes a self-signed certificate for `HOST` with the openssl tool, and
+    returns the PEM file holding it and its key.
+    """
+    path = "{0}/server.pem".format(directory)
+    subprocess.check_call(
+        ["openssl", "req", "-x509", "-newkey", "ec", "-pkeyopt",
+         "ec_paramgen_curve:prime256v1", "-nodes", "-days", "1",
+         "-subj", "/CN=" + HOST, "-keyout", path, "-out", path],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return path
+
+
+@benchmark("tls")
+def bench_tls(args):
+    """
+    Logs bots in one after another against a local server, without TLS,
+    with STARTTLS and a full handshake every time, and with STARTTLS
+    resuming the session of an earlier connection. Reports the time each
+    handshake takes and the CPU each login costs this process, which is
+    where resuming sessions saves the most.
+    """
+    directory = tempfile.TemporaryDirectory()
+    try:
+        certfile = create_certificate(directory.name)
+    except (OSError, subprocess.CalledProcessError) as e:
+        print("Skipping the tls benchmark, can't make a certificate: "
+              "{0}".format(e))
+        directory.cleanup()
+        return
+
+    port = free_port()
+    ready = multiprocessing.Event()
+    server = multiprocessing.Process(target=serve,
+                                     args=(port, ready, certfile),
+                                     daemon=True)
+    server.start()
+    ready.wait()
+    count = max(1, args.bots // 4)
+    runs = iter(range(1000000))
+
+    async def log_in(tls_context, resume, metrics):
+        loop = asyncio.get_event_loop()
+        run = next(runs)
+        cpu = 0.0
+        transports = []
+        for index in range(count):
+            if not resume and tls_context is not None:
+                tls_context.forget()
+            logged_in = loop.create_future()
+            name = "tlsbot_{0}_{1}@{2}".format(run, index, HOST)
+            cpu_start = time.process_time()
+            await botruntime.open_connection(
+                lambda: LoginProtocol(name, logged_in, tls_context, metrics),
+                HOST, port)
+            bot = await logged_in
+            cpu += time.process_time() - cpu_start
+            transports.append(bot.transport)
+        for transport in transports:
+            transport.close()
+        await asyncio.sleep(0.1)
+        return cpu
+
+    loop = botruntime.create_event_loop("asyncio")
+    try:
+        for mode in ("plain", "full", "resumed"):
+            tls_context = None
+            if mode != "plain":
+                tls_context = xmpptls.create_client_context(certfile)
+            metrics = XmppMetrics()
+            if mode == "resumed":
+                # A session to resume
+                loop.run_until_complete(log_in(tls_context, True, metrics))
+            results = []
+            for i in range(args.repeat):
+                metrics = XmppMetrics()
+                start = time.perf_counter()
+                cpu = loop.run_until_complete(
+                    log_in(tls_context, mode == "resumed", metrics))
+                results.append((time.perf_counter() - start, cpu, metrics))
+            elapsed, cpu, metrics = min(results, key=lambda r: r[1])
+            report("tls login {0}".format(mode), elapsed, count, "logins",
+                   mode=mode)
+            report_value("tls login cpu {0}".format(mode), cpu / count * 1e6,
+                         "us/bot", mode=mode)
+            handshakes = metrics.tls_handshakes.get(
+                "resumed" if mode == "resumed" else "full")
+            if handshakes is not None:
+                report_value("tls handshake {0}".format(mode),
+                             handshakes.mean(), "us", mode=mode)
+    finally:
+        loop.close()
+        asyncio.set_event_loop(None)
+        server.terminate()
+        server.join()
+        directory.cleanup()
+
+
+@benchmark("pipeline")
+def bench_pipeline(args):
+    """
+    Logs in a quarter of `--bots` bots at once against a local server that
+    answers 10ms late, like one across a network, waiting for every answer
+    and pipelining the login, with the server's features not known yet
+    (cold) and known from earlier logins. Reports logins per second, and
+    the time and round trips each login took.
+    """
+    latency = 0.01
+    port = free_port()
+    ready = multiprocessing.Event()
+    server = multiprocessing.Process(target=serve,
+                                     args=(port, ready, None, latency),
+                                     daemon=True)
+    server.start()
+    ready.wait()
+    count = max(1, args.bots // 4)
+    runs = iter(range(1000000))
+
+    async def log_in(pipeline, metrics):
+        loop = asyncio.get_event_loop()
+        run = next(runs)
+
+        async def one(index):
+            logged_in = loop.create_future()
+            name = "pipebot_{0}_{1}@{2}".format(run, index, HOST)
+            await botruntime.open_connection(
+                lambda: LoginProtocol(name, logged_in, metrics=metrics,
+                                      pipeline=pipeline),
+                HOST, port)
+            return await logged_in
+
+        start = time.perf_counter()
+        bots = await asyncio.gather(*(one(i) for i in range(count)))
+        elapsed = time.perf_counter() - start
+        for bot in bots:
+            bot.transport.close()
+        await asyncio.sleep(0.1)
+        return elapsed
+
+    loop = botruntime.create_event_loop("asyncio")
+    try:
+        for mode in ("sequential", "pipelined cold", "pipelined"):
+            results = []
+            for i in range(args.repeat):
+                if mode == "pipelined cold":
+                    xmpphandler.KNOWN_FEATURES.clear()
+                metrics = XmppMetrics()
+                results.append((loop.run_until_complete(
+                    log_in(mode != "sequential", metrics)), metrics))
+            elapsed, metrics = min(results, key=lambda r: r[0])
+            report("login {0}".format(mode), elapsed, count, "logins",
+                   mode=mode, latency=latency)
+            report_value("login time {0}".format(mode),
+                         metrics.login_phases["ready"].mean(), "us",
+                         mode=mode, latency=latency)
+            report_value("login round trips {0}".format(mode),
+                         metrics.login_round_trips["ready"].mean(),
+                         "round trips", mode=mode, latency=latency)
+    finally:
+        loop.close()
+        asyncio.set_event_loop(None)
+        server.terminate()
+        server.join()
+
+
+@benchmark("ratelimit")
+def bench_ratelimit(args):
+    """
+    Has a tenth of `--bots` bots try to send twice as many messages as a
+    local server with a rate limit allows, as fast as they can, and with
+    their outbound queues keeping them a little under the limit. Reports the
+    messages that made it through each second, and how many bots the server
+    disconnected for going over.
+    """
+    rate_limit = 50.0
+    duration = 2.0
+    port = free_port()
+    ready = multiprocessing.Event()
+    server = multiprocessing.Process(target=serve,
+                                     args=(port, ready, None, 0.0, rate_limit),
+                                     daemon=True)
+    server.start()
+    ready.wait()
+    count = max(1, args.bots // 10)
+    runs = iter(range(1000000))
+
+    async def talk(governed):
+        loop = asyncio.get_event_loop()
+        run = next(runs)
+
+        async def one(index):
+            logged_in = loop.create_future()
+            name = "chatbot_{0}_{1}@{2}".format(run, index, HOST)
+            outbound = None
+            if governed:
+                outbound = OutboundQueue(rate_limit * 0.9)
+            await botruntime.open_connection(
+                lambda: ChatBot(name, logged_in, outbound), HOST, port)
+            return await logged_in
+
+        bots = await asyncio.gather(*(one(i) for i in range(count)))
+        await asyncio.gather(*(bot.talk(rate_limit * 2, duration)
+                               for bot in bots))
+        # For the last messages to come back
+        await asyncio.sleep(0.2)
+        for bot in bots:
+            bot.transport.close()
+        await asyncio.sleep(0.1)
+        return sum(bot.received for bot in bots), \
+            sum(bot.cut_off for bot in bots)
+
+    loop = botruntime.create_event_loop("asyncio")
+    try:
+        for mode in ("unlimited", "governed"):
+            results = [loop.run_until_complete(talk(mode == "governed"))
+                       for i in range(args.repeat)]
+            received, cut_off = max(results)
+            report("ratelimit delivered {0}".format(mode), duration,
+                   received, "messages", mode=mode, rate_limit=rate_limit)
+            report_value("ratelimit disconnected {0}".format(mode), cut_off,
+                         "bots", mode=mode, rate_limit=rate_limit)
+    finally:
+        loop.close()
+        asyncio.set_event_loop(None)
+        server.terminate()
+        server.join()
+
+
+@benchmark("resume")
+def bench_resume(args):
+    """
+    Puts `--bots` bots in rooms on a local server, drops all their
+    connections at once, has someone in each room talk while they are gone,
+    and brings them back: logging in again and rejoining their rooms, or
+    resuming their streams with stream management (XEP-0198). Reports how
+    fast they are back, the stanzas each one sends and gets to get there,
+    and how many of the messages said meanwhile each one missed.
+    """
+    port = free_port()
+    ready = multiprocessing.Event()
+    server = multiprocessing.Process(target=serve, args=(port, ready),
+                                     daemon=True)
+    server.start()
+    ready.wait()
+    botruntime.raise_file_limit(args.bots * 2)
+    num_rooms = 10
+    said = 5
+    runs = iter(range(1000000))
+
+    async def connect(factories):
+        loop = asyncio.get_event_loop()
+        limit = asyncio.Semaphore(100)
+
+        async def one(factory):
+            logged_in = loop.create_future()
+            async with limit:
+                await botruntime.open_connection(
+                    lambda: factory(logged_in), HOST, port)
+                return await asyncio.wait_for(logged_in, 30)
+
+        return await asyncio.gather(*(one(factory) for factory in factories))
+
+    def room_bots(run, sessions, metrics):
+        return [
+            lambda logged_in, index=index, sm=sm: RoomBot(
+                "resumebot_{0}_{1}@{2}".format(run, index, HOST),
+                "resume_room_{0}_{1}@conference.{2}".format(
+                    run, index % num_rooms, HOST),
+                logged_in, sm, metrics)
+            for index, sm in enumerate(sessions)
+        ]
+
+    async def glitch(resume):
+        run = next(runs)
+        sessions = [StreamManagement() if resume else None
+                    for i in range(args.bots)]
+        bots = await connect(room_bots(run, sessions, XmppMetrics()))
+        talkers = await connect([
+            lambda logged_in, index=index: RoomBot(
+                "resumetalker_{0}_{1}@{2}".format(run, index, HOST),
+                "resume_room_{0}_{1}@conference.{2}".format(run, index, HOST),
+                logged_in)
+            for index in range(num_rooms)])
+        # Until the server has acked the joins
+        await asyncio.sleep(0.2)
+
+        for bot in bots:
+            bot.transport.abort()
+        await asyncio.sleep(0.1)
+        for talker in talkers:
+            for i in range(said):
+                talker.handler.groupchat(talker.room, "Where did you go?")
+        await asyncio.sleep(0.1)
+
+        metrics = XmppMetrics()
+        start = time.perf_counter()
+        cpu_start = time.process_time()
+        bots = await connect(room_bots(run, sessions, metrics))
+        elapsed = time.perf_counter() - start
+        cpu = time.process_time() - cpu_start
+        # For the messages that were missed to come in
+        await asyncio.sleep(0.2)
+        missed = sum(said - bot.received for bot in bots)
+
+        for bot in bots + talkers:
+            bot.close()
+        await asyncio.sleep(0.1)
+        return elapsed, cpu, metrics, missed
+
+    loop = botruntime.create_event_loop("asyncio")
+    try:
+        for mode in ("relogin", "resume"):
+            results = [loop.run_until_complete(glitch(mode == "resume"))
+                       for i in range(args.repeat)]
+            elapsed, cpu, metrics, missed = min(results, key=lambda r: r[0])
+            report("reconnect {0}".format(mode), elapsed, args.bots, "bots",
+                   mode=mode)
+            report_value("reconnect cpu {0}".format(mode),
+                         cpu / args.bots * 1e6, "us/bot", mode=mode)
+            report_value("reconnect stanzas out {0}".format(mode),
+                         sum(metrics.stanzas_out.values()) / args.bots,
+                         "stanzas/bot", mode=mode)
+            report_value("reconnect stanzas in {0}".format(mode),
+                         sum(metrics.stanzas_in.values()) / args.bots,
+                         "stanzas/bot", mode=mode)
+            report_value("reconnect missed {0}".format(mode),
+                         max(result[3] for result in results) / args.bots,
+                         "messages/bot", mode=mode)
+    finally:
+        loop.close()
+        asyncio.set_event_loop(None)
+        server.terminate()
+        server.join()
+
+
+def environment():
+    try:
+        commit = subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "machine": platform.machine(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+    }
+
+
+def compare(baseline_path, threshold):
+    """
+    Compares this run with a saved one. Returns the names of benchmarks that
+    got worse by more than `threshold`.
+    """
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    baseline_results = {
+        result["name"]: result for result in baseline["results"]
+    }
+
+    regressions = []
+    print()
+    print("Compared to {0}:".format(
+        baseline["environment"].get("commit") or baseline_path))
+    for result in RESULTS:
+        base = baseline_results.get(result["name"])
+        if not base:
+            continue
+        if "rate" in result:
+            change = result["rate"] / base["rate"] - 1.0
+        else:
+            # Lower is better, so an increase shows as a drop
+            change = base["value"] / result["value"] - 1.0
+        marker = ""
+        if change < -threshold:
+            marker = "  REGRESSION"
+            regressions.append(result["name"])
+        print("{0:<52} {1:+8.1%}{2}".format(result["name"], change, marker))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "-b", "--benchmark",
+        dest="benchmarks",
+        action="append",
+        choices=sorted(BENCHMARKS),
+        help="A benchmark to run, may be repeated (default: all)"
+    )
+
+    parser.add_argument(
+        "-s", "--stanzas",
+        type=int,
+        default=5000,
+        help="The number of stanzas in generated streams"
+    )
+
+    parser.add_argument(
+        "-c", "--chunk-sizes",
+        type=int,
+        nargs="+",
+        default=[0, 256, 4096],
+        help="Sizes of the reads to split streams into (0 for one read)"
+    )
+
+    parser.add_argument(
+        "--bots",
+        type=int,
+        default=200,
+        help="The number of bots connected at once by the connect and bots "
+             "benchmarks (a quarter as many log in one by one for the tls "
+             "benchmark)"
+    )
+
+    parser.add_argument(
+        "-r", "--repeat",
+        type=int,
+        default=3,
+        help="Number of runs per benchmark, the best one is reported"
+    )
+
+    parser.add_argument(
+        "-j", "--json",
+        help="Write the results to this file as JSON"
+    )
+
+    parser.add_argument(
+        "--compare",
+        metavar="BASELINE",
+        help="Compare the results with a file written with --json"
+    )
+
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="Slowdown (as a fraction) counted as a regression by --compare"
+    )
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+
+    for name in args.benchmarks or sorted(BENCHMARKS):
+        BENCHMARKS[name](args)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({
+                "environment": environment(),
+                "settings": {
+                    "stanzas": args.stanzas,
+                    "chunk_sizes": args.chunk_sizes,
+                    "repeat": args.repeat,
+                    "bots": args.bots,
+                    "seed": SEED,
+                },
+                "results": RESULTS,
+            }, f, indent=2)
+
+    if args.compare:
+        regressions = compare(args.compare, args.threshold)
+        if regressions:
+            return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
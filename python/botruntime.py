@@ -0,0 +1,223 @@
+"""
+Event loop and socket setup shared by the bots.
+
+`create_event_loop` picks the loop implementation: uvloop when it is
+installed, as it spends less CPU per connection on the loop and the
+sockets, otherwise the one in the standard library. Bots connect with
+`open_connection`, which tunes each socket before connecting, and
+`run_forever` runs the loop until it is stopped or the process is told to
+stop, and then shuts everything down in order.
+"""
+import asyncio
+import logging
+import signal
+import socket
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+LOOPS = ("auto", "uvloop", "asyncio")
+
+# Files left over for everything other than the bots' sockets: logs, the
+# metrics server, pipes to the workers of a fleet and so on
+RESERVED_FILES = 64
+
+# Signals that start an orderly shutdown
+SHUTDOWN_SIGNALS = (signal.SIGINT, signal.SIGTERM)
+
+
+def install_event_loop(kind="auto"):
+    """
+    Sets the event loop policy for `kind`, one of `LOOPS`, and returns the
+    name of the loop implementation used. Processes forked afterwards, such
+    as the workers of a fleet, inherit the policy.
+    """
+    if kind not in LOOPS:
+        raise ValueError("Unknown event loop: {0}".format(kind))
+    if kind == "auto":
+        kind = "asyncio" if uvloop is None else "uvloop"
+    if kind == "uvloop":
+        if uvloop is None:
+            raise RuntimeError("uvloop is not installed")
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    else:
+        asyncio.set_event_loop_policy(None)
+    return kind
+
+
+def create_event_loop(kind=None):
+    """
+    Creates a new event loop from the current policy, or from the one for
+    `kind` when given, and makes it the current loop.
+    """
+    if kind is not None:
+        install_event_loop(kind)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    return loop
+
+
+def raise_file_limit(wanted):
+    """
+    Raises the limit on open files to `wanted` plus `RESERVED_FILES`, as far
+    as the hard limit allows. Returns the limit, or None where there are no
+    limits to raise.
+    """
+    if resource is None:
+        return None
+    wanted += RESERVED_FILES
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY or soft >= wanted:
+        return soft
+    limit = wanted
+    if hard != resource.RLIM_INFINITY:
+        limit = min(wanted, hard)
+    try:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (limit, hard))
+    except (ValueError, OSError) as e:
+        logger.warning("Can't raise the limit on open files: %s", e)
+        return soft
+    if limit < wanted:
+        logger.warning("Only %d files may be open, %d wanted. Raise the hard "
+                       "limit with ulimit -Hn.", limit, wanted)
+    return limit
+
+
+class SocketOptions(object):
+    """
+    Options set on each bot's socket before it connects.
+
+    Bots send lots of small stanzas and wait for the answers, so Nagle's
+    algorithm only adds latency. Buffer sizes are left to the kernel unless
+    given; small ones save kernel memory when running many idle bots.
+    """
+
+    def __init__(self, nodelay=True, send_buffer=None, receive_buffer=None):
+        self.nodelay = nodelay
+        self.send_buffer = send_buffer
+        self.receive_buffer = receive_buffer
+
+    def apply(self, sock):
+        if sock.family in (socket.AF_INET, socket.AF_INET6):
+            self.apply_nodelay(sock)
+        if self.send_buffer:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF,
+                            self.send_buffer)
+        if self.receive_buffer:
+            # Must be set before connecting to affect the TCP window
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                            self.receive_buffer)
+
+    def apply_nodelay(self, sock):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY,
+                        1 if self.nodelay else 0)
+
+
+# Addresses by host name and port. Bots all connect to the same server, so it
+# is only looked up once rather than on every (re)connect.
+addresses = {}
+
+
+async def resolve(loop, host, port):
+    key = (host, port)
+    infos = addresses.get(key)
+    if infos is None:
+        infos = await loop.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+        if not infos:
+            raise OSError("No addresses found for {0}".format(host))
+        addresses[key] = infos
+    return infos
+
+
+async def open_connection(protocol_factory, host, port, options=None):
+    """
+    Like `loop.create_connection`, but with `options` applied to the socket
+    and the address of `host` cached.
+    """
+    loop = asyncio.get_event_loop()
+    if options is None:
+        options = SocketOptions()
+    error = None
+    for family, type_, proto, _, address in await resolve(loop, host, port):
+        sock = socket.socket(family, type_, proto)
+        try:
+            sock.setblocking(False)
+            options.apply(sock)
+            await loop.sock_connect(sock, address)
+        except OSError as e:
+            sock.close()
+            error = e
+            continue
+        except BaseException:
+            sock.close()
+            raise
+        break
+    else:
+        raise error
+
+    try:
+        transport, protocol = await loop.create_connection(protocol_factory,
+                                                           sock=sock)
+    except BaseException:
+        sock.close()
+        raise
+    # Transports switch Nagle's algorithm off themselves, so this only
+    # matters when it was asked for
+    if not options.nodelay:
+        options.apply_nodelay(transport.get_extra_info("socket"))
+    return transport, protocol
+
+
+def cancel_tasks(loop):
+    """
+    Cancels every task left on `loop` and waits for them to finish.
+    """
+    tasks = asyncio.all_tasks(loop)
+    if not tasks:
+        return
+    for task in tasks:
+        task.cancel()
+    loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+    for task in tasks:
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Task failed while shutting down: %r",
+                         task.exception())
+
+
+def run_forever(loop, shutdown=None, timeout=5.0):
+    """
+    Runs `loop` until it is stopped or SIGINT or SIGTERM arrive, then shuts
+    down: waits up to `timeout` seconds for the coroutine returned by
+    `shutdown()`, if given, so connections can close cleanly, cancels the
+    tasks left and closes the loop. Further signals are ignored meanwhile.
+    """
+    for signum in SHUTDOWN_SIGNALS:
+        loop.add_signal_handler(signum, loop.stop)
+    try:
+        loop.run_forever()
+    finally:
+        for signum in SHUTDOWN_SIGNALS:
+            loop.add_signal_handler(signum, logger.info,
+                                    "Already shutting down")
+        try:
+            if shutdown is not None:
+                try:
+                    loop.run_until_complete(
+                        asyncio.wait_for(shutdown(), timeout))
+                except asyncio.TimeoutError:
+                    logger.warning("Shutting down took over %.0fs, giving up",
+                                   timeout)
+            cancel_tasks(loop)
+            loop.run_until_complete(loop.shutdown_asyncgens())
+        finally:
+            # Which removes the signal handlers as well
+            loop.close()
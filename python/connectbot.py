@@ -4,6 +4,7 @@ import asyncio
 import logging
 import sys
 
+import botruntime
 from xmpphandler import XmppHandler
 
 logging.basicConfig(level=logging.DEBUG)
@@ -22,27 +23,41 @@ class ConnectBot(asyncio.Protocol):
 
     def connect(self):
         loop = asyncio.get_event_loop()
-        handler = loop.create_connection(lambda: self, self.servername, 5222)
+        handler = botruntime.open_connection(lambda: self, self.servername,
+                                             5222)
         loop.create_task(handler)
 
     def connection_made(self, transport):
         logger.debug("Connection made")
         self.transport = transport
         self.xmppHandler = XmppHandler()
+        self.xmppHandler.tracer.name = self.username
+        if logger.isEnabledFor(logging.DEBUG):
+            self.xmppHandler.tracer.enable()
         self.xmppHandler.send = self.write
+        self.xmppHandler.coalesce_writes = True
 
         self.xmppHandler.connect(self.host, self.username, self.password)
+        asyncio.get_event_loop().create_task(self.run())
 
     def connection_lost(self, exc):
         logger.debug("Connection lost")
+        self.xmppHandler.connection_lost()
+
+    async def run(self):
+        try:
+            await self.xmppHandler.wait_ready()
+        except ConnectionError:
+            logger.warning("%s failed to log in", self.username)
+            return
+        logger.info("%s logged in", self.username)
 
     def write(self, data):
-        logger.debug("%s: Send: %s", self.username, data.encode())
-        self.transport.write(data.encode())
+        self.transport.write(data)
 
     def data_received(self, data):
         logger.debug("%s: Received %d bytes", self.username, len(data))
-        self.xmppHandler.handle_raw_response(data.decode())
+        self.xmppHandler.handle_raw_response(data)
 
 
 def main():
@@ -63,13 +78,11 @@ def main():
     args = parser.parse_args()
 
     logger.debug("Echobot is starting")
-    loop = asyncio.get_event_loop()
+    loop = botruntime.create_event_loop("auto")
 
     bot = ConnectBot(args.host_name, "echobot", servername=args.server_name)
     bot.connect()
-    loop.run_forever()
-
-    loop.close()
+    botruntime.run_forever(loop)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,216 @@
+import asyncio
+import collections
+import logging
+import random
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket(object):
+    """
+    Allows `rate` events per second on average, and bursts of up to
+    `capacity` at once. A rate of None means no limit.
+    """
+
+    def __init__(self, rate, capacity=1, now=0.0):
+        self.rate = rate
+        self.capacity = max(capacity, 1)
+        self.tokens = self.capacity
+        self.updated = now
+
+    def take(self, now):
+        """
+        Takes a token if there is one, and returns 0. Otherwise returns how
+        long to wait for the next one.
+        """
+        if self.rate is None:
+            return 0
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class Backoff(object):
+    """
+    Exponential backoff with full jitter: after n failures in a row, the
+    delay is picked at random between 0 and base * 2^n, up to `maximum`.
+    Spreading the delays like this keeps bots that were all disconnected at
+    the same moment from all coming back at the same moment.
+    """
+
+    def __init__(self, base=1.0, maximum=60.0):
+        self.base = base
+        self.maximum = maximum
+
+    def delay(self, failures):
+        ceiling = min(self.maximum, self.base * (2 ** min(failures, 32)))
+        return random.uniform(0, ceiling)
+
+
+class ConnectionScheduler(object):
+    """
+    Decides when bots may start connecting.
+
+    Bots waiting to connect are admitted in the order they asked, at no more
+    than `rate` per second (with bursts of up to `burst`), and only while
+    fewer than `max_handshakes` are between starting to connect and being
+    logged in. Bots that lose their connection, or fail to make one, try
+    again after a jittered exponential backoff.
+
+    Bots are identified by a key, such as their username. `connect` is
+    called with the key to start connecting a bot, and the owner reports
+    back with `handshake_done` once it has logged in or failed. If that takes
+    longer than `handshake_timeout`, `abort` is called with the key and the
+    slot is given to the next bot. Bots that are gone for good are dropped
+    with `remove`.
+    """
+
+    def __init__(self, connect, abort=None, rate=None, burst=1,
+                 max_handshakes=None, backoff=None, handshake_timeout=None,
+                 loop=None):
+        self.connect = connect
+        self.abort = abort
+        self.loop = loop or asyncio.get_event_loop()
+        self.bucket = TokenBucket(rate, burst, self.loop.time())
+        self.max_handshakes = max_handshakes
+        self.backoff = backoff or Backoff()
+        self.handshake_timeout = handshake_timeout
+
+        # Bots waiting for admission, in order
+        self.waiting = collections.deque()
+        self.waiting_set = set()
+
+        # Bots admitted and not yet logged in, with their timeout handles
+        self.handshaking = {}
+
+        # Failures in a row for each bot, reset when it logs in
+        self.failures = {}
+
+        # Bots waiting out a backoff delay, with the handles to request them
+        # again
+        self.backing_off = {}
+
+        self.admit_handle = None
+
+        self.admitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.timed_out = 0
+        self.retries = 0
+        self.throttled = 0
+        self.max_in_flight = 0
+
+    def get_status(self):
+        return {
+            "waiting": len(self.waiting) + len(self.backing_off),
+            "connecting": len(self.handshaking),
+            "connects": self.admitted,
+            "connect_failures": self.failed,
+            "handshake_timeouts": self.timed_out,
+            "retries": self.retries,
+            "throttled": self.throttled,
+        }
+
+    def ramp_time(self, num_bots):
+        """
+        How long it should take to admit `num_bots`, limited by the rate.
+        """
+        rate = self.bucket.rate
+        if rate is None:
+            return 0.0
+        return max(0.0, num_bots - self.bucket.capacity) / rate
+
+    def request(self, bot):
+        """
+        Queues a bot to connect as soon as it is allowed to.
+        """
+        if bot in self.waiting_set or bot in self.handshaking:
+            return
+        self.backing_off.pop(bot, None)
+        self.waiting.append(bot)
+        self.waiting_set.add(bot)
+        if self.admit_handle is None:
+            self.admit()
+
+    def retry(self, bot):
+        """
+        Queues a bot to connect again after a backoff delay, which grows with
+        every failure since it last logged in.
+        """
+        failures = self.failures.get(bot, 0)
+        self.failures[bot] = failures + 1
+        delay = self.backoff.delay(failures)
+        logger.debug("Retrying %s in %.1fs", bot, delay)
+        self.retries += 1
+        handle = self.backing_off.pop(bot, None)
+        if handle is not None:
+            handle.cancel()
+        self.backing_off[bot] = self.loop.call_later(delay, self.request, bot)
+
+    def remove(self, bot):
+        """
+        Forgets a bot that won't connect again, such as one stopped for good,
+        along with its failures and any retry it was waiting for.
+        """
+        self.failures.pop(bot, None)
+        handle = self.backing_off.pop(bot, None)
+        if handle is not None:
+            handle.cancel()
+        if bot in self.waiting_set:
+            self.waiting_set.discard(bot)
+            self.waiting.remove(bot)
+
+    def handshake_done(self, bot, success):
+        handle = self.handshaking.pop(bot, None)
+        if handle is None:
+            return
+        if handle is not True:
+            handle.cancel()
+        if success:
+            self.completed += 1
+            self.failures.pop(bot, None)
+        else:
+            self.failed += 1
+        if self.waiting and self.admit_handle is None:
+            self.admit()
+
+    def admit(self):
+        self.admit_handle = None
+        waiting = self.waiting
+        while waiting:
+            if self.max_handshakes is not None and \
+                    len(self.handshaking) >= self.max_handshakes:
+                # Picked up again by `handshake_done`
+                return
+            wait = self.bucket.take(self.loop.time())
+            if wait > 0:
+                self.throttled += 1
+                self.admit_handle = self.loop.call_later(wait, self.admit)
+                return
+
+            bot = waiting.popleft()
+            self.waiting_set.discard(bot)
+            if self.handshake_timeout is not None:
+                self.handshaking[bot] = self.loop.call_later(
+                    self.handshake_timeout, self.expire, bot)
+            else:
+                self.handshaking[bot] = True
+            self.admitted += 1
+            self.max_in_flight = max(self.max_in_flight,
+                                     len(self.handshaking))
+            self.connect(bot)
+
+    def expire(self, bot):
+        if self.handshaking.pop(bot, None) is None:
+            return
+        self.timed_out += 1
+        self.failed += 1
+        logger.warning("Handshake for %s timed out", bot)
+        if self.abort is not None:
+            self.abort(bot)
+        if self.waiting and self.admit_handle is None:
+            self.admit()
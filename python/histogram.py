@@ -0,0 +1,114 @@
+from array import array
+
+
+class Histogram(object):
+    """
+    A histogram of non-negative integers (such as latencies in microseconds)
+    in the style of HdrHistogram: values are counted in buckets whose width
+    grows with the value, so each is recorded to within a fixed relative
+    precision however large it is, in a small, fixed amount of memory.
+
+    With the default of 8 `sub_bucket_bits`, values below 256 are exact and
+    larger ones are within 1/128 (under 1%). Recording is a few integer
+    operations, and histograms can be merged, e.g. to combine the results
+    of several processes.
+    """
+    __slots__ = ("sub_bucket_bits", "counts", "total", "max", "sum")
+
+    def __init__(self, sub_bucket_bits=8):
+        self.sub_bucket_bits = sub_bucket_bits
+        self.counts = array("Q")
+        self.total = 0
+        self.max = 0
+        self.sum = 0
+
+    def __len__(self):
+        return self.total
+
+    def index_of(self, value):
+        bucket = value.bit_length() - self.sub_bucket_bits
+        if bucket <= 0:
+            return value
+        return (bucket << (self.sub_bucket_bits - 1)) + (value >> bucket)
+
+    def value_at_index(self, index):
+        """
+        The highest value counted at `index`.
+        """
+        bucket = (index >> (self.sub_bucket_bits - 1)) - 1
+        if bucket <= 0:
+            return index
+        sub_bucket = index - (bucket << (self.sub_bucket_bits - 1))
+        return ((sub_bucket + 1) << bucket) - 1
+
+    def record(self, value, count=1):
+        if value < 0:
+            value = 0
+        # index_of, inlined as this is called for every stanza
+        bits = self.sub_bucket_bits
+        bucket = value.bit_length() - bits
+        if bucket <= 0:
+            index = value
+        else:
+            index = (bucket << (bits - 1)) + (value >> bucket)
+        try:
+            self.counts[index] += count
+        except IndexError:
+            self.counts.extend([0] * (index + 1 - len(self.counts)))
+            self.counts[index] += count
+        self.total += count
+        self.sum += value * count
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        if other.sub_bucket_bits != self.sub_bucket_bits:
+            raise ValueError("Can't merge histograms of different precision")
+        counts = self.counts
+        if len(other.counts) > len(counts):
+            counts.extend([0] * (len(other.counts) - len(counts)))
+        for index, count in enumerate(other.counts):
+            if count:
+                counts[index] += count
+        self.total += other.total
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    def clear(self):
+        self.counts = array("Q")
+        self.total = 0
+        self.max = 0
+        self.sum = 0
+
+    @property
+    def min(self):
+        """
+        The lowest value recorded, to within the precision of the histogram.
+        """
+        for index, count in enumerate(self.counts):
+            if count:
+                return self.value_at_index(index)
+        return None
+
+    def mean(self):
+        if not self.total:
+            return None
+        return self.sum / self.total
+
+    def percentile(self, percentile):
+        """
+        Returns the value below which `percentile` percent of the recorded
+        values fall, or None if nothing has been recorded.
+        """
+        if not self.total:
+            return None
+        wanted = max(1, int(self.total * percentile / 100.0 + 0.5))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= wanted:
+                return min(self.value_at_index(index), self.max)
+        return self.max
+
+    def percentiles(self, *percentiles):
+        return [self.percentile(p) for p in percentiles]
@@ -1,15 +1,51 @@
 #!/usr/bin/env python3
 import argparse
+import concurrent.futures
+import multiprocessing
+import queue
 import random
 import asyncio
 import logging
+import os
+import signal
 
 import sys
 
+import botruntime
+import scram
+import xmpptls
+from connectionscheduler import Backoff, ConnectionScheduler
+from latency import DELAY_NAMESPACE, LatencyRecorder, add_marker, new_session
+from metricsserver import MetricsServer, write_snapshots
+from outboundqueue import OutboundQueue
+from loadprofile import DISTRIBUTIONS, LoadProfile, MessagePacer, RoomChooser
+from streammanagement import StreamManagement
 from xmpphandler import XmppHandler
+from xmppmetrics import PrometheusWriter, XmppMetrics, summarize
+from xmpptrace import StanzaTracer
 
 logger = logging.getLogger(__name__)
 
+# The most stanzas handled per event loop iteration, so a burst of incoming
+# stanzas (e.g. history when joining a busy room) doesn't starve other bots
+DISPATCH_BATCH = 64
+
+# Status values that only ever go up, exported as counters
+STATUS_COUNTERS = (
+    "reconnects", "messages_sent", "connects", "connect_failures",
+    "handshake_timeouts", "retries", "throttled", "scram_derivations",
+    "scram_cache_hits", "resumes", "backpressured",
+)
+
+# How often the monitor shows latency and loss for every room, in seconds
+ROOM_REPORT_INTERVAL = 10
+
+# All bots read into this one buffer. The data is handed straight to the
+# bot's parser, which copies whatever it needs to keep, so it's free to be
+# reused for the next read.
+RECEIVE_BUFFER_SIZE = 65536
+receive_buffer = memoryview(bytearray(RECEIVE_BUFFER_SIZE))
+
 PHRASES = [
     "Today a man knocked on my door and asked for a small donation towards the local swimming pool. I gave him a glass of water.",
     "A recent study has found that women who carry a little extra weight live longer than the men who mention it.",
@@ -46,58 +82,241 @@ PHRASES = [
 ]
 
 
-class JumperBot(asyncio.Protocol):
-    def __init__(self, manager, host, username, password, num_rooms):
+class BotSet(object):
+    """
+    A set of usernames that a random one can be picked from quickly.
+    """
+
+    def __init__(self):
+        self.usernames = []
+        self.positions = {}
+
+    def __len__(self):
+        return len(self.usernames)
+
+    def add(self, username):
+        if username not in self.positions:
+            self.positions[username] = len(self.usernames)
+            self.usernames.append(username)
+
+    def discard(self, username):
+        position = self.positions.pop(username, None)
+        if position is None:
+            return
+        last = self.usernames.pop()
+        if last != username:
+            self.usernames[position] = last
+            self.positions[last] = position
+
+    def choice(self):
+        if not self.usernames:
+            return None
+        return random.choice(self.usernames)
+
+
+class Bot(object):
+    """
+    One simulated user: who it is, where it is and what it has said there.
+    Bots have no behaviour of their own. The `BotManager` decides what they
+    do, and they do it through their `BotConnection`, which may be shared
+    with many other bots.
+    """
+    __slots__ = ("username", "nick", "jid", "listener", "connection", "room",
+                 "phrases_left", "session", "sequence")
+
+    def __init__(self, username, nick, jid=None, listener=False):
+        self.username = username
+        self.nick = nick
+        # The full JID to send as, when the connection is a component's. On
+        # a connection of its own, a bot is whatever the server bound.
+        self.jid = jid
+        self.listener = listener
+        self.connection = None
+
+        # The room the bot is in and how many phrases to say before jumping
+        self.room = None
+        self.phrases_left = 0
+
+        # Every message sent is marked with the session and a sequence number,
+        # so listeners can measure latency and loss. Each visit to a room is a
+        # new session.
+        self.session = None
+        self.sequence = 0
+
+
+class BotConnection(asyncio.BufferedProtocol):
+    """
+    A connection to the server, and the bots using it.
+
+    Normally that is one bot, logged in as itself. With `component` set, the
+    connection logs in as that external component, and any number of bots
+    with JIDs in its domain share it: stanzas they receive are routed to
+    them by the JID they are addressed to.
+
+    With stream management, the connection keeps its `StreamManagement`
+    when it is lost, and resumes the stream when it reconnects, with its
+    bots still in their rooms.
+
+    Stanzas go out through an `OutboundQueue`, at no more than the rate the
+    manager allows each connection, and the bots stop talking while the
+    connection is congested.
+    """
+
+    def __init__(self, manager, name, host, password, component=None):
         self.manager = manager
+        self.name = name
         self.host = host
-        self.username = "{0}@{1}".format(username, host)
         self.password = password
+        self.component = component
+        self.bots = {}
         self.xmppHandler = None
         self.transport = None
+        self.connect_task = None
+        self.ready = False
+
+        # Set when the handshake timed out before it even connected, so that
+        # cancelling `connect_task` tries again rather than giving up
+        self.aborted = False
 
-        self.num_rooms = num_rooms
-        self.current_channel = None
-        self.listener = False
-        self.task = None
+        # Kept across reconnects so tracing stays on for this connection, and
+        # so the stream can be resumed
+        self.tracer = StanzaTracer(name)
+        self.stream_management = None
 
     def connection_made(self, transport):
-        logger.debug("%s: Connection made", self.username)
+        logger.debug("%s: Connection made", self.name)
         self.transport = transport
-        self.xmppHandler = XmppHandler()
-        self.xmppHandler.handle_message = self.handle_xmpp_message
+        self.xmppHandler = XmppHandler(metrics=self.manager.metrics)
+        self.xmppHandler.tracer = self.tracer
+        self.xmppHandler.add_route(self.handle_xmpp_message, tag="message",
+                                   type="groupchat")
+        self.xmppHandler.add_route(self.handle_xmpp_presence, tag="presence",
+                                   type="error")
         self.xmppHandler.send = self.write
+        self.xmppHandler.coalesce_writes = True
+        self.xmppHandler.outbound = OutboundQueue(
+            self.manager.send_rate, self.manager.send_burst,
+            self.manager.send_queue)
 
-        self.xmppHandler.handle_presence = self.handle_xmpp_presence
+        self.xmppHandler.dispatch_batch = DISPATCH_BATCH
+        self.xmppHandler.pause_reading = transport.pause_reading
+        self.xmppHandler.resume_reading = transport.resume_reading
+        self.xmppHandler.handle_logged_in = self.handle_logged_in
+        self.xmppHandler.handle_login_failed = self.handle_login_failed
         self.xmppHandler.handle_closed = self.handle_closed
         self.xmppHandler.handle_stream_error = self.handle_stream_error
-        self.xmppHandler.connect(self.host, self.username, self.password)
-        self.task = asyncio.get_event_loop().create_task(self.run())
+        self.xmppHandler.start_tls = self.start_tls
+        self.xmppHandler.mechanisms = self.manager.mechanisms
+        self.xmppHandler.pipeline_login = self.manager.pipeline_login
+        if self.component is not None:
+            self.xmppHandler.connect_component(self.component, self.password)
+        else:
+            self.xmppHandler.use_tls = self.manager.tls_context is not None
+            if self.manager.stream_management:
+                if self.stream_management is None:
+                    self.stream_management = StreamManagement()
+                self.xmppHandler.stream_management = self.stream_management
+            self.xmppHandler.connect(self.host, self.name, self.password)
 
     def connection_lost(self, exc):
         logger.warning("Connection lost")
         self.transport.close()
+        self.xmppHandler.connection_lost()
         self.xmppHandler = None
-        self.manager.notify_closed(self.username)
-        if self.task:
-            self.task.cancel()
+        self.transport = None
+        self.ready = False
+        self.manager.notify_closed(self)
 
     def write(self, data):
-        logger.debug("%s: Send: %s", self.username, data.encode())
-        self.transport.write(data.encode())
+        # Not after a stream error, say, before the connection is gone
+        if not self.transport.is_closing():
+            self.transport.write(data)
+
+    def pause_writing(self):
+        if self.xmppHandler is not None:
+            self.xmppHandler.pause_writing()
 
-    def data_received(self, data):
-        logger.debug("%s: Received %d bytes", self.username, len(data))
-        self.xmppHandler.handle_raw_response(data.decode())
+    def resume_writing(self):
+        if self.xmppHandler is not None:
+            self.xmppHandler.resume_writing()
+
+    def is_congested(self):
+        return self.xmppHandler is None or self.xmppHandler.is_congested()
+
+    def close(self):
+        """
+        Ends the stream cleanly, so the server doesn't keep it for resuming,
+        and closes the connection.
+        """
+        if self.ready:
+            self.xmppHandler.close_stream()
+        self.transport.close()
+
+    def can_resume(self):
+        return self.stream_management is not None and \
+            self.stream_management.resumable
+
+    def get_buffer(self, sizehint):
+        return receive_buffer
+
+    def buffer_updated(self, nbytes):
+        logger.debug("%s: Received %d bytes", self.name, nbytes)
+        self.xmppHandler.handle_raw_response(receive_buffer[:nbytes])
+
+    def recipient(self, response):
+        if self.component is None:
+            return self.bots.get(self.name)
+        return self.bots.get((response.to_jid or "").partition("/")[0])
 
     def handle_xmpp_message(self, response):
-        pass
+        bot = self.recipient(response)
+        if bot is None or not bot.listener:
+            return
+        if response.find_child_with_tag("delay", DELAY_NAMESPACE) is not None:
+            # Room history, sent on joining
+            return
+        room, _, sender = (response.from_jid or "").partition("/")
+        self.manager.latency.record(bot.username, room, sender, response.body)
 
     def handle_xmpp_presence(self, response):
+        logger.warning(response.toXml())
+
+    def start_tls(self):
+        asyncio.get_event_loop().create_task(self.upgrade())
+
+    async def upgrade(self):
+        transport = self.transport
+        handler = self.xmppHandler
         try:
-            if response.attributes.getValue("type") == "error":
-                logger.warning(response.toXml())
-        except Exception:
-            pass
+            self.transport = await xmpptls.start_tls(
+                transport, self, self.manager.tls_context, self.host,
+                handler.metrics)
+        except OSError as e:
+            logger.warning("%s: TLS handshake failed: %s", self.name, e)
+            transport.close()
+            return
+        if self.xmppHandler is not handler:
+            # Lost the connection meanwhile
+            return
+        handler.pause_reading = self.transport.pause_reading
+        handler.resume_reading = self.transport.resume_reading
+        handler.handle_tls_established()
+
+    def handle_logged_in(self):
+        self.ready = True
+        if self.xmppHandler.tls_active:
+            # By now the server has sent the ticket to resume the session with
+            self.manager.tls_context.remember(self.transport, self.host)
+        if self.xmppHandler.resumed:
+            logger.info("%s resumed its stream", self.name)
+            self.manager.connection_resumed(self)
+        else:
+            logger.info("%s logged in", self.name)
+            self.manager.connection_ready(self)
+
+    def handle_login_failed(self):
+        # Closing makes the manager try again later
+        self.transport.close()
 
     def handle_closed(self):
         logger.warning("Stream closed")
@@ -107,136 +326,718 @@ class JumperBot(asyncio.Protocol):
         logger.warning("Stream error:\n%s", response.toXml())
         self.transport.close()
 
-    def join_random_room(self):
-        room = random.randrange(self.num_rooms)
-        new_channel = "bot_room_{0}@conference.{1}".format(room, self.host)
+    def join_room(self, bot, room):
+        logger.debug("%s: Joining %s", bot.username, room)
+        self.xmppHandler.join_room(room, jid=bot.jid, nick=bot.nick)
 
-        if new_channel != self.current_channel:
-            if self.current_channel is not None:
-                logger.debug("%s: Leaving %s", self.username,
-                             self.current_channel)
-                self.xmppHandler.leave_room(self.current_channel)
+    def leave_room(self, bot, room):
+        logger.debug("%s: Leaving %s", bot.username, room)
+        self.xmppHandler.leave_room(room, jid=bot.jid, nick=bot.nick)
 
-        self.current_channel = new_channel
+    def groupchat(self, bot, room, text):
+        self.xmppHandler.groupchat(room, text, sender=bot.jid)
 
-        logger.debug("%s: Joining %s", self.username, self.current_channel)
-        self.xmppHandler.join_room(self.current_channel)
 
-    def say_random_phrase(self):
-        if self.listener:
-            return
-        phrase = random.choice(PHRASES)
-        logger.debug("%s: %s", self.username, phrase)
-        self.xmppHandler.groupchat(self.current_channel, phrase)
-
-    async def run(self):
-        while self.xmppHandler.state != "ready":
-            if self.transport.is_closing():
-                return
-            logger.debug("Waiting for %s to log in", self.username)
-            try:
-                await asyncio.sleep(1)
-            except asyncio.CancelledError:
-                return
-
-        self.manager.notify_login(self.username)
-        logger.info("%s logged in", self.username)
-        while True:
-            self.join_random_room()
-            n = random.randint(5, 10)
-            for i in range(n):
-                if self.transport.is_closing():
-                    return
-                self.say_random_phrase()
-                try:
-                    await asyncio.sleep(random.random() * 10.0 + 5.0)
-                except asyncio.CancelledError:
-                    return
+class BotManager(object):
+    """
+    Runs bots following a load profile: connects them, moves them between
+    rooms and has them talk, at the pace the profile sets.
 
+    Bots are `Bot` records, keyed by username, and connections are
+    `BotConnection`s, keyed by name. Normally every bot has a connection of
+    its own, named after it. With `--component`, bots share connections
+    instead, `--bots-per-connection` each, which takes far less memory per
+    bot. The connection scheduler decides when connections, rather than
+    bots, connect.
+    """
 
-class BotManager(object):
-    def __init__(self):
+    def __init__(self, status_queue=None, worker_id=None):
         self.bots_running = {}
         self.bots_logged_in = {}
+        self.connections = {}
+        self.reconnects = 0
+        self.resumes = 0
+        self.messages_sent = 0
+        self.backpressured = 0
         self.args = None
 
-    def create_bot(self, botname, args):
-        bot = JumperBot(self, args.host_name, botname, "jumperbot",
-                        args.num_rooms)
-        if args.listener:
-            bot.listener = True
+        # Set on every bot's socket before it connects
+        self.socket_options = botruntime.SocketOptions()
+
+        # Shared by all the connections in this process, if they use TLS, so
+        # they can resume each other's sessions
+        self.tls_context = None
+
+        # The SASL mechanisms bots may log in with, in order of preference
+        self.mechanisms = XmppHandler.MECHANISMS
+
+        # Whether connections use stream management, to resume their streams
+        # when they reconnect, and pipeline their logins
+        self.stream_management = False
+        self.pipeline_login = False
+
+        # How fast each connection may send, in stanzas per second (None for
+        # no limit), in bursts of how many, and how many messages may wait
+        # to be sent before more are dropped
+        self.send_rate = None
+        self.send_burst = 5
+        self.send_queue = 100
+
+        # When running as a worker in a fleet, status is reported to the
+        # parent process through this queue rather than displayed.
+        self.status_queue = status_queue
+        self.worker_id = worker_id
+
+        # Latest status reported by each worker process, keyed by worker id.
+        # Only used by the parent process of a fleet.
+        self.worker_status = {}
+        self.workers = []
 
-        self.connect_bot(bot, args)
+        # Decides when bots connect and reconnect. Created with the bots, as
+        # it needs the event loop.
+        self.scheduler = None
 
+        # How many bots to run and how much they say, over time. Messages are
+        # sent by the pacer, from a randomly picked talker that is logged in.
+        self.profile = None
+        self.first_bot = 0
+        self.max_bots = 0
+        self.target_bots = 0
+        self.profile_finished = False
+        self.pacer = MessagePacer(self.send_message)
+        self.talkers = BotSet()
+        self.tasks = []
+        self.stopping = False
+
+        # Latency and loss of the messages received by listeners
+        self.latency = LatencyRecorder()
+
+        # Counters and timings shared by all the connections in this process
+        self.metrics = XmppMetrics()
+        self.metrics_server = None
+
+    def create_scheduler(self, args, num_workers=1):
+        """
+        Creates the connection scheduler for this process, with its share of
+        the fleet-wide connection rate.
+        """
+        rate = args.connect_rate / num_workers if args.connect_rate else None
+        return ConnectionScheduler(
+            self.connect,
+            self.abort,
+            rate=rate,
+            burst=max(1, args.connect_burst // num_workers),
+            max_handshakes=max(1, args.max_handshakes // num_workers),
+            backoff=Backoff(args.backoff_base, args.backoff_max),
+            handshake_timeout=args.handshake_timeout or None
+        )
+
+    def create_bot(self, index, args):
+        botname = "jumperbot_{0}".format(index)
+        listener = not self.profile.is_talker(index)
+        if args.component:
+            username = "{0}@{1}".format(botname, args.component)
+            bot = Bot(username, botname, username + "/jumperbot", listener)
+        else:
+            username = "{0}@{1}".format(botname, args.host_name)
+            bot = Bot(username, botname, listener=listener)
         return bot
 
-    def connect_bot(self, bot, args):
+    def connection_name(self, index, args):
+        if args.component:
+            return "jumperbot_mux_{0}".format(
+                index // args.bots_per_connection)
+        return "jumperbot_{0}@{1}".format(index, args.host_name)
+
+    def add_bot(self, index, args):
+        bot = self.create_bot(index, args)
+        self.bots_running[bot.username] = bot
+        name = self.connection_name(index, args)
+        connection = self.connections.get(name)
+        if connection is None:
+            if args.component:
+                connection = BotConnection(self, name, args.host_name,
+                                           args.component_secret,
+                                           args.component)
+            else:
+                connection = BotConnection(self, name, args.host_name,
+                                           "jumperbot")
+            self.connections[name] = connection
+            self.scheduler.request(name)
+        connection.bots[bot.username] = bot
+        bot.connection = connection
+        if args.trace and bot.nick in args.trace:
+            connection.tracer.enable(args.trace_tags, args.trace_sample)
+        if connection.ready:
+            self.bot_logged_in(bot)
+
+    def connect(self, name):
+        connection = self.connections.get(name)
+        if connection is None:
+            # Stopped while waiting to connect
+            self.scheduler.handshake_done(name, False)
+            return
+        if connection.ready:
+            # Asked for again while already connected, e.g. after stopping
+            # and restarting its bots
+            self.scheduler.handshake_done(name, True)
+            return
+        connection.connect_task = asyncio.get_event_loop().create_task(
+            self.open_connection(connection))
+
+    async def open_connection(self, connection):
+        try:
+            await botruntime.open_connection(
+                lambda: connection, self.args.server_name, self.args.port,
+                self.socket_options)
+        except asyncio.CancelledError:
+            if not connection.aborted:
+                # Stopped, or shutting down
+                raise
+            # The handshake timed out before we even got connected
+            connection.aborted = False
+            self.scheduler.retry(connection.name)
+        except OSError as e:
+            logger.warning("%s failed to connect: %s", connection.name, e)
+            self.scheduler.handshake_done(connection.name, False)
+            self.scheduler.retry(connection.name)
+        finally:
+            connection.connect_task = None
+
+    def abort(self, name):
+        connection = self.connections.get(name)
+        if connection is None:
+            return
+        if connection.connect_task is not None:
+            connection.aborted = True
+            connection.connect_task.cancel()
+        elif connection.transport is not None:
+            connection.transport.close()
+
+    def create_bots(self, args, first=0, count=None):
+        """
+        Runs bots `first` to `first + count` following `args.profile`, or
+        this process's share of it when running as one of several workers.
+        """
+        self.args = args
+        self.socket_options = botruntime.SocketOptions(
+            send_buffer=args.send_buffer, receive_buffer=args.receive_buffer)
+        if args.tls:
+            self.tls_context = xmpptls.create_client_context(
+                args.tls_ca, not args.tls_no_verify)
+        self.mechanisms = tuple(args.mechanisms)
+        self.stream_management = args.stream_management
+        self.pipeline_login = args.pipeline_login
+        self.send_rate = args.send_rate
+        self.send_burst = args.send_burst
+        self.send_queue = args.send_queue
+        if args.scram_threads:
+            scram.KEYS.executor = concurrent.futures.ThreadPoolExecutor(
+                args.scram_threads, "scram")
+        if count is None:
+            count = args.num_bots
+        num_workers = 1
+        if self.worker_id is not None:
+            num_workers = min(args.workers, args.num_bots)
+        self.scheduler = self.create_scheduler(args, num_workers)
+        self.profile = args.profile.scaled(count / args.num_bots)
+        self.first_bot = first
+        self.max_bots = count
+        if args.connect_rate:
+            logger.info("Connecting up to %d bots at %.0f per second, "
+                        "in about %.0fs", count,
+                        args.connect_rate / num_workers,
+                        self.scheduler.ramp_time(count))
+        loop = asyncio.get_event_loop()
+        self.tasks.append(loop.create_task(self.run_profile()))
+        self.tasks.append(loop.create_task(self.pacer.run()))
+
+    async def run_profile(self, interval=0.5):
+        """
+        Keeps the number of bots and the message rate where the profile says
+        they should be.
+        """
+        profile = self.profile
         loop = asyncio.get_event_loop()
-        handler = loop.create_connection(lambda: bot, args.server_name, 5222)
-        loop.create_task(handler)
+        start = loop.time()
+        while True:
+            elapsed = loop.time() - start
+            target, rate = profile.at(elapsed)
+            self.set_bot_count(min(target, self.max_bots))
+            self.pacer.rate = rate
+            if elapsed >= profile.duration:
+                self.profile_finished = True
+                return
+            await asyncio.sleep(interval)
+
+    def set_bot_count(self, target):
+        self.target_bots = target
+        first = self.first_bot
+        for index in range(first + len(self.bots_running), first + target):
+            self.add_bot(index, self.args)
+        for index in range(first + len(self.bots_running) - 1,
+                           first + target - 1, -1):
+            self.stop_bot("jumperbot_{0}@{1}".format(
+                index, self.args.component or self.args.host_name))
+
+    def stop_bot(self, username):
+        bot = self.bots_running.pop(username, None)
+        if bot is None:
+            return
+        self.bots_logged_in.pop(username, None)
+        self.talkers.discard(username)
+        if bot.room is not None:
+            self.session_ended(bot)
+        connection = bot.connection
+        del connection.bots[username]
+        bot.connection = None
+        if connection.bots:
+            # Others are still using the connection
+            if connection.ready and bot.room is not None:
+                connection.leave_room(bot, bot.room)
+            return
+        del self.connections[connection.name]
+        self.scheduler.handshake_done(connection.name, False)
+        self.scheduler.remove(connection.name)
+        if connection.connect_task is not None:
+            connection.connect_task.cancel()
+        elif connection.transport is not None:
+            connection.close()
+
+    async def shutdown(self):
+        """
+        Stops the profile and the pacer and disconnects every bot, asking the
+        workers of a fleet to do the same, and waits until all the
+        connections are closed and the workers have exited.
+        """
+        self.stopping = True
+        for task in self.tasks:
+            task.cancel()
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+        connections = list(self.connections.values())
+        logger.info("Stopping %d bots", len(self.bots_running))
+        for username in list(self.bots_running):
+            self.stop_bot(username)
+        for worker in self.workers:
+            if worker.is_alive():
+                # Workers shut down the same way on SIGTERM
+                worker.terminate()
+        while any(connection.transport is not None
+                  for connection in connections) or \
+                any(worker.is_alive() for worker in self.workers):
+            await asyncio.sleep(0.05)
+
+    def stop_workers(self, timeout):
+        """
+        Kills the workers still running after `timeout` seconds.
+        """
+        for worker in self.workers:
+            worker.join(timeout)
+            if worker.is_alive():
+                logger.warning("Killing %s", worker.name)
+                worker.kill()
+                worker.join()
 
-    def create_bots(self, args):
+    def signal_workers(self, signum):
+        """
+        Passes a signal on to the workers, e.g. SIGUSR1 to toggle tracing,
+        as the bots are theirs.
+        """
+        for worker in self.workers:
+            if worker.is_alive():
+                os.kill(worker.pid, signum)
+
+    def send_message(self):
+        username = self.talkers.choice()
+        if username is None:
+            return False
+        bot = self.bots_running[username]
+        if bot.connection.is_congested():
+            # The message would only wait, or be dropped, so it is skipped
+            # like any other the pacer can't send on time
+            self.backpressured += 1
+            return False
+        self.say_random_phrase(bot)
+        return True
+
+    def join_random_room(self, bot):
+        connection = bot.connection
+        room = "bot_room_{0}@conference.{1}".format(
+            self.profile.rooms.choose(), self.args.host_name)
+        if room != bot.room:
+            if bot.room is not None:
+                connection.leave_room(bot, bot.room)
+                self.session_ended(bot)
+            bot.room = room
+            bot.session = new_session()
+            bot.sequence = 0
+        connection.join_room(bot, room)
+        bot.phrases_left = random.randint(*self.profile.hop_after)
+
+    def session_ended(self, bot):
+        """
+        Tells the listeners' recorder the last message a talker sent to its
+        room, which it has left, so any that never arrived are counted.
+        """
+        if bot.sequence:
+            self.latency.ended(bot.room, bot.nick, bot.session,
+                               bot.sequence - 1)
+
+    def say_random_phrase(self, bot):
+        if bot.phrases_left <= 0:
+            self.join_random_room(bot)
+        bot.phrases_left -= 1
+        phrase = add_marker(random.choice(PHRASES), bot.session, bot.sequence)
+        bot.sequence += 1
+        logger.debug("%s: %s", bot.username, phrase)
+        bot.connection.groupchat(bot, bot.room, phrase)
+        self.messages_sent += 1
+
+    def start_workers(self, args):
+        """
+        Splits the bot range evenly between `args.workers` processes, each
+        running its own event loop and `BotManager`.
+        """
         self.args = args
-        for i in range(args.num_bots):
-            botname = "jumperbot_{0}".format(i)
-            bot = self.create_bot(botname, args)
-            self.bots_running[bot.username] = bot
+        self.status_queue = multiprocessing.Queue()
+        num_workers = min(args.workers, args.num_bots)
+        per_worker, remainder = divmod(args.num_bots, num_workers)
+        first = 0
+        for worker_id in range(num_workers):
+            count = per_worker + (1 if worker_id < remainder else 0)
+            process = multiprocessing.Process(
+                target=run_worker,
+                args=(args, worker_id, first, count, self.status_queue),
+                name="jumperbot-worker-{0}".format(worker_id)
+            )
+            process.start()
+            self.workers.append(process)
+            first += count
+
+    def get_status(self):
+        status = {
+            "running": len(self.bots_running),
+            "logged_in": len(self.bots_logged_in),
+            "connections": len(self.connections),
+            "scram_derivations": scram.KEYS.derivations,
+            "scram_cache_hits": scram.KEYS.hits,
+            "reconnects": self.reconnects,
+            "resumes": self.resumes,
+            "messages_sent": self.messages_sent,
+            "backpressured": self.backpressured,
+            "target_bots": self.target_bots,
+            "message_rate": self.pacer.rate,
+        }
+        if self.scheduler is not None:
+            status.update(self.scheduler.get_status())
+        status["latency"] = LatencyRecorder()
+        status["latency"].merge(self.latency)
+        status["metrics"] = XmppMetrics()
+        status["metrics"].merge(self.metrics)
+        for worker_status in self.worker_status.values():
+            for key, value in worker_status.items():
+                if key in ("latency", "metrics"):
+                    status[key].merge(value)
+                else:
+                    status[key] = status.get(key, 0) + value
+        return status
+
+    def render_metrics(self):
+        """
+        The status of all the bots, in the Prometheus text format.
+        """
+        status = self.get_status()
+        writer = PrometheusWriter()
+        for key, value in sorted(status.items()):
+            if key in ("latency", "metrics"):
+                continue
+            if key in STATUS_COUNTERS:
+                writer.counter("jumperbot_{0}_total".format(key), value,
+                               key.replace("_", " ").capitalize())
+            else:
+                writer.gauge("jumperbot_{0}".format(key), value,
+                             key.replace("_", " ").capitalize())
+
+        latency = status["latency"]
+        writer.summary("jumperbot_message_latency_seconds", latency.latency,
+                       "Delivery latency of groupchat messages")
+        for room, stats in sorted(latency.rooms.items()):
+            writer.summary("jumperbot_room_message_latency_seconds",
+                           stats.latency,
+                           "Delivery latency of groupchat messages by room",
+                           {"room": room})
+        for room, stats in sorted(latency.rooms.items()):
+            writer.counter("jumperbot_room_messages_received_total",
+                           stats.received, "Groupchat messages received",
+                           {"room": room})
+        for room, stats in sorted(latency.rooms.items()):
+            writer.counter("jumperbot_room_messages_lost_total",
+                           stats.total_lost(),
+                           "Groupchat messages that never arrived",
+                           {"room": room})
+
+        writer.add_xmpp_metrics(status["metrics"])
+        return writer.render()
+
+    def metrics_snapshot(self):
+        """
+        The status of all the bots as plain data, for JSON.
+        """
+        status = self.get_status()
+        latency = status.pop("latency")
+        status["metrics"] = status["metrics"].snapshot()
+        status["latency"] = summarize(latency.latency)
+        status["rooms"] = {
+            room: {
+                "received": stats.received,
+                "lost": stats.total_lost(),
+                "duplicates": stats.duplicates,
+                "latency": summarize(stats.latency),
+            }
+            for room, stats in latency.rooms.items()
+        }
+        return status
+
+    def start_metrics(self, args):
+        """
+        Serves metrics over HTTP and/or writes JSON snapshots, as asked for.
+        """
+        loop = asyncio.get_event_loop()
+        if args.metrics_port:
+            self.metrics_server = MetricsServer(self.render_metrics,
+                                                self.metrics_snapshot)
+            loop.run_until_complete(self.metrics_server.start(
+                args.metrics_host, args.metrics_port))
+        if args.metrics_file:
+            loop.create_task(write_snapshots(
+                args.metrics_file, self.metrics_snapshot,
+                args.metrics_interval))
+
+    def collect_worker_status(self):
+        while True:
+            try:
+                worker_id, status = self.status_queue.get_nowait()
+            except queue.Empty:
+                break
+            self.worker_status[worker_id] = status
+
+    def is_running(self):
+        if self.workers:
+            return any(worker.is_alive() for worker in self.workers)
+        return not self.profile_finished or len(self.bots_running) > 0
 
     async def monitor_status(self, display_stats):
         blinkers = [" ", ".", ":", "."]
         blinker_index = 0
-        template = "{2} bots running, {3} logged in {4}"
+        template = "{0} workers, {1}/{2} bots running on {3} connections, " \
+                   "{4} logged in, {5} connecting, {6} waiting, " \
+                   "{7} reconnects, {8} resumed, {9} messages sent at " \
+                   "{10:.1f}/s, latency {11}, {12:.2%} lost {13}"
+        ticks = 0
         while True:
             await asyncio.sleep(1)
+            if self.workers:
+                self.collect_worker_status()
+            elif self.status_queue is not None:
+                self.status_queue.put((self.worker_id, self.get_status()))
+
             if display_stats:
+                status = self.get_status()
                 print(template.format(
-                    len(self.bots_running),
-                    len(self.bots_logged_in),
+                    max(len(self.workers), 1),
+                    status["running"],
+                    status["target_bots"],
+                    status["connections"],
+                    status["logged_in"],
+                    status.get("connecting", 0),
+                    status.get("waiting", 0),
+                    status["reconnects"],
+                    status["resumes"],
+                    status["messages_sent"],
+                    status["message_rate"],
+                    format_latency(status["latency"].latency),
+                    status["latency"].loss(),
                     blinkers[blinker_index]),
                     end="\r"
                 )
+                ticks += 1
+                if ticks % ROOM_REPORT_INTERVAL == 0:
+                    print_room_report(status["latency"])
             blinker_index += 1
             blinker_index %= len(blinkers)
 
-            if len(self.bots_running) == 0:
-                asyncio.get_event_loop().stop()
+            if not self.is_running():
+                # Unless already shutting down, when the loop is only running
+                # until everything has stopped
+                if not self.stopping:
+                    asyncio.get_event_loop().stop()
                 return
 
-    def notify_login(self, username):
-        self.bots_logged_in[username] = True
-
-    def notify_closed(self, username):
+    def set_tracing(self, username, enabled, tags=None, sample=1):
+        """
+        Switches stanza tracing on or off for a single bot, while it runs.
+        That traces its whole connection, for bots sharing one.
+        """
         try:
-            del self.bots_logged_in[username]
-            logger.info("Reconnecting %s", username)
-            self.connect_bot(self.bots_running[username], self.args)
+            tracer = self.bots_running[username].connection.tracer
         except KeyError:
-            pass
+            return False
+        if enabled:
+            tracer.enable(tags, sample)
+        else:
+            tracer.disable()
+        return True
+
+    def toggle_tracing(self):
+        """
+        Flips tracing for the bots given with --trace, e.g. on SIGUSR1.
+        """
+        for botname in self.args.trace or []:
+            username = "{0}@{1}".format(
+                botname, self.args.component or self.args.host_name)
+            bot = self.bots_running.get(username)
+            if bot is not None:
+                self.set_tracing(username, not bot.connection.tracer.enabled,
+                                 self.args.trace_tags, self.args.trace_sample)
+
+    def connection_ready(self, connection):
+        self.scheduler.handshake_done(connection.name, True)
+        for bot in connection.bots.values():
+            # A new session, in no rooms yet
+            bot.room = None
+            self.bot_logged_in(bot)
+
+    def connection_resumed(self, connection):
+        """
+        The connection's stream was resumed, so its bots are still in their
+        rooms and carry on from where they were.
+        """
+        self.scheduler.handshake_done(connection.name, True)
+        self.resumes += 1
+        for bot in connection.bots.values():
+            if bot.room is None:
+                # Added while the connection was down
+                self.bot_logged_in(bot)
+                continue
+            self.bots_logged_in[bot.username] = True
+            if not bot.listener:
+                self.talkers.add(bot.username)
+
+    def bot_logged_in(self, bot):
+        self.bots_logged_in[bot.username] = True
+        # What to say and when is up to the pacer
+        self.join_random_room(bot)
+        if not bot.listener:
+            self.talkers.add(bot.username)
+
+    def notify_closed(self, connection):
+        name = connection.name
+        if self.connections.get(name) is not connection:
+            # Stopped, or already replaced by a new connection
+            return
+        resumable = connection.can_resume()
+        for bot in connection.bots.values():
+            self.talkers.discard(bot.username)
+            if not resumable and bot.room is not None:
+                self.session_ended(bot)
+                bot.room = None
+            if self.bots_logged_in.pop(bot.username, None):
+                logger.info("Reconnecting %s", bot.username)
+                self.reconnects += 1
+        # Whether it got as far as logging in or not, try again after a while
+        self.scheduler.handshake_done(name, False)
+        self.scheduler.retry(name)
 
 
-async def request_stop():
-    loop = asyncio.get_event_loop()
-    loop.stop()
+def format_latency(histogram):
+    """
+    p50/p99/p99.9 of a histogram of microseconds, in milliseconds.
+    """
+    if not histogram.total:
+        return "-"
+    return "/".join("{0:.1f}".format(value / 1000.0)
+                    for value in histogram.percentiles(50, 99, 99.9)) + "ms"
+
+
+def print_room_report(latency):
+    print()
+    for room in sorted(latency.rooms):
+        stats = latency.rooms[room]
+        print("  {0}: {1} received, {2:.2%} lost, {3} duplicates, "
+              "p50/p99/p99.9 {4}".format(
+                  room, stats.received, stats.loss(), stats.duplicates,
+                  format_latency(stats.latency)))
+
+
+def make_profile(args):
+    """
+    Reads the load profile given with --profile, or makes a steady one from
+    the other options, where every talker says something every ten seconds
+    on average.
+    """
+    if args.profile_file:
+        return LoadProfile.load(args.profile_file)
+    talker_ratio = 0.0 if args.listener else args.talker_ratio
+    message_rate = args.message_rate
+    if message_rate is None:
+        message_rate = args.num_bots * talker_ratio / 10.0
+    rooms = RoomChooser(args.num_rooms, args.room_distribution,
+                        args.zipf_exponent)
+    return LoadProfile.steady(args.num_bots, message_rate, rooms,
+                              talker_ratio)
 
 
 def run(args):
+    if args.workers > 1:
+        return run_fleet(args)
+
     logger.info("Jumperbot starting with %d instances", args.num_bots)
 
     manager = BotManager()
 
+    loop = botruntime.create_event_loop()
     manager.create_bots(args)
-    loop = asyncio.get_event_loop()
+    loop.add_signal_handler(signal.SIGUSR1, manager.toggle_tracing)
 
     loop.create_task(manager.monitor_status(args.monitor))
+    manager.start_metrics(args)
 
-    try:
-        loop.run_forever()
-    except KeyboardInterrupt:
-        for task in asyncio.Task.all_tasks():
-            task.cancel()
-        asyncio.ensure_future(exit())
+    botruntime.run_forever(loop, manager.shutdown, args.shutdown_timeout)
+
+
+def run_worker(args, worker_id, first, count, status_queue):
+    logger.info("Jumperbot worker %d starting with %d instances",
+                worker_id, count)
 
-    loop.close()
+    manager = BotManager(status_queue, worker_id)
+
+    loop = botruntime.create_event_loop()
+    manager.create_bots(args, first, count)
+    loop.add_signal_handler(signal.SIGUSR1, manager.toggle_tracing)
+
+    loop.create_task(manager.monitor_status(False))
+
+    botruntime.run_forever(loop, manager.shutdown, args.shutdown_timeout)
+
+
+def run_fleet(args):
+    logger.info("Jumperbot starting with %d instances in %d workers",
+                args.num_bots, args.workers)
+
+    manager = BotManager()
+
+    # Workers must be forked before the parent creates its event loop
+    manager.start_workers(args)
+    loop = botruntime.create_event_loop()
+    loop.add_signal_handler(signal.SIGUSR1, manager.signal_workers,
+                            signal.SIGUSR1)
+
+    loop.create_task(manager.monitor_status(args.monitor))
+    manager.start_metrics(args)
+
+    botruntime.run_forever(loop, manager.shutdown, args.shutdown_timeout)
+    manager.stop_workers(args.shutdown_timeout)
 
 
 def main():
@@ -246,7 +1047,14 @@ def main():
         "-n", "--num-bots",
         type=int,
         default=10,
-        help="The number of bots to run per process"
+        help="The total number of bots to run"
+    )
+
+    parser.add_argument(
+        "-w", "--workers",
+        type=int,
+        default=1,
+        help="The number of worker processes to split the bots between"
     )
 
     parser.add_argument(
@@ -260,6 +1068,13 @@ def main():
         help="Server name where the host is running (if different from host name)"
     )
 
+    parser.add_argument(
+        "-p", "--port",
+        type=int,
+        default=5222,
+        help="Port the server is listening on"
+    )
+
     parser.add_argument(
         "-r", "--num_rooms",
         type=int,
@@ -267,10 +1082,282 @@ def main():
         help="Number of rooms to jump between. Assumes they have been created."
     )
 
+    parser.add_argument(
+        "--component",
+        metavar="DOMAIN",
+        help="Connect as the external component (XEP-0114) for this domain, "
+             "with many bots sharing each connection, rather than one "
+             "connection per bot"
+    )
+
+    parser.add_argument(
+        "--component-secret",
+        default="secret",
+        help="The secret to log in as the component with"
+    )
+
+    parser.add_argument(
+        "--bots-per-connection",
+        type=int,
+        default=500,
+        help="How many bots share each connection with --component"
+    )
+
+    parser.add_argument(
+        "--mechanisms",
+        nargs="+",
+        choices=XmppHandler.MECHANISMS,
+        default=list(XmppHandler.MECHANISMS),
+        help="The SASL mechanisms to log in with, in order of preference, "
+             "among those the server offers"
+    )
+
+    parser.add_argument(
+        "--scram-threads",
+        type=int,
+        help="Threads deriving SCRAM keys from passwords, which bots reuse "
+             "when they reconnect (by default, the event loop's thread pool)"
+    )
+
+    parser.add_argument(
+        "--tls",
+        action="store_true",
+        help="Upgrade connections with STARTTLS before logging in. Not used "
+             "with --component."
+    )
+
+    parser.add_argument(
+        "--tls-ca",
+        metavar="FILE",
+        help="Check the server's certificate against the CAs in this PEM file "
+             "(by default, the system's)"
+    )
+
+    parser.add_argument(
+        "--tls-no-verify",
+        action="store_true",
+        help="Don't check the server's certificate, e.g. a self-signed one"
+    )
+
+    parser.add_argument(
+        "--pipeline-login",
+        action="store_true",
+        help="Send each step of logging in without waiting for answers that "
+             "aren't needed for the next, once the server's features are "
+             "known from an earlier login, so logging in takes two round "
+             "trips rather than five"
+    )
+
+    parser.add_argument(
+        "--stream-management",
+        action="store_true",
+        help="Enable stream management (XEP-0198), so bots that lose their "
+             "connection resume their streams when they reconnect, without "
+             "rejoining rooms or losing messages. Not used with --component."
+    )
+
+    parser.add_argument(
+        "--connect-rate",
+        type=float,
+        default=200.0,
+        help="The most new connections per second, across all workers "
+             "(0 for no limit). Ramping up N bots takes about N / rate "
+             "seconds."
+    )
+
+    parser.add_argument(
+        "--connect-burst",
+        type=int,
+        default=10,
+        help="How many connections may be started at once, within the rate"
+    )
+
+    parser.add_argument(
+        "--max-handshakes",
+        type=int,
+        default=1000,
+        help="The most bots connecting and logging in at the same time, "
+             "across all workers"
+    )
+
+    parser.add_argument(
+        "--handshake-timeout",
+        type=float,
+        default=30.0,
+        help="Seconds for a bot to connect and log in before trying again "
+             "(0 to wait forever)"
+    )
+
+    parser.add_argument(
+        "--backoff-base",
+        type=float,
+        default=1.0,
+        help="Bots reconnect after a random delay of up to this many seconds, "
+             "doubled for every failure in a row"
+    )
+
+    parser.add_argument(
+        "--backoff-max",
+        type=float,
+        default=60.0,
+        help="The longest delay before reconnecting"
+    )
+
+    parser.add_argument(
+        "--loop",
+        choices=botruntime.LOOPS,
+        default="auto",
+        help="The event loop to run the bots on. auto picks uvloop when it "
+             "is installed."
+    )
+
+    parser.add_argument(
+        "--send-rate",
+        type=float,
+        help="The most stanzas each connection sends per second, to stay "
+             "under the server's rate limits. Stream negotiation and acks "
+             "aren't limited, and IQs and presence go before messages. "
+             "By default there is no limit."
+    )
+
+    parser.add_argument(
+        "--send-burst",
+        type=int,
+        default=5,
+        help="How many stanzas a connection may send at once, after sending "
+             "less than --send-rate for a while. Best kept below what the "
+             "server allows, as it measures the rate as stanzas arrive."
+    )
+
+    parser.add_argument(
+        "--send-queue",
+        type=int,
+        default=100,
+        help="How many messages may wait to be sent on a connection before "
+             "more are dropped. Bots stop talking while it is full, or the "
+             "socket's buffer is."
+    )
+
+    parser.add_argument(
+        "--send-buffer",
+        type=int,
+        help="The size of each bot's socket send buffer, in bytes (by "
+             "default, left to the kernel)"
+    )
+
+    parser.add_argument(
+        "--receive-buffer",
+        type=int,
+        help="The size of each bot's socket receive buffer, in bytes (by "
+             "default, left to the kernel)"
+    )
+
+    parser.add_argument(
+        "--shutdown-timeout",
+        type=float,
+        default=5.0,
+        help="Seconds to wait for bots to disconnect, and workers to exit, "
+             "when stopping"
+    )
+
     parser.add_argument(
         "-l", "--listener",
         action="store_true",
-        help="Listen only, don't say anything"
+        help="Listen only, don't say anything. Listeners measure the latency "
+             "and loss of the messages they receive."
+    )
+
+    parser.add_argument(
+        "--profile",
+        dest="profile_file",
+        metavar="FILE",
+        help="A JSON (or YAML) load profile, with ramp-up stages, message "
+             "rates, room popularity and the share of bots that talk. "
+             "Overrides --num-bots, --num_rooms and the options below."
+    )
+
+    parser.add_argument(
+        "--message-rate",
+        type=float,
+        help="Messages per second sent by all the bots together (by default, "
+             "one every ten seconds per talking bot)"
+    )
+
+    parser.add_argument(
+        "--talker-ratio",
+        type=float,
+        default=1.0,
+        help="The share of bots that talk, the rest only listen and measure "
+             "latency and loss"
+    )
+
+    parser.add_argument(
+        "--room-distribution",
+        choices=DISTRIBUTIONS,
+        default="uniform",
+        help="How bots pick rooms: all equally, or a few popular ones (Zipf)"
+    )
+
+    parser.add_argument(
+        "--zipf-exponent",
+        type=float,
+        default=1.0,
+        help="How strongly bots favour popular rooms with --room-distribution "
+             "zipf"
+    )
+
+    parser.add_argument(
+        "--reader",
+        choices=XmppHandler.READERS,
+        default=XmppHandler.default_reader,
+        help="The engine used for reading incoming XMPP data"
+    )
+
+    parser.add_argument(
+        "--trace",
+        action="append",
+        metavar="BOTNAME",
+        help="Log all stanzas to and from this bot, e.g. jumperbot_42, or "
+             "with --component, its whole connection. May be repeated. Send "
+             "SIGUSR1 to toggle at runtime."
+    )
+
+    parser.add_argument(
+        "--trace-tags",
+        nargs="+",
+        help="Only trace stanzas with these tags, e.g. message presence"
+    )
+
+    parser.add_argument(
+        "--trace-sample",
+        type=int,
+        default=1,
+        help="Only trace every n-th stanza"
+    )
+
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        help="Serve metrics for all the bots on this port, at /metrics in "
+             "the Prometheus format and at /metrics.json"
+    )
+
+    parser.add_argument(
+        "--metrics-host",
+        default="127.0.0.1",
+        help="The address to serve metrics on"
+    )
+
+    parser.add_argument(
+        "--metrics-file",
+        help="Append a JSON snapshot of the metrics to this file, one per line"
+    )
+
+    parser.add_argument(
+        "--metrics-interval",
+        type=float,
+        default=10.0,
+        help="Seconds between JSON snapshots"
     )
 
     parser.add_argument(
@@ -291,8 +1378,22 @@ def main():
     if args.verbose:
         level = logging.DEBUG
 
+    XmppHandler.default_reader = args.reader
+
+    args.profile = make_profile(args)
+    args.num_bots = args.profile.max_bots
+
     logging.basicConfig(format='%(process)d %(asctime)s %(levelname)s %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p', level=level)
 
+    # Before any worker is forked, so they all inherit the policy
+    logger.info("Using the %s event loop",
+                botruntime.install_event_loop(args.loop))
+    if args.component:
+        botruntime.raise_file_limit(
+            -(-args.num_bots // args.bots_per_connection))
+    else:
+        botruntime.raise_file_limit(args.num_bots)
+
     run(args)
 
 if __name__ == "__main__":
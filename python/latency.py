@@ -0,0 +1,218 @@
+"""
+End-to-end delivery latency and loss for groupchat messages.
+
+Senders append a marker to the body of every message they send to a room:
+a session ID for the sending bot, a sequence number for that room and the
+time it was sent. Receivers read the marker back to work out how long the
+message took and, from gaps in the sequence numbers, how many went missing.
+Messages missing after the last one a receiver got from a sender only show
+up as such once the sender has left the room, and said which one was its
+last. Times come from the wall clock, so senders and receivers on different
+machines need synchronised clocks.
+"""
+import random
+import re
+import time
+
+from histogram import Histogram
+
+MARKER_PATTERN = re.compile(r" #([0-9a-f]+)\.([0-9a-f]+)\.([0-9a-f]+)$")
+
+DELAY_NAMESPACE = "urn:xmpp:delay"
+
+# How long after a sender leaves a room the messages it sent there that
+# haven't arrived are counted as lost, in microseconds
+TAIL_GRACE = 5 * 1000000
+
+
+def now_us():
+    return time.time_ns() // 1000
+
+
+def new_session():
+    """
+    A random ID for one sender, so the sequence numbers of a bot that is
+    recreated aren't mistaken for repeats of the old one's.
+    """
+    return "{0:x}".format(random.getrandbits(32))
+
+
+def add_marker(text, session, sequence, sent_at=None):
+    # type: (str, str, int, int) -> str
+    if sent_at is None:
+        sent_at = now_us()
+    return "{0} #{1}.{2:x}.{3:x}".format(text, session, sequence, sent_at)
+
+
+def read_marker(body):
+    """
+    Returns the session, sequence number and time sent from a message body,
+    or None if it has no marker.
+    """
+    if not body:
+        return None
+    match = MARKER_PATTERN.search(body)
+    if match is None:
+        return None
+    session, sequence, sent_at = match.groups()
+    return session, int(sequence, 16), int(sent_at, 16)
+
+
+class RoomStats(object):
+    """
+    Delivery of messages sent to one room, as seen by the receivers in it.
+    """
+    __slots__ = ("received", "lost", "duplicates", "latency", "last_seen",
+                 "heard", "ended")
+
+    def __init__(self):
+        self.received = 0
+        self.lost = 0
+        self.duplicates = 0
+        self.latency = Histogram()
+
+        # Highest sequence number received so far, by receiver and sender.
+        # Only kept where the messages are received.
+        self.last_seen = {}
+
+        # For each sender (and session), how many receivers heard from it
+        # and the sum of the highest sequence numbers they got, and the last
+        # sequence number it sent once it has left the room, and when
+        self.heard = {}
+        self.ended = {}
+
+    def tail_lost(self, now=None):
+        """
+        The messages senders sent before leaving the room, at least
+        `TAIL_GRACE` ago, after the last one each receiver got from them.
+        Only receivers that got any of a sender's messages are counted.
+        """
+        if now is None:
+            now = now_us()
+        lost = 0
+        heard = self.heard
+        for key, (last, ended_at) in self.ended.items():
+            if now - ended_at >= TAIL_GRACE and key in heard:
+                receivers, total = heard[key]
+                lost += receivers * last - total
+        return lost
+
+    def total_lost(self, now=None):
+        return self.lost + self.tail_lost(now)
+
+    def loss(self, now=None):
+        lost = self.total_lost(now)
+        expected = self.received + lost
+        if not expected:
+            return 0.0
+        return lost / expected
+
+    def merge(self, other):
+        self.received += other.received
+        self.lost += other.lost
+        self.duplicates += other.duplicates
+        self.latency.merge(other.latency)
+        heard = self.heard
+        for key, (receivers, total) in other.heard.items():
+            mine = heard.get(key)
+            if mine is None:
+                heard[key] = [receivers, total]
+            else:
+                mine[0] += receivers
+                mine[1] += total
+        self.ended.update(other.ended)
+
+    def __getstate__(self):
+        # Sent to the parent process of a fleet without the sequence numbers
+        # of each receiver, which are of no use there
+        return (self.received, self.lost, self.duplicates, self.latency,
+                self.heard, self.ended)
+
+    def __setstate__(self, state):
+        self.received, self.lost, self.duplicates, self.latency, \
+            self.heard, self.ended = state
+        self.last_seen = {}
+
+
+class LatencyRecorder(object):
+    """
+    Collects latency and loss for the messages received by a set of bots,
+    per room and overall. Latencies are in microseconds.
+    """
+
+    def __init__(self):
+        self.rooms = {}
+        self.latency = Histogram()
+
+    def record(self, receiver, room, sender, body, received_at=None):
+        """
+        Records a message `receiver` got in `room`. Returns False if it had
+        no marker.
+        """
+        marker = read_marker(body)
+        if marker is None:
+            return False
+        session, sequence, sent_at = marker
+        if received_at is None:
+            received_at = now_us()
+
+        stats = self.rooms.get(room)
+        if stats is None:
+            stats = self.rooms[room] = RoomStats()
+
+        key = (receiver, sender, session)
+        last = stats.last_seen.get(key)
+        heard = stats.heard.get((sender, session))
+        if heard is None:
+            heard = stats.heard[(sender, session)] = [0, 0]
+        if last is not None:
+            if sequence <= last:
+                stats.duplicates += 1
+                return True
+            # Anything skipped over never arrived. Messages sent before the
+            # receiver first heard from this sender aren't counted.
+            stats.lost += sequence - last - 1
+            heard[1] += sequence - last
+        else:
+            heard[0] += 1
+            heard[1] += sequence
+        stats.last_seen[key] = sequence
+
+        latency = received_at - sent_at
+        stats.received += 1
+        stats.latency.record(latency)
+        self.latency.record(latency)
+        return True
+
+    def ended(self, room, sender, session, last_sequence, ended_at=None):
+        """
+        Records that `sender` has left `room`, the last message it sent
+        there being `last_sequence`, so those after the last one each
+        receiver got can be counted as lost.
+        """
+        if ended_at is None:
+            ended_at = now_us()
+        stats = self.rooms.get(room)
+        if stats is None:
+            stats = self.rooms[room] = RoomStats()
+        stats.ended[(sender, session)] = (last_sequence, ended_at)
+
+    def merge(self, other):
+        for room, other_stats in other.rooms.items():
+            stats = self.rooms.get(room)
+            if stats is None:
+                stats = self.rooms[room] = RoomStats()
+            stats.merge(other_stats)
+        self.latency.merge(other.latency)
+
+    def received(self):
+        return sum(stats.received for stats in self.rooms.values())
+
+    def loss(self, now=None):
+        if now is None:
+            now = now_us()
+        received = self.received()
+        lost = sum(stats.total_lost(now) for stats in self.rooms.values())
+        if not received + lost:
+            return 0.0
+        return lost / (received + lost)
@@ -0,0 +1,198 @@
+"""
+Load profiles for JumperBot: how many bots to run over time, how many
+messages per second they send between them, which rooms they pick and how
+many of them talk rather than just listen.
+
+A profile is read from a JSON file, or a YAML file if PyYAML is installed:
+
+    {
+        "stages": [
+            {"duration": 60, "bots": 1000, "message_rate": 0},
+            {"duration": 30, "bots": 1000, "message_rate": 200},
+            {"duration": 600, "bots": 1000, "message_rate": 200}
+        ],
+        "rooms": {"count": 50, "distribution": "zipf", "exponent": 1.2},
+        "talker_ratio": 0.25,
+        "hop_after": [5, 10]
+    }
+
+Each stage moves the number of bots and the message rate from where the
+previous stage left them (no bots, no messages, to start with) to its own
+values over `duration` seconds, in a straight line, or all at once when
+`curve` is "step". After the last stage its values are held.
+"""
+import asyncio
+import bisect
+import itertools
+import json
+import logging
+import random
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+logger = logging.getLogger(__name__)
+
+DISTRIBUTIONS = ("uniform", "zipf")
+CURVES = ("linear", "step")
+
+
+class Stage(object):
+    def __init__(self, duration, bots, message_rate, curve="linear"):
+        if curve not in CURVES:
+            raise ValueError("Unknown curve: {0}".format(curve))
+        self.duration = float(duration)
+        self.bots = int(bots)
+        self.message_rate = float(message_rate)
+        self.curve = curve
+
+
+class RoomChooser(object):
+    """
+    Picks rooms by index, either uniformly or following Zipf's law, where
+    the k-th most popular room is picked in proportion to 1 / k^exponent.
+    """
+
+    def __init__(self, count, distribution="uniform", exponent=1.0):
+        if distribution not in DISTRIBUTIONS:
+            raise ValueError(
+                "Unknown room distribution: {0}".format(distribution))
+        self.count = count
+        self.distribution = distribution
+        self.exponent = exponent
+        self.cumulative_weights = None
+        if distribution == "zipf":
+            self.cumulative_weights = list(itertools.accumulate(
+                1.0 / (k ** exponent) for k in range(1, count + 1)))
+
+    def choose(self, rng=random):
+        weights = self.cumulative_weights
+        if weights is None:
+            return rng.randrange(self.count)
+        return bisect.bisect(weights, rng.random() * weights[-1])
+
+
+class LoadProfile(object):
+    def __init__(self, stages, rooms=None, talker_ratio=1.0,
+                 hop_after=(5, 10)):
+        if not stages:
+            raise ValueError("A load profile needs at least one stage")
+        self.stages = stages
+        self.rooms = rooms or RoomChooser(10)
+        self.talker_ratio = talker_ratio
+        self.hop_after = tuple(hop_after)
+
+    @classmethod
+    def from_dict(cls, spec):
+        stages = [Stage(**stage) for stage in spec["stages"]]
+        rooms = spec.get("rooms", {})
+        return cls(
+            stages,
+            RoomChooser(rooms.get("count", 10),
+                        rooms.get("distribution", "uniform"),
+                        rooms.get("exponent", 1.0)),
+            spec.get("talker_ratio", 1.0),
+            spec.get("hop_after", (5, 10))
+        )
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            if path.endswith((".yaml", ".yml")):
+                if yaml is None:
+                    raise RuntimeError(
+                        "PyYAML is needed to read {0}".format(path))
+                spec = yaml.safe_load(f)
+            else:
+                spec = json.load(f)
+        return cls.from_dict(spec)
+
+    @classmethod
+    def steady(cls, bots, message_rate, rooms, talker_ratio=1.0):
+        """
+        A profile that starts all the bots at once and keeps them at the same
+        message rate.
+        """
+        return cls([Stage(0, bots, message_rate, "step")], rooms,
+                   talker_ratio)
+
+    @property
+    def max_bots(self):
+        return max(stage.bots for stage in self.stages)
+
+    @property
+    def duration(self):
+        return sum(stage.duration for stage in self.stages)
+
+    def at(self, elapsed):
+        """
+        Returns the number of bots and the message rate `elapsed` seconds
+        into the profile.
+        """
+        bots, rate = 0, 0.0
+        for stage in self.stages:
+            if elapsed < stage.duration:
+                if stage.curve == "step":
+                    return stage.bots, stage.message_rate
+                progress = elapsed / stage.duration
+                return (
+                    int(round(bots + (stage.bots - bots) * progress)),
+                    rate + (stage.message_rate - rate) * progress
+                )
+            elapsed -= stage.duration
+            bots, rate = stage.bots, stage.message_rate
+        return bots, rate
+
+    def scaled(self, share):
+        """
+        This profile's share of the load, for one of several processes.
+        """
+        return LoadProfile(
+            [Stage(stage.duration, round(stage.bots * share),
+                   stage.message_rate * share, stage.curve)
+             for stage in self.stages],
+            self.rooms, self.talker_ratio, self.hop_after)
+
+    def is_talker(self, index):
+        """
+        Whether the bot with the given index talks. Talkers are spread evenly
+        over the indexes, so any range of bots has the right mix.
+        """
+        ratio = self.talker_ratio
+        return int((index + 1) * ratio) > int(index * ratio)
+
+
+class MessagePacer(object):
+    """
+    Issues sends at a target aggregate rate, from a single task.
+
+    Every `tick` seconds it works out how many messages are due at the
+    current rate, carrying fractions over to the next tick, and calls `send`
+    that many times. `send` returns False when there was nobody to send a
+    message; those are dropped rather than saved up.
+    """
+
+    def __init__(self, send, rate=0.0, tick=0.05):
+        self.send = send
+        self.rate = rate
+        self.tick = tick
+        self.due = 0.0
+        self.sent = 0
+        self.skipped = 0
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        last = loop.time()
+        while True:
+            await asyncio.sleep(self.tick)
+            now = loop.time()
+            self.due += (now - last) * self.rate
+            last = now
+            while self.due >= 1.0:
+                self.due -= 1.0
+                if self.send():
+                    self.sent += 1
+                else:
+                    self.skipped += 1
@@ -0,0 +1,77 @@
+import asyncio
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class MetricsServer(object):
+    """
+    A minimal HTTP server for metrics, running on the event loop.
+
+    GET /metrics returns `render_text()` in the Prometheus text format, and
+    GET /metrics.json returns `render_json()` as JSON. It answers one request
+    per connection, which is all a scraper needs.
+    """
+
+    def __init__(self, render_text, render_json):
+        self.render_text = render_text
+        self.render_json = render_json
+        self.server = None
+        self.requests = 0
+
+    async def start(self, host, port):
+        self.server = await asyncio.start_server(self.handle, host, port)
+        logger.info("Serving metrics on http://%s:%d/metrics", host, port)
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+
+    async def handle(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            while True:
+                header = await reader.readline()
+                if header in (b"\r\n", b"\n", b""):
+                    break
+            parts = request_line.decode("latin-1").split()
+            if len(parts) < 2 or parts[0] != "GET":
+                self.respond(writer, 405, "text/plain", b"Method not allowed\n")
+            else:
+                self.requests += 1
+                path = parts[1].split("?")[0]
+                if path == "/metrics":
+                    self.respond(writer, 200,
+                                 "text/plain; version=0.0.4; charset=utf-8",
+                                 self.render_text().encode())
+                elif path == "/metrics.json":
+                    self.respond(writer, 200, "application/json",
+                                 json.dumps(self.render_json()).encode())
+                else:
+                    self.respond(writer, 404, "text/plain", b"Not found\n")
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    def respond(self, writer, status, content_type, body):
+        reasons = {200: "OK", 404: "Not Found", 405: "Method Not Allowed"}
+        writer.write(
+            "HTTP/1.0 {0} {1}\r\n"
+            "Content-Type: {2}\r\n"
+            "Content-Length: {3}\r\n"
+            "Connection: close\r\n\r\n".format(
+                status, reasons[status], content_type, len(body)).encode())
+        writer.write(body)
+
+
+async def write_snapshots(path, render_json, interval):
+    """
+    Appends a JSON snapshot to `path` every `interval` seconds, one per line.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        with open(path, "a") as f:
+            f.write(json.dumps(render_json()) + "\n")
@@ -0,0 +1,177 @@
+"""
+Flow control for what a connection sends.
+
+Servers limit how fast each connection may send ("karma", or rate limits)
+and disconnect clients that keep going over with a stream error, and
+whatever the kernel can't take straight away piles up in the transport's
+buffer. So a handler with an `OutboundQueue` sends stanzas no faster than a
+`TokenBucket` allows, most urgent first: stream management acks go out right
+away, then IQs, then presence, and chat last. Anything else that isn't a
+stanza, like negotiating or ending the stream, or enabling stream
+management, only makes sense after what was sent before it, so it takes
+everything still queued out with it, straight away. While the transport's
+buffer is full, nothing goes out until it has drained.
+
+Chat is what gives: at most `max_queued` messages wait, and any beyond that
+are dropped. Everything else waits for as long as it takes.
+
+Stanzas sent again on resuming a stream (XEP-0198) are replayed as they
+were first sent: in their order, ahead of anything queued since, and never
+dropped, however many there are.
+"""
+from collections import deque
+
+from connectionscheduler import TokenBucket
+
+# Priority classes, most urgent first. Only `replay` puts stanzas in REPLAY.
+CONTROL = 0
+REPLAY = 1
+IQ = 2
+PRESENCE = 3
+MESSAGE = 4
+PRIORITY_NAMES = ("control", "replay", "iq", "presence", "message")
+
+# Stream management requests and acks, which may go ahead of anything
+ACK_PREFIXES = (b"<r ", b"<r/", b"<a ", b"<a/")
+
+
+def priority(package):
+    """
+    The priority class of a package, or None if it must keep its place
+    after everything sent before it.
+    """
+    if package.startswith(b"<message"):
+        return MESSAGE
+    if package.startswith(b"<presence"):
+        return PRESENCE
+    if package.startswith(b"<iq"):
+        return IQ
+    if package.startswith(ACK_PREFIXES):
+        return CONTROL
+    return None
+
+
+class OutboundQueue(object):
+    """
+    What is waiting to be sent on one connection, by priority class. `rate`
+    is stanzas per second, or None for no limit, with bursts of up to
+    `burst` after a quiet spell. Anything that isn't a stanza is never held
+    back by the rate, and nor is what it takes out with it, though that
+    still uses up the allowance.
+
+    `take` returns what may go out now, after which `wait` is how long until
+    the rate allows more.
+    """
+    __slots__ = ("queues", "queued", "bucket", "max_queued", "wait",
+                 "dropped")
+
+    def __init__(self, rate=None, burst=10, max_queued=100):
+        # Created when first needed, as most connections have nothing
+        # waiting most of the time
+        self.queues = [None] * len(PRIORITY_NAMES)
+        self.queued = 0
+        self.bucket = TokenBucket(rate, burst)
+        self.max_queued = max_queued
+        self.wait = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return self.queued
+
+    def is_full(self):
+        queue = self.queues[MESSAGE]
+        return queue is not None and len(queue) >= self.max_queued
+
+    def put(self, package):
+        """
+        Queues a package to send. Returns False, and drops it, if it is a
+        message and `max_queued` of them are already waiting.
+        """
+        kind = priority(package)
+        if kind is None:
+            self.put_in_order(package)
+            return True
+        queue = self.queues[kind]
+        if queue is None:
+            queue = self.queues[kind] = deque()
+        elif kind == MESSAGE and len(queue) >= self.max_queued:
+            self.dropped += 1
+            return False
+        queue.append(package)
+        self.queued += 1
+        return True
+
+    def put_in_order(self, package):
+        queues = self.queues
+        control = queues[CONTROL]
+        if control is None:
+            control = queues[CONTROL] = deque()
+        moved = 0
+        for kind in (REPLAY, IQ, PRESENCE, MESSAGE):
+            if queues[kind] is not None:
+                moved += len(queues[kind])
+                control.extend(queues[kind])
+                queues[kind] = None
+        if moved and self.bucket.rate is not None:
+            # Going into debt, as the server counts them all the same
+            self.bucket.tokens -= moved
+        control.append(package)
+        self.queued += 1
+
+    def replay(self, packages):
+        """
+        Queues stanzas to send again, in the order given, after any others
+        being replayed and ahead of everything else but control packages.
+        None are dropped.
+        """
+        if not packages:
+            return
+        queue = self.queues[REPLAY]
+        if queue is None:
+            queue = self.queues[REPLAY] = deque()
+        queue.extend(packages)
+        self.queued += len(packages)
+
+    def take(self, now):
+        """
+        Removes and returns, in order, the packages that may be sent at
+        `now` (by the event loop's clock).
+        """
+        packages = []
+        queues = self.queues
+        bucket = self.bucket
+        self.wait = 0
+        for kind, queue in enumerate(queues):
+            if queue is None:
+                continue
+            while queue:
+                if kind != CONTROL:
+                    wait = bucket.take(now)
+                    if wait:
+                        self.wait = wait
+                        break
+                packages.append(queue.popleft())
+            if queue:
+                break
+            queues[kind] = None
+        self.queued -= len(packages)
+        return packages
+
+    def take_all(self):
+        """
+        Removes and returns everything waiting, whatever the rate, e.g. when
+        the connection is lost.
+        """
+        packages = []
+        for queue in self.queues:
+            if queue is not None:
+                packages.extend(queue)
+        self.queues = [None] * len(PRIORITY_NAMES)
+        self.queued = 0
+        return packages
+
+    def clear(self):
+        """
+        Forgets everything waiting, and returns how many packages that was.
+        """
+        return len(self.take_all())
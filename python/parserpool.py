@@ -0,0 +1,128 @@
+"""
+Expat parsers shared between the connections of a process.
+
+An XMPP stream is one long XML document, so every connection needs a parser
+that stays inside the stream element for as long as it is open. Each one
+takes several KB, mostly expat's own buffers, which adds up to most of the
+memory of a mostly idle connection. Between stanzas, though, all a parser
+knows is that it is inside a stream element, and any other parser in the
+same state will do just as well.
+
+So readers only hold on to a parser while a stanza is coming in, or before
+the stream has started. Whenever a read ends between stanzas the parser goes
+back to a `ParserPool`, and the next read, for whichever connection, takes
+one from there. Parsers made for the pool are primed with a stream header
+to put them in that state.
+"""
+from xml.parsers import expat
+
+# Lets expat hand out the same string objects for tag and attribute names
+# across all parsers
+TAG_NAMES = {}
+
+STREAM_TAG = "stream:stream"
+PRIMER = b"<stream:stream>"
+
+
+def create_parser():
+    parser = expat.ParserCreate(intern=TAG_NAMES)
+    parser.buffer_text = True
+    return parser
+
+
+class ParserPool(object):
+    """
+    Parsers inside a stream element, between stanzas. Only as many as are
+    in use at the same time are ever needed, so in a single-threaded process
+    the pool rarely holds more than one.
+    """
+
+    def __init__(self, max_size=16):
+        self.parsers = []
+        self.max_size = max_size
+        self.created = 0
+        self.reused = 0
+
+    def __len__(self):
+        return len(self.parsers)
+
+    def acquire(self):
+        if self.parsers:
+            self.reused += 1
+            return self.parsers.pop()
+        self.created += 1
+        parser = create_parser()
+        parser.Parse(PRIMER, False)
+        return parser
+
+    def release(self, parser):
+        # Don't keep the last reader alive through its handlers
+        parser.StartElementHandler = None
+        parser.EndElementHandler = None
+        parser.CharacterDataHandler = None
+        if len(self.parsers) < self.max_size:
+            self.parsers.append(parser)
+
+
+PARSERS = ParserPool()
+
+
+class PooledParserReader(object):
+    """
+    Base class for stream readers that borrow their parser from a
+    `ParserPool` whenever they are between stanzas.
+
+    Subclasses install their expat handlers in `set_handlers`, and say in
+    `between_stanzas` when they are inside the stream element with no stanza
+    started. They feed data with `parse`, and `position()`, called from a
+    handler, is the byte position of the current event from the start of the
+    stream, whichever parser is reading it.
+    """
+
+    def __init__(self, pool=None):
+        self.pool = pool if pool is not None else PARSERS
+        self.parser = None
+
+        # Bytes of the stream read so far, and the position in the stream of
+        # the first byte the current parser read
+        self.fed = 0
+        self.base = 0
+
+    def set_handlers(self, parser):
+        raise NotImplementedError()
+
+    def between_stanzas(self):
+        raise NotImplementedError()
+
+    def reset(self):
+        if self.parser is not None and self.is_idle():
+            self.pool.release(self.parser)
+        self.parser = None
+        self.fed = 0
+        self.base = 0
+
+    def is_idle(self):
+        # Between stanzas, and expat isn't holding on to part of a tag
+        return self.between_stanzas() and \
+            self.parser.CurrentByteIndex + self.base == self.fed
+
+    def parse(self, data):
+        parser = self.parser
+        if parser is None:
+            if self.fed:
+                parser = self.pool.acquire()
+                self.base = self.fed - parser.CurrentByteIndex
+            else:
+                # A new stream needs a parser of its own, as the pooled ones
+                # are already inside a stream element
+                parser = create_parser()
+            self.parser = parser
+            self.set_handlers(parser)
+        self.fed += len(data)
+        parser.Parse(data, False)
+        if self.is_idle():
+            self.pool.release(parser)
+            self.parser = None
+
+    def position(self):
+        return self.parser.CurrentByteIndex + self.base
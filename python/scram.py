@@ -0,0 +1,280 @@
+"""
+SCRAM authentication (RFC 5802, RFC 7677), for both ends of a connection.
+
+Most of the cost of a SCRAM login is deriving the salted password with
+PBKDF2, thousands of HMAC rounds, and it is the same every time a user logs
+in with the same password, salt and iteration count. So the keys derived
+from it are kept in a `KeyCache`, and bots reconnecting skip straight to the
+cheap part. Derivations that do have to happen run in an executor, where
+hashlib releases the GIL, so the event loop carries on meanwhile, and bots
+needing the same keys at once wait for a single derivation.
+"""
+import asyncio
+import base64
+import hashlib
+import hmac
+import os
+from collections import OrderedDict
+
+# In order of preference, with the hash each one uses
+MECHANISMS = OrderedDict([
+    ("SCRAM-SHA-256", "sha256"),
+    ("SCRAM-SHA-1", "sha1"),
+])
+
+# No channel binding
+GS2_HEADER = "n,,"
+CHANNEL_BINDING = base64.b64encode(GS2_HEADER.encode()).decode()
+
+DEFAULT_ITERATIONS = 4096
+
+
+class ScramError(Exception):
+    pass
+
+
+class ScramKeys(object):
+    """
+    What is derived from a password, salt and iteration count. A client
+    needs the client key to prove it knows the password and the server key
+    to check the server does too. A server only keeps the stored and server
+    keys.
+    """
+    __slots__ = ("hash_name", "client_key", "stored_key", "server_key")
+
+    def __init__(self, hash_name, client_key, stored_key, server_key):
+        self.hash_name = hash_name
+        self.client_key = client_key
+        self.stored_key = stored_key
+        self.server_key = server_key
+
+
+def derive_keys(hash_name, password, salt, iterations):
+    salted_password = hashlib.pbkdf2_hmac(hash_name, password.encode(), salt,
+                                          iterations)
+    client_key = hmac.digest(salted_password, b"Client Key", hash_name)
+    server_key = hmac.digest(salted_password, b"Server Key", hash_name)
+    return ScramKeys(hash_name, client_key,
+                     hashlib.new(hash_name, client_key).digest(), server_key)
+
+
+class KeyCache(object):
+    """
+    Keys by (hash, password, salt, iterations), up to `max_size` of them,
+    dropping the least recently used. `executor` runs the derivations, by
+    default the event loop's own thread pool.
+    """
+
+    def __init__(self, max_size=100000, executor=None):
+        self.keys = OrderedDict()
+        self.pending = {}
+        self.max_size = max_size
+        self.executor = executor
+        self.hits = 0
+        self.derivations = 0
+
+    def __len__(self):
+        return len(self.keys)
+
+    def get(self, hash_name, password, salt, iterations):
+        """
+        The keys if they have already been derived, otherwise None.
+        """
+        key = (hash_name, password, salt, iterations)
+        keys = self.keys.get(key)
+        if keys is not None:
+            self.hits += 1
+            self.keys.move_to_end(key)
+        return keys
+
+    def derive(self, hash_name, password, salt, iterations):
+        """
+        Returns a future for the keys, derived in the executor. Callers
+        asking for the same keys while they are being derived share the
+        future.
+        """
+        key = (hash_name, password, salt, iterations)
+        future = self.pending.get(key)
+        if future is not None:
+            self.hits += 1
+            return future
+        self.derivations += 1
+        loop = asyncio.get_event_loop()
+        future = loop.run_in_executor(self.executor, derive_keys, hash_name,
+                                      password, salt, iterations)
+        self.pending[key] = future
+        future.add_done_callback(lambda f: self.store(key, f))
+        return future
+
+    def store(self, key, future):
+        del self.pending[key]
+        if future.cancelled() or future.exception() is not None:
+            return
+        self.keys[key] = future.result()
+        if len(self.keys) > self.max_size:
+            self.keys.popitem(last=False)
+
+
+# Shared by all the connections of a process
+KEYS = KeyCache()
+
+
+def escape_name(name):
+    return name.replace("=", "=3D").replace(",", "=2C")
+
+
+def unescape_name(name):
+    return name.replace("=2C", ",").replace("=3D", "=")
+
+
+def parse(message):
+    """
+    The attributes of a SCRAM message, e.g. {"r": nonce, "s": salt}.
+    """
+    attributes = {}
+    for part in message.split(","):
+        name, separator, value = part.partition("=")
+        if len(name) != 1 or not separator:
+            raise ScramError("Malformed SCRAM message: {0}".format(message))
+        attributes[name] = value
+    return attributes
+
+
+def create_nonce():
+    return base64.b64encode(os.urandom(18)).decode()
+
+
+def xor(a, b):
+    return bytes(x ^ y for x, y in zip(a, b))
+
+
+class ScramClient(object):
+    """
+    The client side of one SCRAM exchange: `first_message`, then
+    `final_message` with the server's challenge and the keys for it, and
+    `verify` with the server's final message.
+    """
+
+    def __init__(self, mechanism, username, password):
+        self.mechanism = mechanism
+        self.hash_name = MECHANISMS[mechanism]
+        self.username = username
+        self.password = password
+        self.nonce = create_nonce()
+        self.first_bare = "n={0},r={1}".format(escape_name(username),
+                                               self.nonce)
+        self.server_first = None
+        self.salt = None
+        self.iterations = None
+        self.auth_message = None
+        self.keys = None
+
+    def first_message(self):
+        return (GS2_HEADER + self.first_bare).encode()
+
+    def read_challenge(self, server_first):
+        """
+        Reads the server's first message, after which `salt` and
+        `iterations` say which keys are needed.
+        """
+        self.server_first = server_first.decode()
+        attributes = parse(self.server_first)
+        try:
+            nonce = attributes["r"]
+            self.salt = base64.b64decode(attributes["s"])
+            self.iterations = int(attributes["i"])
+        except (KeyError, ValueError):
+            raise ScramError("Malformed SCRAM challenge")
+        if not nonce.startswith(self.nonce):
+            raise ScramError("The server changed our nonce")
+        self.nonce = nonce
+
+    def final_message(self, keys):
+        self.keys = keys
+        final_bare = "c={0},r={1}".format(CHANNEL_BINDING, self.nonce)
+        self.auth_message = "{0},{1},{2}".format(
+            self.first_bare, self.server_first, final_bare).encode()
+        signature = hmac.digest(keys.stored_key, self.auth_message,
+                                self.hash_name)
+        proof = base64.b64encode(xor(keys.client_key, signature)).decode()
+        return "{0},p={1}".format(final_bare, proof).encode()
+
+    def verify(self, server_final):
+        """
+        Checks the server knew the password too.
+        """
+        attributes = parse(server_final.decode())
+        if "e" in attributes:
+            raise ScramError("Server error: {0}".format(attributes["e"]))
+        expected = hmac.digest(self.keys.server_key, self.auth_message,
+                               self.hash_name)
+        try:
+            signature = base64.b64decode(attributes["v"])
+        except (KeyError, ValueError):
+            raise ScramError("Malformed SCRAM outcome")
+        if not hmac.compare_digest(signature, expected):
+            raise ScramError("The server's signature doesn't match")
+
+
+class ScramServer(object):
+    """
+    The server side of one SCRAM exchange: `read_first_message` returns the
+    username, `challenge` the challenge for the user's salt, and
+    `read_final_message`, with the keys for `salt` and `iterations`, returns
+    the server's final message if the client proved it knows the password,
+    or raises ScramError.
+    """
+
+    def __init__(self, mechanism, iterations=DEFAULT_ITERATIONS):
+        self.mechanism = mechanism
+        self.hash_name = MECHANISMS[mechanism]
+        self.salt = None
+        self.iterations = iterations
+        self.username = None
+        self.nonce = None
+        self.first_bare = None
+        self.server_first = None
+
+    def read_first_message(self, client_first):
+        message = client_first.decode()
+        if not message.startswith(GS2_HEADER):
+            raise ScramError("Channel binding isn't supported")
+        self.first_bare = message[len(GS2_HEADER):]
+        attributes = parse(self.first_bare)
+        try:
+            self.username = unescape_name(attributes["n"])
+            self.nonce = attributes["r"] + create_nonce()
+        except KeyError:
+            raise ScramError("Malformed SCRAM first message")
+        return self.username
+
+    def challenge(self, salt):
+        self.salt = salt
+        self.server_first = "r={0},s={1},i={2}".format(
+            self.nonce, base64.b64encode(self.salt).decode(), self.iterations)
+        return self.server_first.encode()
+
+    def read_final_message(self, client_final, keys):
+        message = client_final.decode()
+        final_bare, separator, proof = message.rpartition(",p=")
+        if not separator:
+            raise ScramError("Malformed SCRAM final message")
+        attributes = parse(final_bare)
+        if attributes.get("c") != CHANNEL_BINDING or \
+                attributes.get("r") != self.nonce:
+            raise ScramError("Channel binding or nonce doesn't match")
+        auth_message = "{0},{1},{2}".format(
+            self.first_bare, self.server_first, final_bare).encode()
+        signature = hmac.digest(keys.stored_key, auth_message, self.hash_name)
+        try:
+            client_key = xor(base64.b64decode(proof), signature)
+        except ValueError:
+            raise ScramError("Malformed SCRAM proof")
+        if not hmac.compare_digest(
+                hashlib.new(self.hash_name, client_key).digest(),
+                keys.stored_key):
+            raise ScramError("Wrong password")
+        server_signature = hmac.digest(keys.server_key, auth_message,
+                                       self.hash_name)
+        return "v={0}".format(
+            base64.b64encode(server_signature).decode()).encode()
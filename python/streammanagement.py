@@ -0,0 +1,130 @@
+"""
+Stream management (XEP-0198), for both ends of a connection.
+
+Each end counts the stanzas it has handled, and tells the other how many
+with `<a h='...'/>` when asked with `<r/>`. Stanzas sent are kept until the
+other end has acked them. So when a connection drops, the client can
+resume the stream on a new one with `<resume/>`, straight after logging in,
+and both ends send again whatever the other never got. That is one round
+trip instead of binding a resource, sending presence and joining every room
+all over again, and nothing is lost.
+"""
+from collections import deque
+
+NAMESPACE = "urn:xmpp:sm:3"
+
+# Only stanzas are counted, not the likes of <r/> and <a/>
+STANZA_TAGS = ("message", "presence", "iq")
+STANZA_PREFIXES = (b"<message", b"<presence", b"<iq")
+
+# Counts wrap around at 2^32
+COUNT_MODULUS = 1 << 32
+
+
+def is_stanza(package):
+    return package.startswith(STANZA_PREFIXES)
+
+
+class StreamManagement(object):
+    """
+    One end's count of the stanzas it has handled, and the stanzas it has
+    sent that the other end hasn't acked yet. Owners keep it across
+    connections to resume the stream with `id`.
+
+    At most `max_unacked` stanzas are kept, after which the oldest are given
+    up on. `sent` says when `ack_interval` stanzas have gone out since the
+    last time it did, for the sender to ask for an ack.
+    """
+
+    def __init__(self, max_unacked=1000, ack_interval=10):
+        self.id = None
+        self.resumable = False
+
+        # The JID the stream was bound to, which resuming it gets back
+        self.jid = None
+
+        # Stanzas received and handled
+        self.handled = 0
+
+        # Stanzas sent before the first one in `unacked`: acked by the other
+        # end, or given up on when there were too many
+        self.acked = 0
+        self.unacked = deque()
+        self.max_unacked = max_unacked
+        self.ack_interval = ack_interval
+        self.since_request = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.unacked)
+
+    def received(self):
+        self.handled = (self.handled + 1) % COUNT_MODULUS
+
+    def sent(self, package):
+        """
+        Keeps a stanza until it is acked. Returns True when it is time to ask
+        for an ack.
+        """
+        unacked = self.unacked
+        unacked.append(package)
+        if len(unacked) > self.max_unacked:
+            unacked.popleft()
+            self.acked = (self.acked + 1) % COUNT_MODULUS
+            self.dropped += 1
+        self.since_request += 1
+        if self.since_request >= self.ack_interval:
+            self.since_request = 0
+            return True
+        return False
+
+    def acknowledge(self, h):
+        """
+        Forgets the stanzas the other end says it has handled, by its count
+        `h`. Returns False, and forgets nothing, if `h` counts stanzas that
+        were never sent or were already given up on.
+        """
+        count = (h - self.acked) % COUNT_MODULUS
+        if count > len(self.unacked):
+            return False
+        for _ in range(count):
+            self.unacked.popleft()
+        self.acked = h % COUNT_MODULUS
+        return True
+
+    def take_unacked(self):
+        """
+        Removes and returns the stanzas still unacked, to send them again,
+        which keeps them again.
+        """
+        unacked = list(self.unacked)
+        self.unacked.clear()
+        return unacked
+
+    def reset(self):
+        """
+        Starts again from nothing, when the stream can't be resumed. Returns
+        how many stanzas were lost with it.
+        """
+        lost = len(self.unacked)
+        self.id = None
+        self.resumable = False
+        self.jid = None
+        self.handled = 0
+        self.acked = 0
+        self.unacked.clear()
+        self.since_request = 0
+        return lost
+
+
+def parse_count(value):
+    """
+    An `h` attribute, or None if it isn't one.
+    """
+    try:
+        h = int(value)
+    except (TypeError, ValueError):
+        return None
+    if not 0 <= h < COUNT_MODULUS:
+        return None
+    return h
@@ -0,0 +1,82 @@
+"""
+Connections that are still connecting when the handshake times out are
+tried again, but those stopped on purpose are not, and the scheduler
+forgets about them.
+"""
+import argparse
+import asyncio
+
+import pytest
+
+import botruntime
+from connectionscheduler import ConnectionScheduler
+from jumperbot import Bot, BotConnection, BotManager
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    asyncio.set_event_loop(None)
+    loop.close()
+
+
+@pytest.fixture
+def manager(loop, monkeypatch):
+    async def never_connect(*args):
+        await loop.create_future()
+
+    monkeypatch.setattr(botruntime, "open_connection", never_connect)
+    manager = BotManager()
+    manager.args = argparse.Namespace(server_name="localhost", port=5222)
+    manager.scheduler = ConnectionScheduler(manager.connect, manager.abort,
+                                            loop=loop)
+    return manager
+
+
+def start_connecting(loop, manager, name):
+    connection = BotConnection(manager, name, "localhost", "jumperbot")
+    manager.connections[name] = connection
+    manager.scheduler.request(name)
+    loop.run_until_complete(asyncio.sleep(0))
+    assert connection.connect_task is not None
+    return connection
+
+
+def test_aborted_connect_is_retried(loop, manager):
+    connection = start_connecting(loop, manager, "aborted")
+    task = connection.connect_task
+    # As when the handshake times out
+    manager.scheduler.expire("aborted")
+    loop.run_until_complete(asyncio.sleep(0))
+    assert task.done() and not task.cancelled()
+    assert manager.scheduler.retries == 1
+    assert "aborted" in manager.scheduler.backing_off
+
+
+def test_stopped_connect_is_not_retried(loop, manager):
+    connection = start_connecting(loop, manager, "stopped")
+    bot = Bot("stopped@localhost", "stopped")
+    manager.bots_running[bot.username] = connection.bots[bot.username] = bot
+    bot.connection = connection
+    manager.scheduler.failures["stopped"] = 2
+    task = connection.connect_task
+    manager.stop_bot(bot.username)
+    loop.run_until_complete(asyncio.sleep(0))
+    assert task.cancelled()
+    assert manager.scheduler.retries == 0
+    assert "stopped" not in manager.scheduler.failures
+    assert not manager.scheduler.backing_off
+
+
+def test_removing_cancels_a_pending_retry(loop):
+    connected = []
+    scheduler = ConnectionScheduler(connected.append, loop=loop)
+    scheduler.backoff.base = 0.01
+    scheduler.retry("gone")
+    scheduler.request("waiting")
+    scheduler.remove("gone")
+    loop.run_until_complete(asyncio.sleep(0.05))
+    assert connected == ["waiting"]
+    assert scheduler.failures == {}
@@ -0,0 +1,38 @@
+"""
+Stanzas dispatched in batches, a few per iteration of the event loop, stop
+being handled once the connection is lost rather than being taken for
+unhandled ones.
+"""
+import asyncio
+import logging
+
+from xmppelement import XmppAttributes, XmppElement
+from xmpphandler import XmppHandler
+
+
+def test_batches_left_when_connection_lost_are_dropped(caplog):
+    loop = asyncio.new_event_loop()
+    try:
+        handler = XmppHandler()
+        handler.state = "ready"
+        handler.dispatch_batch = 2
+        received = []
+        handler.handle_message = received.append
+        for i in range(5):
+            handler.queue.push(XmppElement("message", XmppAttributes(
+                id=str(i), type="groupchat")))
+
+        async def run():
+            handler.process_queue()
+            assert len(received) == 2 and handler.dispatch_scheduled
+            handler.connection_lost()
+            await asyncio.sleep(0.01)
+
+        with caplog.at_level(logging.WARNING, logger="xmpphandler"):
+            loop.run_until_complete(run())
+    finally:
+        loop.close()
+    assert len(received) == 2
+    assert len(handler.queue) == 0
+    assert not handler.dispatch_scheduled
+    assert "Unhandled" not in caplog.text
@@ -0,0 +1,53 @@
+"""
+Loss of groupchat messages, from gaps in the sequence numbers and from the
+messages missing after the last one a receiver got, once their sender has
+left the room, including when senders and receivers are in different
+processes of a fleet.
+"""
+import pickle
+
+from latency import TAIL_GRACE, LatencyRecorder, add_marker
+
+ROOM = "room@conference.localhost"
+
+
+def receive(recorder, receiver, sequences, session="5e55"):
+    for sequence in sequences:
+        recorder.record(receiver, ROOM, "talker",
+                        add_marker("hello", session, sequence, 0), 1000)
+
+
+def test_messages_after_the_last_received_are_lost_once_sender_leaves():
+    recorder = LatencyRecorder()
+    receive(recorder, "a", [0, 1, 3, 4])
+    receive(recorder, "b", [0, 1, 2])
+    stats = recorder.rooms[ROOM]
+    assert stats.total_lost() == 1
+
+    recorder.ended(ROOM, "talker", "5e55", 9, ended_at=0)
+    # 5 to 9 for a, and 3 to 9 for b
+    assert stats.total_lost(now=TAIL_GRACE) == 1 + 5 + 7
+    assert stats.received == 7
+    assert recorder.loss(now=TAIL_GRACE) == 13 / 20
+
+
+def test_messages_may_still_arrive_for_a_while():
+    recorder = LatencyRecorder()
+    receive(recorder, "a", [0, 1])
+    recorder.ended(ROOM, "talker", "5e55", 3, ended_at=0)
+    assert recorder.rooms[ROOM].total_lost(now=TAIL_GRACE - 1) == 0
+    receive(recorder, "a", [2, 3])
+    assert recorder.rooms[ROOM].total_lost(now=TAIL_GRACE) == 0
+
+
+def test_tail_loss_across_processes():
+    sender = LatencyRecorder()
+    sender.ended(ROOM, "talker", "5e55", 9, ended_at=0)
+    receivers = LatencyRecorder()
+    receive(receivers, "a", [0, 1, 2])
+    receive(receivers, "b", [0])
+
+    total = LatencyRecorder()
+    for recorder in (sender, receivers):
+        total.merge(pickle.loads(pickle.dumps(recorder)))
+    assert total.rooms[ROOM].total_lost(now=TAIL_GRACE) == 7 + 9
@@ -0,0 +1,82 @@
+"""
+What `OutboundQueue` sends, in what order, and what it drops, and that a
+handler sending through it only counts what actually went out.
+"""
+import asyncio
+
+from outboundqueue import OutboundQueue
+from xmpphandler import XmppHandler
+
+
+def message(i):
+    return "<message to='a@localhost'><body>{0}</body></message>".format(
+        i).encode()
+
+
+def presence(i):
+    return "<presence id='{0}'/>".format(i).encode()
+
+
+def test_chat_over_the_limit_is_dropped():
+    queue = OutboundQueue(max_queued=3)
+    assert [queue.put(message(i)) for i in range(5)] == \
+        [True, True, True, False, False]
+    assert queue.dropped == 2
+    assert queue.take(0) == [message(i) for i in range(3)]
+
+
+def test_replay_keeps_order_and_drops_nothing():
+    """
+    On resuming a stream up to 1000 stanzas may be sent again, far more
+    chat than may wait otherwise, and they must go in their first order.
+    """
+    queue = OutboundQueue(max_queued=3)
+    queue.put(presence("later"))
+    queue.put(message("later"))
+    replayed = [message(i) if i % 3 else presence(i) for i in range(1000)]
+    queue.replay(replayed)
+    assert len(queue) == 1002
+    assert queue.dropped == 0
+    assert queue.take(0) == replayed + [presence("later"), message("later")]
+
+
+def test_replay_is_rate_limited():
+    queue = OutboundQueue(rate=10, burst=5)
+    queue.replay([message(i) for i in range(20)])
+    assert queue.take(0) == [message(i) for i in range(5)]
+    assert queue.wait > 0
+    assert queue.take(1.0) == [message(i) for i in range(5, 10)]
+
+
+def test_stream_packages_take_the_replay_out_first():
+    queue = OutboundQueue(rate=10, burst=1)
+    queue.replay([message(0), message(1)])
+    queue.put(presence(2))
+    queue.put(b"</stream:stream>")
+    assert queue.take(0) == [message(0), message(1), presence(2),
+                             b"</stream:stream>"]
+
+
+def test_stanzas_cleared_from_the_queue_count_as_dropped_not_sent():
+    loop = asyncio.new_event_loop()
+    try:
+        handler = XmppHandler()
+        written = []
+        handler.send = written.append
+        handler.outbound = OutboundQueue(rate=1, burst=2)
+
+        async def run():
+            for i in range(5):
+                handler.transmit(message(i))
+            await asyncio.sleep(0)
+            handler.close_stream()
+
+        loop.run_until_complete(run())
+        if handler.flush_timer is not None:
+            handler.flush_timer.cancel()
+    finally:
+        loop.close()
+    metrics = handler.metrics
+    assert written == [message(0) + message(1), b"</stream:stream>"]
+    assert metrics.stanzas_out["message"] == 2
+    assert metrics.outbound_dropped == 3
@@ -0,0 +1,246 @@
+"""
+The pull reader (`XmppStreamReader`) must read every stream exactly as the
+SAX path (`XmppTreeReader`) does: the same stanzas, with the same
+attributes, children and text, and the same stream start and end events,
+however the stream is split into reads, and with any number of connections
+sharing the parser pool.
+"""
+import random
+
+import pytest
+
+from parserpool import ParserPool
+from xmppcontenthandler import XmppTreeReader
+from xmppstreamreader import XmppStreamReader, build_element
+
+STREAM_START = (
+    "<?xml version='1.0'?>"
+    "<stream:stream xmlns:stream='http://etherx.jabber.org/streams' "
+    "version='1.0' from='localhost' id='s1' xml:lang='en' "
+    "xmlns='jabber:client'>"
+)
+
+STANZAS = [
+    "<stream:features>"
+    "<mechanisms xmlns='urn:ietf:params:xml:ns:xmpp-sasl'>"
+    "<mechanism>SCRAM-SHA-256</mechanism><mechanism>PLAIN</mechanism>"
+    "</mechanisms></stream:features>",
+    "<success xmlns='urn:ietf:params:xml:ns:xmpp-sasl'/>",
+    "<iq type='result' id='1'><bind xmlns='urn:ietf:params:xml:ns:xmpp-bind'>"
+    "<jid>bot@localhost/résumé</jid></bind></iq>",
+    # Quoted '>' in attributes, and escaped text
+    "<message from='room@conference.localhost/a&gt;b' to='bot@localhost' "
+    "type='groupchat' title=\"x > y\"><body>1 &lt; 2 &amp;&amp; "
+    "\"quoted\" 'too'</body></message>",
+    # Multibyte text, split across reads at any byte
+    "<message from='room@conference.localhost/日本' "
+    "to='bot@localhost' type='groupchat'>"
+    "<body>こんにちは \U0001F600 café "
+    "über ж</body>"
+    "<delay xmlns='urn:xmpp:delay' stamp='2020-01-01T00:00:00Z'/></message>",
+    "<presence from='room@conference.localhost/nick' to='bot@localhost'>"
+    "<x xmlns='http://jabber.org/protocol/muc#user'>"
+    "<item affiliation='none' role='participant'/><status code='110'/></x>"
+    "</presence>",
+    # Deeply nested, with text between children
+    "<iq type='result' id='2'><query xmlns='jabber:iq:roster'>"
+    "<item jid='a@localhost'>before<group>one</group>between"
+    "<group>two</group>after</item></query></iq>",
+    # Empty, with a quoted '>' and an escaped end tag
+    "<presence from='room@conference.localhost/x' to='bot@localhost' "
+    "status=\"a > b\" type='unavailable' note='&lt;/presence>'/>",
+    "<r xmlns='urn:xmpp:sm:3'/>",
+]
+
+STREAM_END = "</stream:stream>"
+
+
+def describe(element):
+    """
+    Everything about an element a handler may look at, as plain data.
+    """
+    element = getattr(element, "element", element)
+    return (
+        element.tag,
+        dict(element.attributes),
+        element.text,
+        [describe(child) for child in element.children],
+    )
+
+
+def describe_tag(stanza):
+    return stanza[1:].split(" ", 1)[0].split(">", 1)[0].rstrip("/")
+
+
+def stream_bytes(stanzas, keepalives=True, end=True):
+    parts = [STREAM_START]
+    for stanza in stanzas:
+        parts.append(stanza)
+        if keepalives:
+            # Whitespace keepalives between stanzas
+            parts.append(" \n")
+    if end:
+        parts.append(STREAM_END)
+    return "".join(parts).encode("utf-8")
+
+
+def random_chunks(data, rng, max_size=17):
+    chunks = []
+    position = 0
+    while position < len(data):
+        size = rng.randint(1, max_size)
+        chunks.append(data[position:position + size])
+        position += size
+    return chunks
+
+
+def read_all(reader, chunks):
+    events = []
+    for chunk in chunks:
+        reader.feed(chunk)
+        queue = reader.queue
+        while len(queue):
+            events.append(describe(queue.pop()))
+    return events
+
+
+def building_stream_reader(pool=None):
+    reader = XmppStreamReader(pool=pool)
+    reader.build_elements = True
+    return reader
+
+
+READERS = {
+    "sax": XmppTreeReader,
+    "pull": XmppStreamReader,
+    "pull, building elements": building_stream_reader,
+}
+
+
+def test_whole_stream_matches():
+    data = stream_bytes(STANZAS)
+    sax = read_all(XmppTreeReader(pool=ParserPool()), [data])
+    pull = read_all(XmppStreamReader(pool=ParserPool()), [data])
+    assert pull == sax
+    assert [event[0] for event in sax] == \
+        ["stream:stream"] + [describe_tag(s) for s in STANZAS] + \
+        ["stream:closed"]
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_random_splits_match(seed):
+    rng = random.Random(seed)
+    stanzas = [rng.choice(STANZAS) for _ in range(30)]
+    data = stream_bytes(stanzas, keepalives=rng.random() < 0.5)
+    expected = read_all(XmppTreeReader(pool=ParserPool()), [data])
+    for name, reader_class in READERS.items():
+        chunks = random_chunks(data, rng, max_size=rng.choice((1, 3, 17, 64)))
+        events = read_all(reader_class(pool=ParserPool()), chunks)
+        assert events == expected, name
+
+
+def test_one_byte_reads_match():
+    data = stream_bytes(STANZAS)
+    chunks = [data[i:i + 1] for i in range(len(data))]
+    sax = read_all(XmppTreeReader(pool=ParserPool()), chunks)
+    pull = read_all(XmppStreamReader(pool=ParserPool()), chunks)
+    assert pull == sax
+    assert len(sax) == len(STANZAS) + 2
+
+
+def test_str_and_bytes_reads_match():
+    text = stream_bytes(STANZAS).decode("utf-8")
+    for reader_class in READERS.values():
+        from_text = read_all(reader_class(pool=ParserPool()), [text])
+        from_bytes = read_all(reader_class(pool=ParserPool()),
+                              [text.encode("utf-8")])
+        assert from_text == from_bytes
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_interleaved_connections_sharing_a_pool(seed):
+    """
+    Connections of both kinds read their streams a chunk at a time, in
+    random order, all borrowing parsers from one pool. Each one must read
+    exactly what it would have on its own.
+    """
+    rng = random.Random(seed)
+    pool = ParserPool(max_size=4)
+    connections = []
+    for index in range(8):
+        stanzas = [rng.choice(STANZAS) for _ in range(15)]
+        data = stream_bytes(stanzas, keepalives=rng.random() < 0.5)
+        expected = read_all(XmppTreeReader(pool=ParserPool()), [data])
+        reader_class = list(READERS.values())[index % len(READERS)]
+        connections.append({
+            "reader": reader_class(pool=pool),
+            "chunks": random_chunks(data, rng),
+            "events": [],
+            "expected": expected,
+        })
+
+    pending = list(connections)
+    while pending:
+        connection = rng.choice(pending)
+        chunk = connection["chunks"].pop(0)
+        connection["events"].extend(read_all(connection["reader"], [chunk]))
+        if not connection["chunks"]:
+            pending.remove(connection)
+
+    for connection in connections:
+        assert connection["events"] == connection["expected"]
+    # Parsers went back to the pool between stanzas
+    assert pool.reused > 0
+
+
+def test_stream_restart_after_reset():
+    """
+    After STARTTLS or authentication the stream starts again from scratch,
+    with the same reader.
+    """
+    first = stream_bytes(STANZAS[:2], end=False)
+    second = stream_bytes(STANZAS[2:])
+    results = {}
+    for name, reader_class in READERS.items():
+        reader = reader_class(pool=ParserPool())
+        events = read_all(reader, random_chunks(first, random.Random(1)))
+        reader.reset()
+        events += read_all(reader, random_chunks(second, random.Random(2)))
+        results[name] = events
+    assert results["pull"] == results["sax"]
+    assert [event[0] for event in results["sax"]].count("stream:stream") == 2
+
+
+@pytest.mark.parametrize("build_elements", (False, True))
+def test_raw_bytes_round_trip(build_elements):
+    """
+    The pull reader keeps each stanza's bytes as received, which must parse
+    back to the same element.
+    """
+    data = stream_bytes(STANZAS)
+    reader = XmppStreamReader(pool=ParserPool())
+    reader.build_elements = build_elements
+    for chunk in random_chunks(data, random.Random(3)):
+        reader.feed(chunk)
+    queue = reader.queue
+    queue.pop()
+    for stanza in STANZAS:
+        view = queue.pop()
+        assert view.raw == stanza.encode("utf-8")
+        assert describe(build_element(view.raw)) == describe(view)
+
+
+def test_switching_to_building_elements_between_reads():
+    """
+    The handler switches building on and off as it logs in, between
+    whatever reads the stream comes in.
+    """
+    data = stream_bytes(STANZAS * 3)
+    expected = read_all(XmppTreeReader(pool=ParserPool()), [data])
+    rng = random.Random(4)
+    reader = XmppStreamReader(pool=ParserPool())
+    events = []
+    for chunk in random_chunks(data, rng):
+        reader.build_elements = rng.random() < 0.5
+        events += read_all(reader, [chunk])
+    assert events == expected
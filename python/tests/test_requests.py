@@ -0,0 +1,98 @@
+"""
+How `RequestTracker` counts requests that don't get a response, that
+requests with only a callback don't go missing without a word, and that
+the counts get to the metrics.
+"""
+import asyncio
+import logging
+
+import pytest
+
+from xmppelement import XmppAttributes, XmppElement
+from xmppmetrics import PrometheusWriter, XmppMetrics
+from xmpprequests import RequestTracker
+
+
+def response(request_id):
+    return XmppElement("iq", XmppAttributes(id=request_id, type="result"))
+
+
+def test_connection_lost_counts_as_failed_not_cancelled():
+    loop = asyncio.new_event_loop()
+    try:
+        tracker = RequestTracker()
+        future = loop.create_future()
+        tracker.add("1", future=future)
+        tracker.add("2", future=loop.create_future())
+        assert tracker.cancel("2")
+        tracker.fail_all(ConnectionError("Connection lost"))
+        assert (tracker.failed, tracker.cancelled) == (1, 1)
+        assert len(tracker) == 0
+        with pytest.raises(ConnectionError):
+            future.result()
+    finally:
+        loop.close()
+
+
+def test_callback_requests_are_logged_when_connection_lost(caplog):
+    def handle_bind(response):
+        pass
+
+    tracker = RequestTracker()
+    tracker.add("bind_1", callback=handle_bind)
+    with caplog.at_level(logging.WARNING, logger="xmpprequests"):
+        tracker.fail_all(ConnectionError("Connection lost"))
+    assert tracker.failed == 1
+    assert "bind_1" in caplog.text
+    assert "handle_bind" in caplog.text
+
+
+def test_callback_requests_are_logged_when_timed_out(caplog):
+    called = []
+    loop = asyncio.new_event_loop()
+    try:
+        tracker = RequestTracker()
+        tracker.add("session_1", callback=called.append, timeout=0.01,
+                    loop=loop)
+        with caplog.at_level(logging.WARNING, logger="xmpprequests"):
+            loop.run_until_complete(asyncio.sleep(0.05))
+    finally:
+        loop.close()
+    assert tracker.timed_out == 1
+    assert called == []
+    assert "session_1" in caplog.text
+    assert "append" in caplog.text
+
+
+def test_requests_are_counted_in_shared_metrics():
+    metrics = XmppMetrics()
+    loop = asyncio.new_event_loop()
+    try:
+        first = RequestTracker(metrics)
+        second = RequestTracker(metrics)
+        first.add("1", callback=lambda response: None)
+        first.add("2", future=loop.create_future(), timeout=0.01, loop=loop)
+        second.add("3", future=loop.create_future())
+        second.add("4", future=loop.create_future())
+        assert metrics.requests_pending == 4
+        first.resolve("1", response("1"))
+        first.resolve("5", response("5"))
+        loop.run_until_complete(asyncio.sleep(0.05))
+        second.cancel("3")
+        assert metrics.requests_pending == 1
+        second.fail_all(ConnectionError("Connection lost"))
+    finally:
+        loop.close()
+    assert metrics.requests_pending == 0
+    assert metrics.requests == {"completed": 1, "unmatched": 1,
+                                "timed_out": 1, "cancelled": 1, "failed": 1}
+
+    total = XmppMetrics()
+    total.merge(metrics)
+    writer = PrometheusWriter()
+    writer.add_xmpp_metrics(total)
+    text = writer.render()
+    assert "xmpp_pending_requests 0\n" in text
+    for outcome in ("timed_out", "failed", "unmatched"):
+        assert 'xmpp_requests_total{{outcome="{0}"}} 1\n'.format(
+            outcome) in text
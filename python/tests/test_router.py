@@ -0,0 +1,141 @@
+"""
+`StanzaRouter` must call exactly the handlers whose routes match a stanza,
+in the order they were added, however many routes there are, and IQs the
+handler doesn't take as responses to its requests must reach it too.
+"""
+import random
+import time
+
+import pytest
+
+from xmppelement import XmppAttributes, XmppElement
+from xmpphandler import XmppHandler
+from xmpprouter import KeyedRoutes, StanzaRouter, compile_layout, \
+    with_payload
+
+STATES = [None, "ready", "binding"]
+TAGS = [None, "message", "presence", "iq"]
+TYPES = [None, "chat", "groupchat", "result"]
+NAMESPACES = [None, "urn:a", "urn:b"]
+
+
+def stanza(tag, type=None, xmlns=None, **attributes):
+    attributes = XmppAttributes(attributes)
+    if type is not None:
+        attributes["type"] = type
+    if xmlns is not None:
+        attributes["xmlns"] = xmlns
+    return XmppElement(tag, attributes)
+
+
+def matches(route, state, element):
+    return all(wanted is None or wanted == value for wanted, value in (
+        (route[0], state),
+        (route[1], element.tag),
+        (route[2], element.attributes.get("type")),
+        (route[3], element.attributes.get("xmlns")),
+    ))
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_dispatch_matches_every_route_in_order(seed):
+    rng = random.Random(seed)
+    routes = [(rng.choice(STATES), rng.choice(TAGS), rng.choice(TYPES),
+               rng.choice(NAMESPACES)) for i in range(rng.randint(1, 40))]
+    called = []
+    router = StanzaRouter()
+    for index, route in enumerate(routes):
+        router.add(lambda element, index=index: called.append(index), *route)
+
+    for i in range(200):
+        state = rng.choice(STATES[1:] + ["other"])
+        element = stanza(rng.choice(TAGS[1:] + ["other"]),
+                         rng.choice(TYPES + ["other"]),
+                         rng.choice(NAMESPACES + ["other"]))
+        del called[:]
+        handled = router.dispatch(state, element)
+        expected = [index for index, route in enumerate(routes)
+                    if matches(route, state, element)]
+        assert called == expected
+        assert handled == bool(expected)
+
+
+def test_changing_routes_recompiles():
+    called = []
+    router = StanzaRouter()
+    router.add(called.append, tag="message")
+    element = stanza("message", "chat")
+    assert router.dispatch("ready", element)
+    route = router.add(lambda element: called.append("chat"), type="chat")
+    router.dispatch("ready", element)
+    assert called == [element, element, "chat"]
+    router.remove(route)
+    router.dispatch("ready", element)
+    assert called == [element, element, "chat", element]
+
+
+def test_many_routes_compile_quickly():
+    """
+    The table isn't worked out for every combination of the values routes
+    mention, which grows with the product of their numbers.
+    """
+    compile_layout.cache_clear()
+    router = StanzaRouter()
+    for i in range(256):
+        router.add(lambda element: None, state="state{0}".format(i % 8),
+                   tag="extra{0}".format(i), type="type{0}".format(i % 4),
+                   xmlns="urn:{0}".format(i % 16))
+    start = time.perf_counter()
+    router.dispatch("state1", stanza("extra1", "type1", "urn:1"))
+    router.dispatch("ready", stanza("message"))
+    assert time.perf_counter() - start < 0.1
+
+
+def test_routers_with_the_same_routes_share_a_layout():
+    routers = []
+    for i in range(2):
+        router = StanzaRouter()
+        router.add(lambda element: None, tag="message")
+        router.dispatch("ready", stanza("message"))
+        routers.append(router)
+    assert routers[0].layout is routers[1].layout
+
+
+def test_table_stays_bounded():
+    called = []
+    router = StanzaRouter()
+    router.max_table_size = 4
+    router.add(called.append, tag="message", type="chat")
+    for i in range(10):
+        router.dispatch("ready", stanza("tag{0}".format(i), "chat"))
+        router.dispatch("ready", stanza("message", "type{0}".format(i)))
+    assert router.dispatch("ready", stanza("message", "chat"))
+    assert len(router.table) <= 4
+    assert all(len(keyed.table) <= 4 for keyed in router.table.values()
+               if isinstance(keyed, KeyedRoutes))
+    assert len(called) == 1
+
+
+def test_iq_requests_and_unmatched_responses_are_routed():
+    handler = XmppHandler()
+    handler.state = "ready"
+    pings = []
+    results = []
+    handler.add_route(pings.append, tag="iq", type="get",
+                      filter=with_payload("urn:xmpp:ping"))
+    handler.add_route(results.append, tag="iq", type="result")
+    ping = stanza("iq", "get", id="ping1")
+    ping.add_child(XmppElement("ping", XmppAttributes(xmlns="urn:xmpp:ping")))
+    handler.dispatch(ping)
+    assert pings == [ping]
+
+    answered = []
+    handler.requests.add("1", callback=answered.append)
+    response = stanza("iq", "result", id="1")
+    handler.dispatch(response)
+    assert answered == [response]
+    assert results == []
+    unmatched = stanza("iq", "result", id="2")
+    handler.dispatch(unmatched)
+    assert results == [unmatched]
+    assert handler.requests.unmatched == 1
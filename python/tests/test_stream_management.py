@@ -0,0 +1,194 @@
+"""
+Stream management (XEP-0198) against the stand-in `XmppServer`, running in
+the same event loop: the client's count of what it sent must agree with the
+server's acks, whichever way the login and the outgoing stanzas go, and a
+stream resumed after its connection dropped must lose and repeat nothing.
+"""
+import asyncio
+
+import pytest
+
+import xmppstanzas
+from outboundqueue import OutboundQueue
+from streammanagement import StreamManagement
+from xmpphandler import XmppHandler
+from xmppserver import XmppServer
+
+HOST = "localhost"
+
+
+class Client(asyncio.Protocol):
+    """
+    A client connection, keeping the bodies of the messages it gets. While
+    `partitioned`, what it writes never gets to the server.
+    """
+
+    def __init__(self, username, stream_management=None, pipeline=False,
+                 outbound=None, known_features=None):
+        self.username = username
+        self.stream_management = stream_management
+        self.pipeline = pipeline
+        self.outbound = outbound
+        self.known_features = known_features
+        self.transport = None
+        self.handler = None
+        self.received = []
+        self.partitioned = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.handler = handler = XmppHandler()
+        handler.send = self.write
+        handler.stream_management = self.stream_management
+        handler.pipeline_login = self.pipeline
+        if self.known_features is not None:
+            handler.known_features = self.known_features
+        handler.outbound = self.outbound
+        handler.handle_message = self.handle_message
+        handler.connect(HOST, self.username, "password")
+
+    def write(self, data):
+        if not self.partitioned:
+            self.transport.write(data)
+
+    def handle_message(self, response):
+        self.received.append(response.find_child_with_tag("body").text)
+
+    def data_received(self, data):
+        self.handler.handle_raw_response(data)
+
+    def connection_lost(self, exc):
+        self.handler.connection_lost()
+
+    def pause_writing(self):
+        self.handler.pause_writing()
+
+    def resume_writing(self):
+        self.handler.resume_writing()
+
+
+async def eventually(condition, timeout=5.0):
+    loop = asyncio.get_running_loop()
+    end = loop.time() + timeout
+    while not condition():
+        if loop.time() > end:
+            return False
+        await asyncio.sleep(0.01)
+    return True
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest.fixture
+def server(loop):
+    server = XmppServer(HOST)
+    listener = loop.run_until_complete(server.start("127.0.0.1", 0))
+    server.port = listener.sockets[0].getsockname()[1]
+    yield server
+    listener.close()
+    loop.run_until_complete(listener.wait_closed())
+
+
+async def connect(server, client):
+    await asyncio.get_running_loop().create_connection(
+        lambda: client, "127.0.0.1", server.port)
+    await asyncio.wait_for(client.handler.wait_ready(), 5)
+    return client
+
+
+@pytest.mark.parametrize("pipeline", (False, True))
+@pytest.mark.parametrize("outbound", (False, True))
+def test_acks_account_for_everything_sent(loop, server, pipeline, outbound):
+    """
+    With the login pipelined, <enable/> is queued behind bind and session,
+    which the server doesn't count, and neither must the client, even when
+    the outbound queue only sends them later.
+    """
+    async def run():
+        known_features = {}
+        if pipeline:
+            # To learn the features to pipeline the next login with
+            client = await connect(server, Client(
+                "warmup", pipeline=True, known_features=known_features))
+            client.transport.close()
+        sm = StreamManagement()
+        client = await connect(server, Client(
+            "counted", sm, pipeline, OutboundQueue() if outbound else None,
+            known_features))
+        handler = client.handler
+        assert await eventually(lambda: handler.sm_enabled)
+        for i in range(5):
+            handler.message("counted@localhost", "message {0}".format(i))
+        assert await eventually(lambda: len(client.received) == 5)
+        # Once they are all out, as requests for acks go ahead of anything queued
+        handler.transmit(xmppstanzas.SM_REQUEST)
+        assert await eventually(lambda: len(sm) == 0)
+        # The initial presence and the messages
+        assert sm.acked == 6
+        client.transport.close()
+
+    loop.run_until_complete(run())
+
+
+@pytest.mark.parametrize("outbound", (False, True))
+def test_resuming_loses_and_repeats_nothing(loop, server, outbound):
+    """
+    Alice's connection drops in the middle of a conversation with Bob, while
+    both are still sending, and she resumes her stream on a new one. Each
+    of them must get every message the other sent exactly once, in order.
+    What she sent last never got to the server, more than the outbound
+    queue lets chat wait otherwise.
+    """
+    def alice(sm):
+        return Client("alice", sm, outbound=OutboundQueue(400, burst=10)
+                      if outbound else None)
+
+    async def send(client, to, prefix, numbers):
+        for i in numbers:
+            await client.handler.drain()
+            client.handler.message(to, "{0}{1}".format(prefix, i))
+
+    async def run():
+        sm = StreamManagement()
+        bob = await connect(server, Client("bob"))
+        first = await connect(server, alice(sm))
+        assert await eventually(lambda: first.handler.sm_enabled)
+
+        bob_sends = loop.create_task(
+            send(bob, "alice@localhost", "b", range(100)))
+        await send(first, "bob@localhost", "a", range(50))
+        await asyncio.sleep(0.1)
+        first.partitioned = True
+        await send(first, "bob@localhost", "a", range(50, 200))
+        await asyncio.sleep(0.1)
+        first.transport.abort()
+        sent = 200
+        await asyncio.sleep(0.1)
+        assert first.handler.state == "closed"
+        assert len(sm) >= 150
+
+        second = await connect(server, alice(sm))
+        assert second.handler.resumed
+        await send(second, "bob@localhost", "a", range(sent, sent + 100))
+        sent += 100
+        await bob_sends
+
+        assert await eventually(lambda: len(bob.received) >= sent and
+                                len(first.received) +
+                                len(second.received) >= 100)
+        # For any repeats to turn up
+        await asyncio.sleep(0.2)
+        assert bob.received == ["a{0}".format(i) for i in range(sent)]
+        assert first.received + second.received == \
+            ["b{0}".format(i) for i in range(100)]
+        assert server.resumes == 1
+        second.handler.close_stream()
+        second.transport.close()
+        bob.transport.close()
+
+    loop.run_until_complete(run())
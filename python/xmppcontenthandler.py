@@ -1,37 +1,82 @@
 import logging
-from typing import List
+from collections import deque
 from xml.sax import ContentHandler
 
-from xmppelement import XmppElement
+from parserpool import PooledParserReader
+from xmppelement import XmppElement, make_attributes
 
 logger = logging.getLogger(__name__)
 
 
+class StanzaQueue(object):
+    """
+    A FIFO queue of parsed stanzas waiting to be dispatched, with constant
+    time `push` and `pop`.
+
+    The queue itself never refuses a stanza - the parser has to put
+    everything it reads somewhere - but it reports when it has reached
+    `max_depth` so the owner can stop reading from the transport until it
+    has caught up. `high_water` and `pauses` record how deep the queue got
+    and how often that happened.
+    """
+
+    DEFAULT_MAX_DEPTH = 1024
+
+    def __init__(self, max_depth=DEFAULT_MAX_DEPTH):
+        self.items = deque()
+        self.max_depth = max_depth
+        self.high_water = 0
+        self.pushed = 0
+        self.pauses = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def push(self, element):
+        self.items.append(element)
+        self.pushed += 1
+        depth = len(self.items)
+        if depth > self.high_water:
+            self.high_water = depth
+
+    def pop(self):
+        return self.items.popleft()
+
+    def is_full(self):
+        return len(self.items) >= self.max_depth
+
+    def clear(self):
+        self.items.clear()
+
+
 class XmppContentHandler(ContentHandler):
-    def __init__(self):
+    def __init__(self, queue=None):
         ContentHandler.__init__(self)
-        self.queue = []  # type: List[XmppElement]
+        self.queue = queue if queue is not None else StanzaQueue()
+        self.reset()
+
+    def reset(self):
         self.current_element = None
         self.element_stack = []
+        self.in_stream = False
 
     def startElement(self, name, attrs):
-        element = XmppElement()
-        element.tag = name
-        element.attributes = attrs
+        element = XmppElement(name, make_attributes(attrs))
 
         if name == "stream:stream":
             # This element won't close until stream is closed
-            self.queue.append(element)
+            self.in_stream = True
+            self.queue.push(element)
             return
 
         self.element_stack.append(self.current_element)
         self.current_element = element
 
     def endElement(self, name):
-        if not self.current_element:
+        if self.current_element is None:
             if name == "stream:stream":
-                element = XmppElement()
-                element.tag = "stream:closed"
+                self.in_stream = False
+                self.queue.push(XmppElement("stream:closed"))
                 return
             else:
                 raise RuntimeError("No current element")
@@ -40,15 +85,54 @@ class XmppContentHandler(ContentHandler):
             raise RuntimeError("Mismatched tag")
 
         parent = self.element_stack.pop()
-        if parent:
-            parent.children.append(self.current_element)
+        if parent is not None:
+            parent.add_child(self.current_element)
         else:
-            self.queue.insert(0, self.current_element)
+            self.queue.push(self.current_element)
         self.current_element = parent
 
     def characters(self, content):
+        if self.current_element is None:
+            # Whitespace between stanzas, e.g. keepalives
+            return
         if self.current_element.text:
             self.current_element.text += content
         else:
             self.current_element.text = content
 
+
+class XmppTreeReader(PooledParserReader):
+    """
+    An incremental reader for an XMPP stream that builds a full `XmppElement`
+    tree for every stanza, with an `XmppContentHandler`.
+
+    The content handler is driven straight from expat, through the methods
+    of the SAX `ContentHandler` interface it implements, rather than through
+    an `xml.sax` reader: that way the parser can go back to the pool between
+    stanzas, and only the content handler is kept for each connection.
+    """
+
+    def __init__(self, queue=None, pool=None):
+        PooledParserReader.__init__(self, pool)
+        self.content_handler = XmppContentHandler(queue)
+        self.queue = self.content_handler.queue
+
+    def set_handlers(self, parser):
+        content_handler = self.content_handler
+        parser.StartElementHandler = content_handler.startElement
+        parser.EndElementHandler = content_handler.endElement
+        parser.CharacterDataHandler = content_handler.characters
+
+    def between_stanzas(self):
+        content_handler = self.content_handler
+        return content_handler.in_stream and \
+            content_handler.current_element is None
+
+    def reset(self):
+        PooledParserReader.reset(self)
+        self.content_handler.reset()
+
+    def feed(self, data):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self.parse(data)
@@ -1,35 +1,215 @@
-class XmppElement(object):
-    def __init__(self):
-        self.tag = None
-        self.attributes = []
+import sys
+
+
+class XmppAttributes(dict):
+    """
+    A plain dictionary of attribute values that also offers the subset of
+    the SAX `Attributes` interface used throughout this code, so elements
+    built without SAX can be handled the same way.
+    """
+    __slots__ = ()
+
+    def getValue(self, name):
+        return self[name]
+
+    def getNames(self):
+        return list(self.keys())
+
+
+# Shared by every element without attributes - never modify it
+EMPTY_ATTRIBUTES = XmppAttributes()
+
+# Shared by every element without children, until the first one is added
+NO_CHILDREN = ()
+
+
+def escape_text(value):
+    # type: (str) -> str
+    # Most text needs no escaping, and checking for that is much quicker
+    # than replacing
+    if "&" in value:
+        value = value.replace("&", "&amp;")
+    if "<" in value:
+        value = value.replace("<", "&lt;")
+    if ">" in value:
+        value = value.replace(">", "&gt;")
+    return value
+
+
+def escape_attribute(value):
+    # type: (str) -> str
+    """
+    Escapes a value for use in an attribute quoted with single quotes.
+    """
+    value = escape_text(value)
+    if "'" in value:
+        value = value.replace("'", "&apos;")
+    if "\"" in value:
+        value = value.replace("\"", "&quot;")
+    return value
+
+
+def make_attributes(attrs):
+    """
+    Makes compact attributes from a dictionary or SAX attributes.
+    """
+    if not attrs:
+        return EMPTY_ATTRIBUTES
+    return XmppAttributes(attrs.items())
+
+
+class StanzaAccessors(object):
+    """
+    Shortcuts for the attributes and children most often looked at when
+    handling a stanza. Needs `attributes` and `find_child_with_tag`.
+    """
+    __slots__ = ()
+
+    @property
+    def type(self):
+        return self.attributes.get("type")
+
+    @property
+    def id(self):
+        return self.attributes.get("id")
+
+    @property
+    def from_jid(self):
+        return self.attributes.get("from")
+
+    @property
+    def to_jid(self):
+        return self.attributes.get("to")
+
+    @property
+    def xmlns(self):
+        return self.attributes.get("xmlns")
+
+    @property
+    def body(self):
+        body = self.find_child_with_tag("body")
+        if body is None:
+            return None
+        return body.text
+
+
+class XmppElement(StanzaAccessors):
+    """
+    A parsed XML element.
+
+    Tags are interned, elements without attributes or children share empty
+    ones, and there is no per-instance `__dict__`, as many thousands of these
+    may be alive at once. Use `add_child` rather than appending to `children`.
+    """
+    __slots__ = ("tag", "attributes", "text", "children", "child_index")
+
+    def __init__(self, tag=None, attributes=EMPTY_ATTRIBUTES):
+        self.tag = sys.intern(tag) if tag else tag
+        self.attributes = attributes
         self.text = None
-        self.children = []
+        self.children = NO_CHILDREN
+        self.child_index = None
 
-    def find_child_with_tag(self, tag):
-        # type: (str) -> XmppElement
+    def add_child(self, child):
+        if self.children is NO_CHILDREN:
+            self.children = [child]
+        else:
+            self.children.append(child)
+        self.child_index = None
+
+    def find_child_with_tag(self, tag, xmlns=None):
+        # type: (str, str) -> XmppElement
         """
+        Returns the first child with the given tag, and namespace if given.
 
         :rtype: XmppElement
         """
-        for c in self.children:
-            if c.tag == tag:
-                return c
-        return None
+        children = self.children
+        if len(children) < 4:
+            for c in children:
+                if c.tag == tag and (xmlns is None or c.xmlns == xmlns):
+                    return c
+            return None
 
-    def toXml(self, indent=0):
-        spaces = " " * indent
-        attributes = ""
-        for a in self.attributes.getNames():
-            attributes += "{0}={1} ".format(a, self.attributes.getValue(a))
-        result = spaces + "<{0} {1}".format(self.tag, attributes).strip()
-        if self.children or self.text:
-            result += ">\n"
-            for child in self.children:
-                result += child.toXml(indent=indent + 4)
-            if self.text:
-                result += " " * (indent + 4) + self.text + "\n"
-            result += spaces + "</{0}>\n".format(self.tag)
-        else:
-            result += "/>\n"
+        index = self.child_index
+        if index is None:
+            index = {}
+            for c in reversed(children):
+                index[c.tag] = c
+                index[(c.tag, c.xmlns)] = c
+            self.child_index = index
+        if xmlns is None:
+            return index.get(tag)
+        return index.get((tag, xmlns))
+
+    def iter_xml(self, pretty=False, indent=0):
+        # type: (bool, int) -> Iterator[str]
+        """
+        Yields the element as XML, in chunks, with attribute values and text
+        escaped. Works through the tree with a stack rather than recursion,
+        so the cost is linear in the size of the element however deeply it
+        is nested.
+
+        Compact output has no whitespace between elements, as sent on the
+        wire. Pretty output puts every element on its own line, starting
+        `indent` spaces in and indenting each level by four more.
+        """
+        newline = "\n" if pretty else ""
+        stack = [(self, indent)]
+        pop = stack.pop
+        push = stack.append
+        while stack:
+            element, spaces = pop()
+            if spaces is None:
+                # A closing tag pushed below the element's children
+                yield element
+                continue
 
-        return result
\ No newline at end of file
+            prefix = " " * spaces if pretty else ""
+            tag = element.tag
+            attributes = element.attributes
+            if attributes:
+                start = prefix + "<" + tag + "".join([
+                    " " + name + "='" + escape_attribute(value) + "'"
+                    for name, value in attributes.items()
+                ])
+            else:
+                start = prefix + "<" + tag
+
+            children = element.children
+            text = element.text
+            if not children:
+                if text:
+                    yield start + ">" + escape_text(text) + "</" + tag + ">" + \
+                        newline
+                else:
+                    yield start + "/>" + newline
+                continue
+
+            yield start + ">" + newline
+            if text:
+                if pretty:
+                    yield " " * (spaces + 4) + escape_text(text) + newline
+                else:
+                    yield escape_text(text)
+            push((prefix + "</" + tag + ">" + newline, None))
+            for child in reversed(children):
+                push((child, spaces + 4))
+
+    def write_xml(self, stream, pretty=False):
+        """
+        Writes the element as XML to a text stream, such as `io.StringIO`.
+        """
+        write = stream.write
+        for chunk in self.iter_xml(pretty):
+            write(chunk)
+
+    def to_bytes(self):
+        # type: () -> bytes
+        """
+        Returns the element as compact, encoded XML, ready to be sent.
+        """
+        return "".join(self.iter_xml()).encode()
+
+    def toXml(self, indent=0):
+        return "".join(self.iter_xml(True, indent))
@@ -1,13 +1,71 @@
+import asyncio
 import base64
+import hashlib
 import logging
+import time
 import uuid
-from xml.sax import make_parser
-from xml.sax.saxutils import escape
 
-from xmppcontenthandler import XmppContentHandler
+import scram
+import streammanagement
+import xmppstanzas
+from xmppcontenthandler import StanzaQueue, XmppTreeReader
+from xmppmetrics import XmppMetrics
+from xmpprequests import RequestTracker
+from xmpprouter import StanzaRouter
+from xmppstreamreader import XmppStreamReader
+from xmpptrace import LazyXml, StanzaTracer
 
 logger = logging.getLogger(__name__)
 
+BIND_NAMESPACE = "urn:ietf:params:xml:ns:xmpp-bind"
+TLS_NAMESPACE = "urn:ietf:params:xml:ns:xmpp-tls"
+SASL_NAMESPACE = "urn:ietf:params:xml:ns:xmpp-sasl"
+SESSION_NAMESPACE = "urn:ietf:params:xml:ns:xmpp-session"
+
+# Types of the IQs the server sends as requests of its own, rather than in
+# response to ours
+IQ_REQUEST_TYPES = ("get", "set")
+
+# The features servers offered, by host and stage of the login ("initial",
+# "tls" or "authenticated"), shared by all handlers so that later logins to
+# the same server can be pipelined
+KNOWN_FEATURES = {}
+
+
+class StreamFeatures(object):
+    """
+    What a server offers in its stream features, as far as logging in is
+    concerned. `mechanisms` is None when the server doesn't list any, and
+    `session` is None when it isn't offered, otherwise "required" or
+    "optional" (current servers leave it out or mark it optional).
+    """
+    __slots__ = ("starttls", "mechanisms", "bind", "session", "sm")
+
+    def __init__(self, element=None):
+        self.starttls = False
+        self.mechanisms = None
+        self.bind = False
+        self.session = None
+        self.sm = False
+        if element is not None:
+            self.read(element)
+
+    def read(self, element):
+        self.starttls = element.find_child_with_tag(
+            "starttls", TLS_NAMESPACE) is not None
+        mechanisms = element.find_child_with_tag("mechanisms", SASL_NAMESPACE)
+        if mechanisms is not None:
+            self.mechanisms = tuple(child.text for child in mechanisms.children
+                                    if child.tag == "mechanism")
+        self.bind = element.find_child_with_tag(
+            "bind", BIND_NAMESPACE) is not None
+        session = element.find_child_with_tag("session", SESSION_NAMESPACE)
+        if session is not None:
+            optional = session.find_child_with_tag("optional") is not None
+            self.session = "optional" if optional else "required"
+        self.sm = element.find_child_with_tag(
+            "sm", streammanagement.NAMESPACE) is not None
+
 
 class XmppHandler(object):
     """
@@ -20,42 +78,221 @@ class XmppHandler(object):
     The `handle_raw_response` method takes raw incoming data (presumably from a
     socket), parses it as XML, and responds to it as per the XMPP protocols. It
     does this with a combination of a state-machine (for the negotiation logic)
-    and a request/callback system (for "bind" and "session" stuff).
+    and a request/callback system (for "bind" and "session" stuff). The state
+    machine is a `StanzaRouter`, with a route for every (state, tag) the
+    negotiation expects, and more routes can be added with `add_route`.
+    IQ requests from the server (get and set), and responses matching none
+    of ours, go through the router too.
+
+    It logs in with the first of `mechanisms` the server offers: SCRAM
+    (SHA-256 or SHA-1) or PLAIN. The keys SCRAM derives from the password
+    are cached in `scram_keys`, shared by all handlers by default, and
+    derived in a thread when they aren't there yet.
+
+    With `use_tls` set, the stream is upgraded with STARTTLS before logging
+    in. The owner does the upgrade itself, in `start_tls`, as only it has
+    the transport.
+
+    With `stream_management` set to a `StreamManagement`, stream management
+    (XEP-0198) is enabled once logged in, when the server offers it: the
+    stanzas sent are kept until the server acks them. The owner keeps the
+    `StreamManagement` for the next connection, and gives it to that
+    connection's handler, which then resumes the stream right after
+    authenticating and sends again what the server never got, rather than
+    binding a new one. `resumed` says which happened, in `handle_logged_in`.
+
+    With `pipeline_login` set, it doesn't wait for answers it can do without.
+    Once a server's features are known, from an earlier login to it (they
+    are kept in `known_features`, shared by all handlers by default), every
+    new stream is started together with the next step of the login, rather
+    than once the features arrive. Bind, session (left out when the server
+    says it is optional), stream management and initial presence all go out
+    together, and the login is done once the bind result is back. That is
+    two round trips from connecting to logging in with PLAIN, rather than
+    five. If the server turns out to have changed, the login fails and the
+    features are forgotten, so the next login goes step by step. How many
+    round trips each login state took to reach is recorded in the metrics,
+    along with the time.
+
+    With `connect_component` it logs in as an external component (XEP-0114)
+    instead, with a handshake, after which stanzas can be sent and received
+    for any JID in the component's domain. The methods that send stanzas
+    take the sending JID (and nick, for rooms) to allow for that.
 
     In addition to that, methods like `method`, `groupchat` and `subject`, etc.
     perform direct `send` ops, where the (initially null) implementation of
     `send` is plugged-in by some configuration activity e.g. monkey-patched by
-    the owning `XmppConnection`.
+    the owning `XmppConnection`. Stanzas are built as bytes from the
+    templates in `xmppstanzas`, and when `coalesce_writes` is set, all the
+    stanzas sent in one iteration of the event loop go out in a single `send`.
+    When the owner sets `outbound` to an `OutboundQueue`, stanzas go through
+    it instead, by priority and at the rate it allows, and the owner calls
+    `pause_writing` and `resume_writing` as the transport's buffer fills up
+    and drains. Callers can wait for room with `drain`, or check
+    `is_congested`.
+
+    Incoming data can be read with one of two engines, selected with the
+    `reader` argument (or `default_reader` for all handlers):
+
+    * "sax" builds a full `XmppElement` tree for every stanza with an
+      `XmppTreeReader`, which drives an `XmppContentHandler` (a SAX
+      `ContentHandler`) straight from expat
+    * "pull" uses an `XmppStreamReader`, which only decodes the tag and
+      attributes of a stanza and builds the rest on demand, once logged in
     """
 
-    def __init__(self):
+    READERS = ("sax", "pull")
+
+    # SASL mechanisms, in order of preference
+    MECHANISMS = tuple(scram.MECHANISMS) + ("PLAIN",)
+
+    # States the stream never leaves
+    FINAL_STATES = ("closed", "auth_failed")
+
+    # States whose time from the start of the stream is recorded in the
+    # metrics
+    LOGIN_STATES = (
+        "waiting_for_features",
+        "starting_tls",
+        "tls_handshake",
+        "authenticating",
+        "authenticated_waiting_for_stream",
+        "authenticated_waiting_for_features",
+        "binding",
+        "resuming",
+        "waiting_for_handshake",
+        "ready",
+        "auth_failed",
+    )
+    default_reader = "sax"
+
+    def __init__(self, reader=None, queue=None, metrics=None):
         self.host = None
         self.username = None
         self.nick = None
         self.jid = None
         self.password = None
 
+        # Encoded once per connection for use in outgoing stanzas
+        self.username_bytes = b""
+        self.jid_bytes = b""
+        self.nick_bytes = b""
+
+        # The domain when logged in as a component
+        self.component = None
+
+        # Whether to upgrade the stream with STARTTLS, which the owner does in
+        # `start_tls`, and whether it has been
+        self.use_tls = False
+        self.tls_active = False
+
+        # The SASL mechanisms to log in with, in order of preference, and the
+        # SCRAM exchange in progress
+        self.mechanisms = self.MECHANISMS
+        self.scram_keys = scram.KEYS
+        self.scram = None
+
+        # Stream management state, set by the owner to enable it, whether it
+        # is counting the stanzas sent on this connection, whether the server
+        # has enabled it, after which the stanzas received are counted too,
+        # and whether the stream was resumed rather than bound anew. With
+        # `outbound`, `sm_enabling` says <enable/> is still queued, and only
+        # what goes out after it is counted.
+        self.stream_management = None
+        self.sm_active = False
+        self.sm_enabled = False
+        self.sm_enabling = False
+        self.resumed = False
+
+        # Whether to pipeline the login, and the server features to do it
+        # with. `features` are those of the current stream, and while
+        # `features_pending` is set they were taken from `known_features`,
+        # and the ones the server sends are still to come.
+        self.pipeline_login = False
+        self.known_features = KNOWN_FEATURES
+        self.features = None
+        self.features_pending = False
+        self.authenticated = False
+
+        # Round trips so far: answers from the server to something sent
+        # since the last one
+        self.round_trips = 0
+        self.awaiting_reply = False
+
         self.id = uuid.uuid4().hex
 
-        # Tracks where we are in the "state machine"
+        # Logs whole stanzas in and out when enabled, which is normally only
+        # done for the odd connection being debugged. Owners may replace this
+        # with a tracer of their own that outlives the connection.
+        self.tracer = StanzaTracer(self.id)
+
+        # Counters and timings, usually shared by all the connections of a
+        # process
+        self.metrics = metrics if metrics is not None else XmppMetrics()
+
+        # Tracks where we are in the "state machine", and when each state was
+        # first reached (by `time.perf_counter`)
         self.state = "initial"
+        self.state_times = {}
+        self.stream_started = None
+
+        # Futures waiting for the state machine to reach a given state
+        self.state_waiters = {}
 
-        # An XML parser for reading incoming XMPP data
-        self.parser = make_parser()
+        self.reader = reader or self.default_reader
+        if self.reader not in self.READERS:
+            raise ValueError("Unknown reader: {0}".format(self.reader))
 
-        # Plugs into the parser, and gives us a queue of XML elements
-        self.content_handler = None
+        # Parsed stanzas waiting to be dispatched. This outlives the content
+        # handler, which is replaced every time the stream is restarted.
+        self.queue = queue if queue is not None else StanzaQueue()
 
-        # Holds callback functions for all currently outstanding requests by ID
-        self.requests = {}
+        # The most stanzas dispatched in one go before yielding to the event
+        # loop, or None to always drain the queue. When this is set and the
+        # queue fills up, reading is paused until it has been drained.
+        self.dispatch_batch = None
+        self.dispatch_scheduled = False
+        self.reading_paused = False
+
+        # Outgoing stanzas waiting to be flushed. When `coalesce_writes` is
+        # set they are collected until the next iteration of the event loop,
+        # otherwise every stanza is sent right away.
+        self.coalesce_writes = False
+        self.output = []
+        self.flush_scheduled = False
+
+        # Flow control for outgoing stanzas, set by the owner to enable it,
+        # with the timer to flush again once the rate allows, whether the
+        # transport has asked us to stop writing, and callers of `drain`
+        # waiting for that to end
+        self.outbound = None
+        self.flush_timer = None
+        self.writing_paused = False
+        self.drain_waiters = []
+
+        # Reads incoming XMPP data into the queue. Readers only hold an XML
+        # parser while a stanza is coming in, and share them otherwise.
+        if self.reader == "pull":
+            self.parser = XmppStreamReader(self.queue)
+        else:
+            self.parser = XmppTreeReader(self.queue)
+
+        # Holds callbacks and futures for all currently outstanding requests
+        # by ID. Requests are expired after `request_timeout` seconds, and at
+        # most `max_pending_requests` may be outstanding through `query`.
+        self.requests = RequestTracker(self.metrics)
+        self.request_timeout = 30.0
+        self.max_pending_requests = 32
+        self.request_slots = None
 
         # A simple perpetually increasing ID for tracking requests
         self.next_request_id = 1
 
-        # Generic response-handler entry-point for things which aren't handled
-        # with callbacks. This hook is dynamically switchable according to our
-        # current high-level state.
-        self.handle_response = self.handle_response_state_not_ready
+        # Routes everything which isn't handled with callbacks, according to
+        # our current high-level state. More handlers can be added with
+        # `add_route`.
+        self.router = StanzaRouter()
+        self.add_stream_routes()
 
         # These don't seem to be strictly necessary
         self.stream_element = None
@@ -68,174 +305,648 @@ class XmppHandler(object):
         self.jid = self.username
         self.password = password
 
-        self.state = "waiting_for_stream"
+        self.username_bytes = xmppstanzas.attribute(self.username)
+        self.jid_bytes = self.username_bytes
+        self.nick_bytes = xmppstanzas.attribute(self.nick)
+
+        self.metrics.connections += 1
+        self.state_times = {}
+        self.round_trips = 0
+        self.stream_started = time.perf_counter()
+        self.set_state("waiting_for_stream")
+        self.start_stream()
+        self.negotiate_known_features()
+
+    def connect_component(self, domain, secret):
+        """
+        Logs in as the external component for `domain`.
+        """
+        self.host = domain
+        self.component = domain
+        self.username = domain
+        self.nick = domain
+        self.jid = domain
+        self.password = secret
+
+        self.username_bytes = xmppstanzas.attribute(domain)
+        self.jid_bytes = self.username_bytes
+        self.nick_bytes = self.username_bytes
+
+        self.metrics.connections += 1
+        self.state_times = {}
+        self.round_trips = 0
+        self.stream_started = time.perf_counter()
+        self.set_state("waiting_for_component_stream")
         self.start_stream()
 
     def start_stream(self):
         self.parser.reset()
-        self.content_handler = XmppContentHandler()
-        self.parser.setContentHandler(self.content_handler)
-        template = "<?xml version='1.0'?>" \
-                   "<stream:stream to='{0}' version='1.0' " \
-                   "xmlns='jabber:client' " \
-                   "xmlns:stream='http://etherx.jabber.org/streams'>"
-        self.send(template.format(self.host))
+        if self.component is not None:
+            header = xmppstanzas.COMPONENT_STREAM_HEADER
+        else:
+            header = xmppstanzas.STREAM_HEADER
+        self.transmit(header % xmppstanzas.attribute(self.host))
+
+    def stage(self):
+        if self.authenticated:
+            return "authenticated"
+        return "tls" if self.tls_active else "initial"
+
+    def learn_features(self, response):
+        self.stream_features_element = response
+        self.features = StreamFeatures(response)
+        if self.pipeline_login:
+            self.known_features[(self.host, self.stage())] = self.features
+        return self.features
+
+    def forget_features(self):
+        for stage in ("initial", "tls", "authenticated"):
+            self.known_features.pop((self.host, stage), None)
+
+    def negotiate_known_features(self):
+        """
+        Carries on with the login straight after starting a stream, without
+        waiting for the features, if they are already known. Returns True if
+        it did.
+        """
+        if not self.pipeline_login:
+            return False
+        features = self.known_features.get((self.host, self.stage()))
+        if features is None:
+            return False
+        self.features = features
+        self.features_pending = True
+        if self.authenticated:
+            self.start_binding()
+        else:
+            self.negotiate()
+        return True
+
+    def handle_pipelined_stream_start(self, response):
+        self.stream_element = response
+
+    def handle_pipelined_features(self, response):
+        # Kept for next time, in case they have changed. If they have, the
+        # server is failing whatever was sent on the strength of the old ones.
+        self.features_pending = False
+        self.learn_features(response)
+
+    def choose_mechanism(self):
+        offered = ("PLAIN",)
+        features = self.features
+        if features is not None and features.mechanisms is not None:
+            offered = features.mechanisms
+        for mechanism in self.mechanisms:
+            if mechanism in offered:
+                return mechanism
+        return None
 
     def authenticate(self):
-        key = base64.b64encode(
-            "\0{0}\0{1}".format(self.nick, self.password).encode(
-                "ascii")).decode()
+        mechanism = self.choose_mechanism()
+        if mechanism is None:
+            logger.warning("No SASL mechanism in common with the server")
+            self.set_state("auth_failed")
+            self.handle_login_failed()
+            return
+        if mechanism in scram.MECHANISMS:
+            self.scram = scram.ScramClient(mechanism, self.nick, self.password)
+            key = base64.b64encode(self.scram.first_message())
+        else:
+            key = base64.b64encode(
+                "\0{0}\0{1}".format(self.nick, self.password).encode(
+                    "ascii"))
         logger.debug("Auth Key: %s", key)
-        template = "<auth xmlns='urn:ietf:params:xml:ns:xmpp-sasl' " \
-                   "mechanism='PLAIN'>{0}</auth>"
-        package = template.format(key)
-        self.state = "authenticating"
-        self.send(package)
+        package = xmppstanzas.AUTH % (mechanism.encode(), key)
+        self.set_state("authenticating")
+        self.transmit(package)
+
+    def handle_auth_challenge(self, response):
+        client = self.scram
+        try:
+            client.read_challenge(base64.b64decode(response.text or ""))
+        except (AttributeError, ValueError, scram.ScramError) as e:
+            self.handle_scram_error(e)
+            return
+        keys = self.scram_keys.get(client.hash_name, self.password,
+                                   client.salt, client.iterations)
+        if keys is not None:
+            self.send_scram_response(keys)
+            return
+        # Which takes a while, so the loop carries on meanwhile
+        future = self.scram_keys.derive(client.hash_name, self.password,
+                                        client.salt, client.iterations)
+        future.add_done_callback(
+            lambda future: self.handle_scram_keys(client, future))
+
+    def handle_scram_keys(self, client, future):
+        if self.scram is not client or self.state != "authenticating":
+            # Gone meanwhile
+            return
+        if future.cancelled() or future.exception() is not None:
+            self.handle_scram_error(future.exception())
+            return
+        self.send_scram_response(future.result())
+
+    def send_scram_response(self, keys):
+        self.transmit(xmppstanzas.SASL_RESPONSE % base64.b64encode(
+            self.scram.final_message(keys)))
+
+    def handle_scram_error(self, error):
+        logger.warning("SCRAM failed: %s", error)
+        self.scram = None
+        self.set_state("auth_failed")
+        self.handle_login_failed()
+
+    def start_binding(self):
+        sm = self.stream_management
+        if sm is not None and sm.resumable and sm.id is not None:
+            if self.features.sm:
+                self.resume_stream()
+                return
+            sm.reset()
+        self.bind()
 
     def bind(self):
-        template = "<bind xmlns='urn:ietf:params:xml:ns:xmpp-bind'>" \
-                   "<resource>{0}</resource>" \
-                   "</bind>"
-        request = template.format(self.id)
+        self.set_state("binding")
+        request = xmppstanzas.BIND % self.id.encode()
         self.issue_request(request, "set", self.handle_bind)
+        if self.pipeline_login:
+            # Nothing else needs the JID bind returns, and the server handles
+            # it all in order
+            if self.features.session == "required":
+                self.issue_request(xmppstanzas.SESSION, "set", None)
+            self.enable_stream_management()
+            self.send_initial_presence()
 
     def handle_bind(self, response):
         logger.debug("Got response to bind")
-        if response.children[0].tag == "bind":
-            bind = response.children[0]
-            if bind.children[0].tag == "jid":
-                self.jid = bind.children[0].text
+        bind = response.find_child_with_tag("bind", BIND_NAMESPACE)
+        if bind is not None:
+            jid = bind.find_child_with_tag("jid")
+            if jid is not None:
+                self.jid = jid.text
+                self.jid_bytes = xmppstanzas.attribute(self.jid)
                 logger.debug("JID is %s", self.jid)
-        self.start_session()
+        if self.pipeline_login:
+            self.finish_login()
+        else:
+            self.start_session()
 
     def start_session(self):
-        template = "<session xmlns='urn:ietf:params:xml:ns:xmpp-session'/>"
-        request = template.format(self.host)
-        self.issue_request(request, "set", self.handle_session)
+        self.issue_request(xmppstanzas.SESSION, "set", self.handle_session)
 
     def handle_session(self, response):
+        self.enable_stream_management()
         self.send_initial_presence()
-        self.state = "ready"
+        self.finish_login()
+
+    def finish_login(self):
+        if self.sm_active:
+            self.stream_management.jid = self.jid
+        self.set_state("ready")
+        self.handle_logged_in()
+
+    def enable_stream_management(self):
+        sm = self.stream_management
+        if sm is None or not self.features.sm:
+            return
+        sm.reset()
+        self.transmit(xmppstanzas.ENABLE_SM)
+        # The server counts what we send from the moment it gets <enable/>,
+        # and what it sends from when it answers with <enabled/>
+        self.sm_active = True
+        self.sm_enabling = self.outbound is not None
+
+    def handle_sm_enabled(self, response):
+        sm = self.stream_management
+        self.sm_enabled = True
+        sm.id = response.attributes.get("id")
+        sm.resumable = response.attributes.get("resume") in ("true", "1")
+        logger.debug("Stream management enabled, id %s", sm.id)
+
+    def handle_sm_failed(self, response):
+        logger.warning("The server wouldn't enable stream management")
+        self.sm_active = False
+        self.sm_enabled = False
+        self.stream_management.reset()
+
+    def resume_stream(self):
+        sm = self.stream_management
+        self.set_state("resuming")
+        self.transmit(xmppstanzas.RESUME_SM % (
+            sm.handled, xmppstanzas.attribute(sm.id)))
+
+    def handle_resumed(self, response):
+        sm = self.stream_management
+        h = streammanagement.parse_count(response.attributes.get("h"))
+        if h is None or not sm.acknowledge(h):
+            logger.warning("Bad count of stanzas handled on resuming: %s",
+                           response.attributes.get("h"))
+        self.jid = sm.jid
+        self.jid_bytes = xmppstanzas.attribute(self.jid)
+        self.resumed = True
+        self.sm_active = True
+        self.sm_enabled = True
+        self.metrics.count_resumption("resumed")
+        # Whatever the server never got, in the order it was first sent
+        unacked = sm.take_unacked()
+        self.metrics.stanzas_resent += len(unacked)
+        self.resend(unacked)
+        self.set_state("ready")
+        self.handle_logged_in()
+
+    def handle_resume_failed(self, response):
+        lost = self.stream_management.reset()
+        logger.info("Couldn't resume the stream, %d stanzas lost", lost)
+        self.metrics.count_resumption("failed")
+        # Which is where we would have been without trying. The server
+        # handles what was pipelined after <resume/> as it would without.
+        self.bind()
+
+    def handle_ack_request(self, response):
+        if self.sm_active:
+            self.transmit(xmppstanzas.SM_ACK %
+                          self.stream_management.handled)
+
+    def handle_ack(self, response):
+        if not self.sm_active:
+            return
+        h = streammanagement.parse_count(response.attributes.get("h"))
+        if h is None or not self.stream_management.acknowledge(h):
+            logger.warning("Bad stream management ack: %s",
+                           response.attributes.get("h"))
 
     def send_initial_presence(self):
-        package = "<presence><show/></presence>"
-        self.send(package)
-
-    def message(self, receiver, text):
-        template = "<message from='{0}' to='{1}' xml:lang='en'>" \
-                   "<body>{2}</body>" \
-                   "</message>"
-        package = template.format(self.username, receiver, escape(text))
-        self.send(package)
-
-    def groupchat(self, receiver, text):
-        template = "<message from='{0}' to='{1}' " \
-                   "type='groupchat' xml:lang='en'><body>{2}</body></message>"
-        package = template.format(self.username, receiver, escape(text))
-        self.send(package)
+        self.transmit(xmppstanzas.INITIAL_PRESENCE)
+
+    def message(self, receiver, text, sender=None):
+        self.transmit(xmppstanzas.MESSAGE % (
+            xmppstanzas.attribute(sender) if sender else self.username_bytes,
+            xmppstanzas.attribute(receiver),
+            xmppstanzas.text(text)
+        ))
+
+    def groupchat(self, receiver, text, sender=None):
+        self.transmit(xmppstanzas.GROUPCHAT % (
+            xmppstanzas.attribute(sender) if sender else self.username_bytes,
+            xmppstanzas.attribute(receiver),
+            xmppstanzas.text(text)
+        ))
 
     def subject(self, receiver, text):
-        template = "<message from='{0}' to='{1}' type='groupchat' " \
-                   "xml:lang='en'><subject>{2}</subject></message>"
-        package = template.format(self.username, receiver, escape(text))
-        self.send(package)
+        self.transmit(xmppstanzas.SUBJECT % (
+            self.username_bytes,
+            xmppstanzas.attribute(receiver),
+            xmppstanzas.text(text)
+        ))
 
     def handle_raw_response(self, response):
-        logger.debug("Recv: %s", response)
+        """
+        Takes the raw bytes as read from the socket. They are handed straight
+        to the parser, which decodes them incrementally, so a multi-byte
+        character may be split between reads.
+        """
+        logger.debug("Recv: %d bytes", len(response))
+        if self.awaiting_reply:
+            self.awaiting_reply = False
+            self.round_trips += 1
+        metrics = self.metrics
+        metrics.reads += 1
+        metrics.bytes_in += len(response)
+        start = time.perf_counter_ns()
         self.parser.feed(response)
-        while len(self.content_handler.queue):
-            element = self.content_handler.queue.pop()
-            logger.debug("State: %s - Popped Response:\n%s", self.state,
-                         element.toXml())
-            if element.tag == "iq":
-                # Handle an "iq" ("Info/Query") response by using its
-                # "id" to locate the relevant callback.
-                request_id = element.attributes.getValue("id")
-                try:
-                    callback = self.requests[request_id]
-                    if callback:
-                        callback(element)
-                    del self.requests[request_id]
-                except KeyError:
-                    logger.warning("No callback found for request %s",
-                                   request_id)
-            else:
-                # All other elements are handled generically via a state-machine
-                result = self.handle_response(element)
-                if not result:
-                    logger.warning("Unhandled response\n%s", element.toXml())
+        metrics.parse_time.record((time.perf_counter_ns() - start) // 1000)
+        self.process_queue()
+
+    def process_queue(self):
+        self.dispatch_scheduled = False
+        queue = self.queue
+        if self.state in self.FINAL_STATES:
+            # Nothing is handled once the stream is over, e.g. what was left
+            # of a batch when the connection was lost
+            queue.clear()
+            return
+        budget = self.dispatch_batch
+        while len(queue):
+            if budget is not None:
+                if budget == 0:
+                    break
+                budget -= 1
+            self.dispatch(queue.pop())
+
+        if len(queue):
+            if queue.is_full() and not self.reading_paused:
+                self.reading_paused = True
+                queue.pauses += 1
+                self.pause_reading()
+            if not self.dispatch_scheduled:
+                self.dispatch_scheduled = True
+                asyncio.get_event_loop().call_soon(self.process_queue)
+        elif self.reading_paused:
+            self.reading_paused = False
+            self.resume_reading()
+
+    def dispatch(self, element):
+        if self.tracer.enabled:
+            self.tracer.trace_received(element, self.state)
+        metrics = self.metrics
+        metrics.count_in(element.tag)
+        # Not counting the stanza that enables stream management, e.g. the
+        # response to starting the session
+        counted = self.sm_enabled and \
+            element.tag in streammanagement.STANZA_TAGS
+        start = time.perf_counter_ns()
+        pending = None
+        if element.tag == "iq" and \
+                element.attributes.get("type") not in IQ_REQUEST_TYPES:
+            # Handle an "iq" ("Info/Query") response by using its
+            # "id" to locate the relevant callback.
+            request_id = element.attributes.get("id")
+            pending = self.requests.resolve(request_id, element)
+            if pending is not None:
+                metrics.iq_rtt.record((start - pending.started) // 1000)
+            elif not self.router.dispatch(self.state, element):
+                logger.warning("No callback found for request %s",
+                               request_id)
+        # All other elements, and requests from the server, are handled
+        # generically via a state-machine
+        elif not self.router.dispatch(self.state, element):
+            logger.warning("Unhandled response\n%s", LazyXml(element))
+        if counted:
+            self.stream_management.received()
+        metrics.dispatch_time.record(
+            (time.perf_counter_ns() - start) // 1000)
 
-    def handle_response_state_not_ready(self, response):
+    def add_stream_routes(self):
+        route = self.router.add
+
+        # Negotiating the stream
+        route(self.handle_stream_start, state="waiting_for_stream")
+        route(self.handle_features, state="waiting_for_features",
+              tag="stream:features")
+        route(self.handle_tls_proceed, state="starting_tls", tag="proceed")
+        route(self.handle_tls_failure, state="starting_tls", tag="failure")
+        route(self.handle_auth_challenge, state="authenticating",
+              tag="challenge")
+        route(self.handle_auth_success, state="authenticating", tag="success")
+        route(self.handle_auth_failure, state="authenticating", tag="failure")
+        route(self.handle_authenticated_stream_start,
+              state="authenticated_waiting_for_stream", tag="stream:stream")
+        route(self.handle_authenticated_features,
+              state="authenticated_waiting_for_features",
+              tag="stream:features")
+
+        # The stream header and features of a stream whose login went ahead
+        # without them
+        pending = lambda response: self.features_pending
+        route(self.handle_pipelined_stream_start, tag="stream:stream",
+              filter=pending)
+        route(self.handle_pipelined_features, tag="stream:features",
+              filter=pending)
+
+        # Stream management
+        sm = streammanagement.NAMESPACE
+        route(self.handle_resumed, state="resuming", tag="resumed")
+        route(self.handle_resume_failed, state="resuming", tag="failed",
+              xmlns=sm)
+        route(self.handle_sm_enabled, state="ready", tag="enabled")
+        route(self.handle_sm_failed, state="ready", tag="failed", xmlns=sm)
+        route(self.handle_ack_request, tag="r", xmlns=sm)
+        route(self.handle_ack, tag="a", xmlns=sm)
+
+        # Logging in as a component
+        route(self.handle_component_stream_start,
+              state="waiting_for_component_stream", tag="stream:stream")
+        route(self.handle_handshake, state="waiting_for_handshake",
+              tag="handshake")
+        route(self.handle_handshake_failure, state="waiting_for_handshake",
+              tag="stream:error")
+
+        # Once ready. The hooks are looked up on every call, so they can still
+        # be replaced after the routes have been added.
+        route(lambda response: self.handle_message(response),
+              state="ready", tag="message")
+        route(lambda response: self.handle_presence(response),
+              state="ready", tag="presence")
+        route(self.handle_stream_closed, state="ready", tag="stream:closed")
+        route(lambda response: self.handle_stream_error(response),
+              state="ready", tag="stream:error")
+
+    def add_route(self, handler, tag=None, type=None, state="ready",
+                  xmlns=None, filter=None):
+        """
+        Calls `handler` with every stanza matching the given tag, type and
+        namespace that arrives in the given state (by default, once logged
+        in). None matches anything. The namespace is the element's own
+        `xmlns`, which only elements outside stanzas carry (e.g. those for
+        stream management), so stanzas are told apart by the namespace of
+        their payload with a `with_payload` filter. If given, `filter` is
+        called with each matching stanza and the handler is only called when
+        it returns True.
+
+        Returns the route, for `remove_route`.
+        """
+        return self.router.add(handler, state, tag, type, xmlns, filter)
+
+    def remove_route(self, route):
+        self.router.remove(route)
+
+    def handle_stream_start(self, response):
+        if response.tag == "stream:stream":
+            self.stream_element = response
+            self.set_state("waiting_for_features")
+        else:
+            logger.warning("Expected stream:stream tag")
+
+    def handle_features(self, response):
+        self.learn_features(response)
+        self.negotiate()
+
+    def negotiate(self):
+        if self.use_tls and not self.tls_active:
+            if not self.features.starttls:
+                logger.warning("The server doesn't offer STARTTLS")
+                self.set_state("auth_failed")
+                self.handle_login_failed()
+                return
+            self.set_state("starting_tls")
+            self.transmit(xmppstanzas.STARTTLS)
+            return
+        self.authenticate()
+
+    def handle_tls_proceed(self, response):
+        self.set_state("tls_handshake")
+        self.start_tls()
+
+    def handle_tls_failure(self, response):
+        logger.warning("The server refused to start TLS")
+        self.forget_features()
+        self.set_state("auth_failed")
+        self.handle_login_failed()
+
+    def handle_tls_established(self):
         """
-        Return True iff the response was 'handled' (including as an error?),
-        otherwise False
+        Call this once `start_tls` has upgraded the connection, to start
+        the stream again over TLS.
         """
-        if self.state == "waiting_for_stream":
-            if response.tag == "stream:stream":
-                self.stream_element = response
-                self.state = "waiting_for_features"
-                return True
+        self.tls_active = True
+        self.set_state("waiting_for_stream")
+        self.start_stream()
+        self.negotiate_known_features()
+
+    def handle_auth_success(self, response):
+        if self.scram is not None:
+            try:
+                self.scram.verify(base64.b64decode(response.text or ""))
+            except (ValueError, scram.ScramError) as e:
+                self.handle_scram_error(e)
+                return
+            self.scram = None
+        self.authenticated = True
+        self.start_stream()
+        if not self.negotiate_known_features():
+            self.set_state("authenticated_waiting_for_stream")
+
+    def handle_auth_failure(self, response):
+        logger.warning("Failed to log in")
+        self.forget_features()
+        self.scram = None
+        self.set_state("auth_failed")
+        self.handle_login_failed()
+
+    def handle_component_stream_start(self, response):
+        self.stream_element = response
+        digest = hashlib.sha1((response.attributes.get("id", "") +
+                               self.password).encode()).hexdigest()
+        self.transmit(xmppstanzas.HANDSHAKE % digest.encode())
+        self.set_state("waiting_for_handshake")
+
+    def handle_handshake(self, response):
+        self.set_state("ready")
+        self.handle_logged_in()
+
+    def handle_handshake_failure(self, response):
+        logger.warning("Component handshake failed")
+        self.set_state("auth_failed")
+        self.handle_login_failed()
+
+    def handle_authenticated_stream_start(self, response):
+        self.stream_element = response
+        logger.debug("Logged in with id: %s",
+                     response.attributes.getValue("id"))
+        self.set_state("authenticated_waiting_for_features")
+
+    def handle_authenticated_features(self, response):
+        self.learn_features(response)
+        self.start_binding()
+
+    def handle_stream_closed(self, response):
+        self.set_state("closed")
+        self.handle_closed()
+
+    def set_state(self, state):
+        self.state = state
+        if self.reader == "pull":
+            # Logging in looks into every stanza, which the pull reader
+            # would otherwise parse a second time to build
+            self.parser.build_elements = state != "ready"
+        now = time.perf_counter()
+        # Some states come round again, e.g. after STARTTLS
+        if state not in self.state_times:
+            self.state_times[state] = now
+            if state in self.LOGIN_STATES and self.stream_started is not None:
+                self.metrics.record_phase(state, now - self.stream_started,
+                                          self.round_trips)
+        waiters = self.state_waiters.pop(state, None)
+        if waiters:
+            for future in waiters:
+                if not future.done():
+                    future.set_result(state)
+
+        if state in self.FINAL_STATES and self.state_waiters:
+            # Nobody is getting anywhere from here
+            waiters = self.state_waiters
+            self.state_waiters = {}
+            for expected, futures in waiters.items():
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(ConnectionError(
+                            "Stream {0} while waiting for {1}".format(
+                                state, expected)))
+
+    async def wait_for_state(self, state):
+        """
+        Waits until the state machine reaches `state`. Raises ConnectionError
+        if the stream ends up in one of the `FINAL_STATES` instead.
+        """
+        if self.state == state:
+            return state
+        if self.state in self.FINAL_STATES:
+            raise ConnectionError("Stream {0}".format(self.state))
+        future = asyncio.get_event_loop().create_future()
+        self.state_waiters.setdefault(state, []).append(future)
+        return await future
+
+    def wait_ready(self):
+        return self.wait_for_state("ready")
+
+    def connection_lost(self):
+        # Call this when the underlying connection goes away, to release
+        # anything waiting for the stream
+        if self.state not in self.FINAL_STATES:
+            self.set_state("closed")
+        if self.outbound is not None:
+            self.keep_outbound()
+        self.sm_active = False
+        self.sm_enabled = False
+        self.sm_enabling = False
+        # Nowhere to send it now. With stream management, the stanzas are
+        # kept to send again when the stream is resumed.
+        self.output = []
+        if self.flush_timer is not None:
+            self.flush_timer.cancel()
+            self.flush_timer = None
+        self.writing_paused = False
+        # Stanzas read but not yet dispatched, which nothing would handle now
+        self.queue.clear()
+        self.dispatch_scheduled = False
+        self.reading_paused = False
+        self.requests.fail_all(ConnectionError("Connection lost"))
+        waiters = self.drain_waiters
+        self.drain_waiters = []
+        for future in waiters:
+            if not future.done():
+                future.set_exception(ConnectionError("Connection lost"))
+
+    def keep_outbound(self):
+        # With stream management, stanzas that were still waiting to be sent
+        # are kept with the ones the server hasn't acked, to send on resuming
+        # the stream. Otherwise they are lost, as they are if <enable/> was
+        # never sent.
+        dropped = 0
+        keep = self.sm_active and not self.sm_enabling
+        for package in self.outbound.take_all():
+            if keep and streammanagement.is_stanza(package):
+                self.stream_management.sent(package)
             else:
-                logger.warning("Expected stream:stream tag")
-                return True
-
-        elif self.state == "waiting_for_features":
-            if response.tag == "stream:features":
-                self.stream_features_element = response
-                self.authenticate()
-                return True
-
-        elif self.state == "authenticating":
-            if response.tag == "success":
-                self.start_stream()
-                self.state = "authenticated_waiting_for_stream"
-                return True
-            elif response.tag == "failure":
-                logger.warning("Failed to log in")
-                return True
-
-        elif self.state == "authenticated_waiting_for_stream":
-            if response.tag == "stream:stream":
-                self.stream_element = response
-                logger.debug("Logged in with id: %s",
-                             response.attributes.getValue("id"))
-                self.state = "authenticated_waiting_for_features"
-                return True
-
-        elif self.state == "authenticated_waiting_for_features":
-            if response.tag == "stream:features":
-                self.stream_features_element = response
-                self.bind()
-                return True
-
-        elif self.state == "ready":
-            self.handle_logged_in()
-            self.handle_response = self.handle_response_state_ready
-            return self.handle_response_state_ready(response)
-
-    def handle_response_state_ready(self, response):
-        if response.tag == "message":
-            self.handle_message(response)
-            return True
-
-        elif response.tag == "presence":
-            self.handle_presence(response)
-            return True
-
-        elif response.tag == "stream:closed":
-            self.state = "closed"
-            self.handle_response = self.handle_response_state_not_ready
-            self.handle_closed()
-            return True
-
-        elif response.tag == "stream:error":
-            self.handle_stream_error(response)
-            return True
+                dropped += 1
+        self.metrics.outbound_dropped += dropped
 
     def handle_logged_in(self):
         # Override this to handle notification of successful login
         pass
 
+    def handle_login_failed(self):
+        # Override this to handle the server refusing to log us in
+        pass
+
+    def start_tls(self):
+        # Override this to upgrade the connection to TLS after STARTTLS, and
+        # call `handle_tls_established` once done
+        logger.warning("Can't start TLS on this connection")
+        self.set_state("auth_failed")
+        self.handle_login_failed()
+
     def handle_message(self, response):
         # Override this to handle message stanzas
         pass
@@ -252,47 +963,277 @@ class XmppHandler(object):
         # Override this to handle stream errors
         pass
 
+    def transmit(self, package):
+        if isinstance(package, str):
+            package = package.encode()
+        outbound = self.outbound
+        if outbound is not None and not outbound.put(package):
+            self.metrics.outbound_dropped += 1
+            logger.debug("Outbound queue full, dropped: %s", package)
+            return
+        if self.tracer.enabled:
+            self.tracer.trace_sent(package)
+        self.awaiting_reply = True
+        if outbound is not None:
+            # Counted once it is actually written, in `flush_outbound`
+            if not self.flush_scheduled:
+                self.flush_scheduled = True
+                asyncio.get_event_loop().call_soon(self.flush)
+            return
+        request_ack = self.sm_active and \
+            streammanagement.is_stanza(package) and \
+            self.stream_management.sent(package)
+        self.metrics.count_out(package)
+        if not self.coalesce_writes:
+            self.metrics.writes += 1
+            self.send(package)
+        else:
+            self.output.append(package)
+            if not self.flush_scheduled:
+                self.flush_scheduled = True
+                asyncio.get_event_loop().call_soon(self.flush)
+        if request_ack:
+            self.transmit(xmppstanzas.SM_REQUEST)
+
+    def resend(self, packages):
+        """
+        Sends stanzas again, in order, like those the server never got before
+        the stream was resumed. With `outbound`, they go ahead of anything
+        queued since, at the rate it allows, and none are dropped.
+        """
+        outbound = self.outbound
+        if outbound is None:
+            for package in packages:
+                self.transmit(package)
+            return
+        if self.tracer.enabled:
+            for package in packages:
+                self.tracer.trace_sent(package)
+        outbound.replay(packages)
+        self.awaiting_reply = True
+        if packages and not self.flush_scheduled:
+            self.flush_scheduled = True
+            asyncio.get_event_loop().call_soon(self.flush)
+
+    def close_stream(self):
+        """
+        Ends the stream cleanly, which also tells the server not to keep it
+        for resuming. The owner closes the connection.
+        """
+        self.sm_active = False
+        self.sm_enabling = False
+        if self.outbound is not None:
+            # Rather than all at once, over the server's rate limit
+            self.metrics.outbound_dropped += self.outbound.clear()
+        self.transmit(xmppstanzas.STREAM_END)
+        self.flush()
+
+    def send_element(self, element):
+        """
+        Sends a parsed element or stanza as it is, for example to re-send or
+        forward one that was received.
+        """
+        self.transmit(element.to_bytes())
+
+    def flush(self):
+        self.flush_scheduled = False
+        if self.outbound is not None:
+            self.flush_outbound()
+            return
+        output = self.output
+        if not output:
+            return
+        self.output = []
+        self.metrics.writes += 1
+        if len(output) == 1:
+            self.send(output[0])
+        else:
+            self.send(b"".join(output))
+
+    def flush_outbound(self):
+        """
+        Sends what `outbound` allows now, and sets a timer for the rest.
+        Stanzas are counted, in the metrics and for stream management, as
+        they are actually sent: their priority may have changed the order,
+        and some may never be.
+        """
+        if self.flush_timer is not None:
+            self.flush_timer.cancel()
+            self.flush_timer = None
+        outbound = self.outbound
+        if not len(outbound) or self.writing_paused:
+            return
+        metrics = self.metrics
+        metrics.outbound_depth.record(len(outbound))
+        loop = asyncio.get_event_loop()
+        packages = outbound.take(loop.time())
+        if self.sm_active:
+            packages = self.track_sent(packages)
+        if packages:
+            for package in packages:
+                metrics.count_out(package)
+            metrics.writes += 1
+            if len(packages) == 1:
+                self.send(packages[0])
+            else:
+                self.send(b"".join(packages))
+        if len(outbound):
+            metrics.outbound_throttled += 1
+            self.flush_timer = loop.call_later(outbound.wait,
+                                               self.flush_outbound)
+        if self.drain_waiters:
+            self.wake_drain_waiters()
+
+    def track_sent(self, packages):
+        # Keeps the stanzas among `packages` until they are acked, asking
+        # for acks in between as needed. While <enable/> is queued, what was
+        # queued before it goes out ahead of it, and the server doesn't count
+        # that.
+        start = 0
+        if self.sm_enabling:
+            if xmppstanzas.ENABLE_SM not in packages:
+                return packages
+            self.sm_enabling = False
+            start = packages.index(xmppstanzas.ENABLE_SM) + 1
+        sm = self.stream_management
+        tracked = packages[:start]
+        for package in packages[start:]:
+            tracked.append(package)
+            if streammanagement.is_stanza(package) and sm.sent(package):
+                tracked.append(xmppstanzas.SM_REQUEST)
+        return tracked
+
+    def is_congested(self):
+        """
+        Whether anything sent now would only wait, or be dropped: the
+        transport has asked us to stop writing, or `outbound` is full.
+        """
+        return self.writing_paused or \
+            (self.outbound is not None and self.outbound.is_full())
+
+    async def drain(self):
+        """
+        Waits until the connection isn't congested, for callers to send no
+        faster than it can take. Raises ConnectionError if the connection is
+        lost meanwhile.
+        """
+        while self.is_congested():
+            future = asyncio.get_event_loop().create_future()
+            self.drain_waiters.append(future)
+            await future
+
+    def wake_drain_waiters(self):
+        if self.is_congested():
+            return
+        waiters = self.drain_waiters
+        self.drain_waiters = []
+        for future in waiters:
+            if not future.done():
+                future.set_result(None)
+
+    def pause_writing(self):
+        """
+        Called by the owner when the transport's buffer is over its
+        high-water mark. What is queued in `outbound` waits, and so do
+        callers of `drain`, until `resume_writing`.
+        """
+        if not self.writing_paused:
+            self.writing_paused = True
+            self.metrics.write_pauses += 1
+
+    def resume_writing(self):
+        self.writing_paused = False
+        if self.outbound is not None:
+            self.flush_outbound()
+        if self.drain_waiters:
+            self.wake_drain_waiters()
+
     def send(self, package):
-        # Override this to send data
+        # Override this to send data (bytes)
         pass
 
-    def issue_request(self, request, request_type, callback, to=None):
+    def pause_reading(self):
+        # Override this to stop reading from the transport while the stanza
+        # queue is full
+        pass
+
+    def resume_reading(self):
+        # Override this to resume reading once the stanza queue has drained
+        pass
+
+    def issue_request(self, request, request_type, callback, to=None,
+                      timeout=None, future=None):
         request_id = self.get_request_id()
         if to is not None:
-            to_clause = "to='{0}'".format(to)
+            to_clause = xmppstanzas.IQ_TO % xmppstanzas.attribute(to)
         else:
-            to_clause = ""
-        package = "<iq id='{0}' type='{1}' from='{2}' {3}>{4}</iq>".format(
-            request_id, request_type, self.jid, to_clause, request)
-        self.requests[request_id] = callback
-        self.send(package)
+            to_clause = b""
+        if isinstance(request, str):
+            request = request.encode()
+        package = xmppstanzas.IQ % (
+            request_id.encode(),
+            request_type.encode(),
+            self.jid_bytes,
+            to_clause,
+            request
+        )
+        if timeout is None:
+            timeout = self.request_timeout
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Without an event loop there is nothing to expire requests
+            loop = None
+        self.requests.add(request_id, callback, future, timeout, loop)
+        self.transmit(package)
         return request_id
 
-    def join_room(self, room, password=""):
+    async def query(self, request, request_type="get", to=None, timeout=None):
+        """
+        Sends an IQ request and waits for the response element.
+
+        Raises `XmppRequestError` if the response is an error, TimeoutError
+        if there is no response within `timeout` (or `request_timeout`)
+        seconds, and ConnectionError if the connection is lost meanwhile.
+        Waits for a free slot first if `max_pending_requests` are already
+        outstanding.
+        """
+        if self.request_slots is None:
+            self.request_slots = asyncio.Semaphore(self.max_pending_requests)
+        async with self.request_slots:
+            future = asyncio.get_running_loop().create_future()
+            request_id = self.issue_request(
+                request, request_type, None, to, timeout, future)
+            try:
+                return await future
+            except asyncio.CancelledError:
+                self.requests.cancel(request_id)
+                raise
+
+    def join_room(self, room, password="", jid=None, nick=None):
         request_id = self.get_request_id()
         if password:
-            password_element = "<password>{0}</password>".format(password)
+            password_element = xmppstanzas.ROOM_PASSWORD % \
+                               xmppstanzas.text(password)
         else:
-            password_element = ""
-        template = "<presence from='{0}' id='{1}' to='{2}/{3}'>" \
-                   "<x xmlns='http://jabber.org/protocol/muc'>{4}</x>" \
-                   "</presence>"
-        package = template.format(
-            self.jid,
-            request_id,
-            room,
-            self.nick,
+            password_element = b""
+        self.transmit(xmppstanzas.JOIN_ROOM % (
+            xmppstanzas.attribute(jid) if jid else self.jid_bytes,
+            request_id.encode(),
+            xmppstanzas.attribute(room),
+            xmppstanzas.attribute(nick) if nick else self.nick_bytes,
             password_element
-        )
-        self.send(package)
+        ))
         return request_id
 
-    def leave_room(self, room):
+    def leave_room(self, room, jid=None, nick=None):
         request_id = self.get_request_id()
-        template = "<presence from='{0}' id='{1}' " \
-                   "to='{2}/{3}' type='unavailable'/>"
-        package = template.format(self.jid, request_id, room, self.nick)
-        self.send(package)
+        self.transmit(xmppstanzas.LEAVE_ROOM % (
+            xmppstanzas.attribute(jid) if jid else self.jid_bytes,
+            request_id.encode(),
+            xmppstanzas.attribute(room),
+            xmppstanzas.attribute(nick) if nick else self.nick_bytes
+        ))
         return request_id
 
     def get_request_id(self):
@@ -303,9 +1244,10 @@ class XmppHandler(object):
     def create_room(self, room):
         # This is just a copy of join_room for now - needs to be extended
         request_id = self.get_request_id()
-        template = "<presence from='{0}' id='{1}' to='{2}/{3}'>" \
-                   "<x xmlns='http://jabber.org/protocol/muc'/>" \
-                   "</presence>"
-        package = template.format(self.jid, request_id, room, self.nick)
-        self.send(package)
+        self.transmit(xmppstanzas.CREATE_ROOM % (
+            self.jid_bytes,
+            request_id.encode(),
+            xmppstanzas.attribute(room),
+            self.nick_bytes
+        ))
         return request_id
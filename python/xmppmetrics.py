@@ -0,0 +1,320 @@
+import re
+import time
+
+from histogram import Histogram
+
+# The tag of an outgoing stanza, skipping the XML declaration before a
+# stream header
+OUTGOING_TAG_PATTERN = re.compile(rb"(?:<\?[^>]*\?>)?<([^\s/>]+)")
+
+# The stanzas sent most, most common first, which are told apart by their
+# start alone as every outgoing stanza is counted
+COMMON_OUTGOING_TAGS = (
+    (b"<message ", "message"),
+    (b"<presence ", "presence"),
+    (b"<iq ", "iq"),
+)
+
+
+class XmppMetrics(object):
+    """
+    Counters and timings for one or more `XmppHandler` connections.
+
+    Every handler has its own to start with, but owners running many
+    connections should give them all the same one: that keeps the memory
+    used per connection down and means nothing has to be added up later.
+    Counting is a few integer operations, and timings are recorded in
+    `Histogram`s, in microseconds, so they can stay on all the time.
+
+    Login phases are the time from starting the stream to first reaching
+    each state of the negotiation, and the number of round trips to the
+    server it took. TLS handshakes are timed separately, by
+    whether the session was resumed or had to be negotiated in full, and
+    attempts to resume a stream (XEP-0198) are counted by outcome, along with
+    the stanzas sent again after resuming.
+
+    IQ requests are counted by how they ended: `completed` with a response,
+    `timed_out`, `cancelled` by the caller or `failed` with the connection,
+    along with the responses that matched no request (`unmatched`), and
+    `requests_pending` is how many are still waiting.
+
+    With an `OutboundQueue`, how many stanzas were waiting at each flush,
+    the messages dropped because too many were, the flushes that had to
+    leave some for the rate limit and the times the transport asked to stop
+    writing are recorded too.
+    """
+
+    def __init__(self):
+        self.connections = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.reads = 0
+        self.writes = 0
+        self.stanzas_in = {}
+        self.stanzas_out = {}
+        self.parse_time = Histogram()
+        self.dispatch_time = Histogram()
+        self.iq_rtt = Histogram()
+        self.requests_pending = 0
+        self.requests = {}
+        self.login_phases = {}
+        self.login_round_trips = {}
+        self.tls_handshakes = {}
+        self.resumptions = {}
+        self.stanzas_resent = 0
+        self.outbound_depth = Histogram()
+        self.outbound_dropped = 0
+        self.outbound_throttled = 0
+        self.write_pauses = 0
+
+    def count_in(self, tag):
+        stanzas_in = self.stanzas_in
+        stanzas_in[tag] = stanzas_in.get(tag, 0) + 1
+
+    def count_out(self, package):
+        for prefix, tag in COMMON_OUTGOING_TAGS:
+            if package.startswith(prefix):
+                break
+        else:
+            match = OUTGOING_TAG_PATTERN.match(package)
+            tag = match.group(1).decode() if match else "unknown"
+        stanzas_out = self.stanzas_out
+        stanzas_out[tag] = stanzas_out.get(tag, 0) + 1
+        self.bytes_out += len(package)
+
+    def count_request(self, outcome):
+        """
+        Counts a request that is no longer pending, or an unmatched response.
+        """
+        if outcome != "unmatched":
+            self.requests_pending -= 1
+        self.requests[outcome] = self.requests.get(outcome, 0) + 1
+
+    def record_phase(self, state, elapsed, round_trips=None):
+        histogram = self.login_phases.get(state)
+        if histogram is None:
+            histogram = self.login_phases[state] = Histogram()
+        histogram.record(int(elapsed * 1000000))
+        if round_trips is not None:
+            histogram = self.login_round_trips.get(state)
+            if histogram is None:
+                histogram = self.login_round_trips[state] = Histogram()
+            histogram.record(round_trips)
+
+    def record_tls_handshake(self, resumed, elapsed):
+        kind = "resumed" if resumed else "full"
+        histogram = self.tls_handshakes.get(kind)
+        if histogram is None:
+            histogram = self.tls_handshakes[kind] = Histogram()
+        histogram.record(int(elapsed * 1000000))
+
+    def count_resumption(self, outcome):
+        self.resumptions[outcome] = self.resumptions.get(outcome, 0) + 1
+
+    def merge(self, other):
+        self.connections += other.connections
+        self.bytes_in += other.bytes_in
+        self.bytes_out += other.bytes_out
+        self.reads += other.reads
+        self.writes += other.writes
+        for tag, count in other.stanzas_in.items():
+            self.stanzas_in[tag] = self.stanzas_in.get(tag, 0) + count
+        for tag, count in other.stanzas_out.items():
+            self.stanzas_out[tag] = self.stanzas_out.get(tag, 0) + count
+        self.parse_time.merge(other.parse_time)
+        self.dispatch_time.merge(other.dispatch_time)
+        self.iq_rtt.merge(other.iq_rtt)
+        self.requests_pending += other.requests_pending
+        for outcome, count in other.requests.items():
+            self.requests[outcome] = self.requests.get(outcome, 0) + count
+        for state, histogram in other.login_phases.items():
+            mine = self.login_phases.get(state)
+            if mine is None:
+                mine = self.login_phases[state] = Histogram()
+            mine.merge(histogram)
+        for state, histogram in other.login_round_trips.items():
+            mine = self.login_round_trips.get(state)
+            if mine is None:
+                mine = self.login_round_trips[state] = Histogram()
+            mine.merge(histogram)
+        for kind, histogram in other.tls_handshakes.items():
+            mine = self.tls_handshakes.get(kind)
+            if mine is None:
+                mine = self.tls_handshakes[kind] = Histogram()
+            mine.merge(histogram)
+        for outcome, count in other.resumptions.items():
+            self.resumptions[outcome] = \
+                self.resumptions.get(outcome, 0) + count
+        self.stanzas_resent += other.stanzas_resent
+        self.outbound_depth.merge(other.outbound_depth)
+        self.outbound_dropped += other.outbound_dropped
+        self.outbound_throttled += other.outbound_throttled
+        self.write_pauses += other.write_pauses
+
+    def snapshot(self):
+        """
+        Everything as plain data, e.g. for JSON. Timings are in seconds.
+        """
+        return {
+            "time": time.time(),
+            "connections": self.connections,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "reads": self.reads,
+            "writes": self.writes,
+            "stanzas_in": dict(self.stanzas_in),
+            "stanzas_out": dict(self.stanzas_out),
+            "parse_time": summarize(self.parse_time),
+            "dispatch_time": summarize(self.dispatch_time),
+            "iq_rtt": summarize(self.iq_rtt),
+            "requests_pending": self.requests_pending,
+            "requests": dict(self.requests),
+            "login_phases": {
+                state: summarize(histogram)
+                for state, histogram in self.login_phases.items()
+            },
+            "login_round_trips": {
+                state: summarize(histogram, 1)
+                for state, histogram in self.login_round_trips.items()
+            },
+            "tls_handshakes": {
+                kind: summarize(histogram)
+                for kind, histogram in self.tls_handshakes.items()
+            },
+            "resumptions": dict(self.resumptions),
+            "stanzas_resent": self.stanzas_resent,
+            "outbound_depth": summarize(self.outbound_depth, 1),
+            "outbound_dropped": self.outbound_dropped,
+            "outbound_throttled": self.outbound_throttled,
+            "write_pauses": self.write_pauses,
+        }
+
+
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+
+def summarize(histogram, scale=1e-6):
+    """
+    Count, sum and quantiles of a histogram, scaled (from microseconds to
+    seconds by default).
+    """
+    return {
+        "count": histogram.total,
+        "sum": histogram.sum * scale,
+        "quantiles": {
+            str(q): (histogram.percentile(q * 100) or 0) * scale
+            for q in QUANTILES
+        },
+    }
+
+
+class PrometheusWriter(object):
+    """
+    Renders metrics in the Prometheus text exposition format.
+    """
+
+    def __init__(self):
+        self.lines = []
+        self.described = set()
+
+    def describe(self, name, metric_type, help_text):
+        if name not in self.described:
+            self.described.add(name)
+            self.lines.append("# HELP {0} {1}".format(name, help_text))
+            self.lines.append("# TYPE {0} {1}".format(name, metric_type))
+
+    def sample(self, name, value, labels=None):
+        if labels:
+            name += "{" + ",".join(
+                '{0}="{1}"'.format(key, escape_label(value))
+                for key, value in sorted(labels.items())) + "}"
+        self.lines.append("{0} {1}".format(name, format_value(value)))
+
+    def counter(self, name, value, help_text, labels=None):
+        self.describe(name, "counter", help_text)
+        self.sample(name, value, labels)
+
+    def gauge(self, name, value, help_text, labels=None):
+        self.describe(name, "gauge", help_text)
+        self.sample(name, value, labels)
+
+    def summary(self, name, histogram, help_text, labels=None, scale=1e-6):
+        self.describe(name, "summary", help_text)
+        labels = labels or {}
+        for q in QUANTILES:
+            value = histogram.percentile(q * 100)
+            self.sample(name, (value or 0) * scale,
+                        dict(labels, quantile=str(q)))
+        self.sample(name + "_sum", histogram.sum * scale, labels)
+        self.sample(name + "_count", histogram.total, labels)
+
+    def add_xmpp_metrics(self, metrics):
+        self.counter("xmpp_connections_total", metrics.connections,
+                     "Connections started")
+        self.counter("xmpp_received_bytes_total", metrics.bytes_in,
+                     "Bytes received")
+        self.counter("xmpp_sent_bytes_total", metrics.bytes_out,
+                     "Bytes sent")
+        self.counter("xmpp_reads_total", metrics.reads, "Reads from sockets")
+        self.counter("xmpp_writes_total", metrics.writes, "Writes to sockets")
+        for tag, count in sorted(metrics.stanzas_in.items()):
+            self.counter("xmpp_received_stanzas_total", count,
+                         "Stanzas received", {"tag": tag})
+        for tag, count in sorted(metrics.stanzas_out.items()):
+            self.counter("xmpp_sent_stanzas_total", count, "Stanzas sent",
+                         {"tag": tag})
+        self.summary("xmpp_parse_seconds", metrics.parse_time,
+                     "Time spent parsing each read")
+        self.summary("xmpp_dispatch_seconds", metrics.dispatch_time,
+                     "Time spent handling each stanza")
+        self.summary("xmpp_iq_rtt_seconds", metrics.iq_rtt,
+                     "Round-trip time of IQ requests")
+        self.gauge("xmpp_pending_requests", metrics.requests_pending,
+                   "IQ requests waiting for a response")
+        for outcome, count in sorted(metrics.requests.items()):
+            self.counter("xmpp_requests_total", count,
+                         "IQ requests by how they ended, and responses to "
+                         "no request (unmatched)", {"outcome": outcome})
+        for state, histogram in sorted(metrics.login_phases.items()):
+            self.summary("xmpp_login_phase_seconds", histogram,
+                         "Time from starting the stream to each login state",
+                         {"state": state})
+        for state, histogram in sorted(metrics.login_round_trips.items()):
+            self.summary("xmpp_login_round_trips", histogram,
+                         "Round trips to the server from starting the stream "
+                         "to each login state", {"state": state}, scale=1)
+        for kind, histogram in sorted(metrics.tls_handshakes.items()):
+            self.summary("xmpp_tls_handshake_seconds", histogram,
+                         "Time taken by STARTTLS handshakes, full or resumed",
+                         {"kind": kind})
+        for outcome, count in sorted(metrics.resumptions.items()):
+            self.counter("xmpp_stream_resumptions_total", count,
+                         "Attempts to resume a stream, by outcome",
+                         {"outcome": outcome})
+        self.counter("xmpp_resent_stanzas_total", metrics.stanzas_resent,
+                     "Stanzas sent again after resuming a stream")
+        self.summary("xmpp_outbound_queue_depth", metrics.outbound_depth,
+                     "Stanzas waiting in the outbound queue at each flush",
+                     scale=1)
+        self.counter("xmpp_outbound_dropped_total", metrics.outbound_dropped,
+                     "Stanzas dropped because the outbound queue was full "
+                     "or the connection was lost")
+        self.counter("xmpp_outbound_throttled_total",
+                     metrics.outbound_throttled,
+                     "Flushes that left stanzas waiting for the rate limit")
+        self.counter("xmpp_write_pauses_total", metrics.write_pauses,
+                     "Times the transport's buffer filled up")
+
+    def render(self):
+        return "\n".join(self.lines) + "\n"
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"") \
+        .replace("\n", "\\n")
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return "{0:.9g}".format(value)
+    return str(value)
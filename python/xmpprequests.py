@@ -0,0 +1,201 @@
+import heapq
+import itertools
+import logging
+import time
+import weakref
+
+from xmppmetrics import XmppMetrics
+
+logger = logging.getLogger(__name__)
+
+
+class XmppRequestError(Exception):
+    """
+    Raised when an IQ request gets a response of type 'error'.
+    """
+
+    def __init__(self, response):
+        Exception.__init__(self, "Request {0} failed".format(
+            response.attributes.get("id")))
+        self.response = response
+
+
+def callback_name(callback):
+    return getattr(callback, "__qualname__", None) or repr(callback)
+
+
+class PendingRequest(object):
+    __slots__ = ("request_id", "callback", "future", "deadline", "done",
+                 "started")
+
+    def __init__(self, request_id, callback=None, future=None, deadline=None):
+        self.request_id = request_id
+        self.callback = callback
+        self.future = future
+        self.deadline = deadline
+        self.done = False
+        self.started = time.perf_counter_ns()
+
+
+class RequestTimer(object):
+    """
+    Expires pending requests for every connection on an event loop, using a
+    single heap of deadlines and a single loop timer for the earliest one.
+
+    Requests that complete in time are not removed from the heap; their
+    entries are simply skipped when their deadline comes up.
+    """
+    timers = weakref.WeakKeyDictionary()
+
+    @classmethod
+    def for_loop(cls, loop):
+        timer = cls.timers.get(loop)
+        if timer is None:
+            timer = cls(loop)
+            cls.timers[loop] = timer
+        return timer
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.heap = []
+        self.sequence = itertools.count()
+        self.handle = None
+        self.handle_deadline = None
+
+    def __len__(self):
+        return len(self.heap)
+
+    def add(self, tracker, pending):
+        heapq.heappush(
+            self.heap, (pending.deadline, next(self.sequence), tracker, pending))
+        if self.handle_deadline is None or \
+                pending.deadline < self.handle_deadline:
+            self.schedule()
+
+    def schedule(self):
+        if self.handle is not None:
+            self.handle.cancel()
+        self.handle_deadline = self.heap[0][0]
+        self.handle = self.loop.call_at(self.handle_deadline, self.fire)
+
+    def fire(self):
+        self.handle = None
+        self.handle_deadline = None
+        now = self.loop.time()
+        heap = self.heap
+        while heap and heap[0][0] <= now:
+            deadline, sequence, tracker, pending = heapq.heappop(heap)
+            if not pending.done:
+                tracker.expire(pending)
+        if heap:
+            self.schedule()
+
+
+class RequestTracker(object):
+    """
+    Keeps track of outstanding IQ requests for one connection, by ID.
+
+    Each request completes either with a callback, a future, or both. Requests
+    with a timeout are expired by the `RequestTimer` for the loop, and the
+    counters here show how requests have fared: those still pending when the
+    connection is lost are `failed`, and only those given up on by the caller
+    are `cancelled`. They are counted in `metrics` as well, with the number
+    of requests pending, for all the connections sharing it.
+
+    Callbacks are only ever called with a response, so a request that times
+    out or fails with just a callback is logged with the callback's name, as
+    nothing else will hear about it.
+    """
+
+    def __init__(self, metrics=None):
+        self.pending = {}
+        self.metrics = metrics if metrics is not None else XmppMetrics()
+
+        self.issued = 0
+        self.completed = 0
+        self.timed_out = 0
+        self.cancelled = 0
+        self.failed = 0
+        self.unmatched = 0
+
+    def __len__(self):
+        return len(self.pending)
+
+    def __contains__(self, request_id):
+        return request_id in self.pending
+
+    def add(self, request_id, callback=None, future=None, timeout=None,
+            loop=None):
+        pending = PendingRequest(request_id, callback, future)
+        self.pending[request_id] = pending
+        self.issued += 1
+        self.metrics.requests_pending += 1
+        if timeout is not None and loop is not None:
+            pending.deadline = loop.time() + timeout
+            RequestTimer.for_loop(loop).add(self, pending)
+        return pending
+
+    def resolve(self, request_id, response):
+        """
+        Completes the request with the given response, and returns it. Returns
+        None if there is no such request.
+        """
+        pending = self.pending.pop(request_id, None)
+        if pending is None:
+            self.unmatched += 1
+            self.metrics.count_request("unmatched")
+            return None
+        pending.done = True
+        self.completed += 1
+        self.metrics.count_request("completed")
+        if pending.callback:
+            pending.callback(response)
+        future = pending.future
+        if future is not None and not future.done():
+            if response.attributes.get("type") == "error":
+                future.set_exception(XmppRequestError(response))
+            else:
+                future.set_result(response)
+        return pending
+
+    def expire(self, pending):
+        if self.pending.get(pending.request_id) is not pending:
+            return
+        del self.pending[pending.request_id]
+        pending.done = True
+        self.timed_out += 1
+        self.metrics.count_request("timed_out")
+        if pending.future is None and pending.callback is not None:
+            logger.warning("Request %s timed out, %s won't be called",
+                           pending.request_id, callback_name(pending.callback))
+        else:
+            logger.warning("Request %s timed out", pending.request_id)
+        if pending.future is not None and not pending.future.done():
+            pending.future.set_exception(TimeoutError(
+                "Request {0} timed out".format(pending.request_id)))
+
+    def cancel(self, request_id):
+        pending = self.pending.pop(request_id, None)
+        if pending is None:
+            return False
+        pending.done = True
+        self.cancelled += 1
+        self.metrics.count_request("cancelled")
+        if pending.future is not None:
+            pending.future.cancel()
+        return True
+
+    def fail_all(self, exception):
+        pending_requests = self.pending
+        self.pending = {}
+        for pending in pending_requests.values():
+            pending.done = True
+            self.failed += 1
+            self.metrics.count_request("failed")
+            if pending.future is not None:
+                if not pending.future.done():
+                    pending.future.set_exception(exception)
+            elif pending.callback is not None:
+                logger.warning("Request %s failed (%s), %s won't be called",
+                               pending.request_id, exception,
+                               callback_name(pending.callback))
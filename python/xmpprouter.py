@@ -0,0 +1,250 @@
+import itertools
+from functools import lru_cache
+
+
+class Route(object):
+    """
+    A handler registered with a `StanzaRouter`, and what it matches. None
+    matches anything.
+    """
+    __slots__ = ("handler", "state", "tag", "type", "xmlns", "filter")
+
+    def __init__(self, handler, state=None, tag=None, type=None, xmlns=None,
+                 filter=None):
+        self.handler = handler
+        self.state = state
+        self.tag = tag
+        self.type = type
+        self.xmlns = xmlns
+        self.filter = filter
+
+
+class StanzaRouter(object):
+    """
+    Dispatches stanzas to handlers registered for a combination of stream
+    state, tag, type and namespace, any of which can be left out to match
+    everything. The namespace is the element's own `xmlns` attribute, which
+    only the elements outside stanzas have, such as those for SASL or stream
+    management: messages, presences and IQs never carry one, and are told
+    apart by their payload with a `with_payload` filter instead.
+
+    Registrations are compiled into a table by the state and tag of a
+    stanza, holding every handler that applies, in the order they were
+    added. Each combination is only worked out the first time a stanza has
+    it, with values no route mentions standing for None, so dispatch is one
+    dictionary lookup however many handlers there are. Only where some
+    route for the state and tag mentions a type or namespace are those
+    looked up too, in a second table of `KeyedRoutes`. At most
+    `max_table_size` combinations are kept in each table, so a peer sending
+    ever new tags or types can't grow them without bound. Only routes with
+    a `filter` cost anything extra, and only for the stanzas that reach
+    them.
+
+    Handlers are called with the stanza. Filters are called with the stanza
+    too, and the handler is skipped unless the filter returns True.
+    """
+
+    max_table_size = 1024
+
+    def __init__(self):
+        self.routes = []
+
+        # Compiled from `routes` on the first dispatch after a change
+        self.table = None
+        self.layout = None
+        self.entries = None
+
+    def __len__(self):
+        return len(self.routes)
+
+    def add(self, handler, state=None, tag=None, type=None, xmlns=None,
+            filter=None):
+        """
+        Registers a handler and returns its `Route`, which can be passed to
+        `remove` later.
+        """
+        route = Route(handler, state, tag, type, xmlns, filter)
+        self.routes.append(route)
+        self.table = None
+        return route
+
+    def remove(self, route):
+        self.routes.remove(route)
+        self.table = None
+
+    def compile(self):
+        routes = self.routes
+        self.layout = compile_layout(tuple(
+            (r.state, r.tag, r.type, r.xmlns) for r in routes))
+        self.entries = [(r.handler, r.filter) for r in routes]
+        self.table = {}
+
+    def dispatch(self, state, stanza):
+        """
+        Calls every handler that matches the stanza in the given state.
+        Returns True if there were any.
+        """
+        table = self.table
+        if table is None:
+            self.compile()
+            table = self.table
+        key = (state, stanza.tag)
+        matching = table.get(key)
+        if matching is None:
+            matching = self.lookup(key)
+            if len(table) < self.max_table_size:
+                table[key] = matching
+        if matching.__class__ is KeyedRoutes:
+            matching = matching.select(stanza)
+        if not matching:
+            return False
+        handled = False
+        for handler, filter in matching:
+            if filter is None or filter(stanza):
+                handler(stanza)
+                handled = True
+        return handled
+
+    def lookup(self, key):
+        """
+        The handlers for a state and tag, or the `KeyedRoutes` to pick them
+        from by type and namespace.
+        """
+        state, tag = self.layout.general(key)
+        types, namespaces = self.layout.varies(state, tag)
+        if types or namespaces:
+            return KeyedRoutes(self, state, tag, types, namespaces)
+        return self.match((state, tag, None, None))
+
+    def match(self, key):
+        entries = self.entries
+        return tuple(entries[i] for i in self.layout.match(key))
+
+
+class KeyedRoutes(object):
+    """
+    The handlers for a state and tag of a `StanzaRouter` where some route
+    mentions a type or namespace, by those of the stanza.
+    """
+    __slots__ = ("router", "state", "tag", "types", "namespaces", "table")
+
+    def __init__(self, router, state, tag, types, namespaces):
+        self.router = router
+        self.state = state
+        self.tag = tag
+        self.types = types
+        self.namespaces = namespaces
+        self.table = {}
+
+    def select(self, stanza):
+        attributes = stanza.attributes
+        key = (attributes.get("type") if self.types else None,
+               attributes.get("xmlns") if self.namespaces else None)
+        matching = self.table.get(key)
+        if matching is None:
+            layout = self.router.layout
+            matching = self.router.match((self.state, self.tag) + (
+                key[0] if key[0] in layout.types else None,
+                key[1] if key[1] in layout.namespaces else None))
+            if len(self.table) < self.router.max_table_size:
+                self.table[key] = matching
+        return matching
+
+
+class RouteLayout(object):
+    """
+    Which routes, by index, apply to each combination of state, tag, type
+    and namespace. A combination is matched by the routes whose key is the
+    same but for None in some places, so working one out takes at most 16
+    lookups of routes by their exact key, whatever the number of routes.
+    Combinations are worked out as they come up and kept, along with
+    whether the routes for each state and tag mention types or namespaces.
+    """
+
+    def __init__(self, keys):
+        self.states = frozenset(key[0] for key in keys) - {None}
+        self.tags = frozenset(key[1] for key in keys) - {None}
+        self.types = frozenset(key[2] for key in keys) - {None}
+        self.namespaces = frozenset(key[3] for key in keys) - {None}
+
+        self.routes = {}
+        self.keyed = {}
+        for i, key in enumerate(keys):
+            self.routes.setdefault(key, []).append(i)
+            if key[2] is not None or key[3] is not None:
+                self.keyed.setdefault(key[:2], []).append(key)
+        self.matches = {}
+        self.variations = {}
+
+    def general(self, key):
+        """
+        The state and tag with any no route mentions as None.
+        """
+        state, tag = key
+        return (state if state in self.states else None,
+                tag if tag in self.tags else None)
+
+    def varies(self, state, tag):
+        """
+        Whether routes matching the state and tag mention types and
+        namespaces.
+        """
+        variation = self.variations.get((state, tag))
+        if variation is None:
+            types = namespaces = False
+            for general in itertools.product(
+                    *((None,) if value is None else (value, None)
+                      for value in (state, tag))):
+                for key in self.keyed.get(general, ()):
+                    types = types or key[2] is not None
+                    namespaces = namespaces or key[3] is not None
+            variation = self.variations[(state, tag)] = (types, namespaces)
+        return variation
+
+    def match(self, key):
+        indices = self.matches.get(key)
+        if indices is None:
+            found = []
+            routes = self.routes
+            for general in itertools.product(
+                    *((None,) if value is None else (value, None)
+                      for value in key)):
+                found.extend(routes.get(general, ()))
+            indices = self.matches[key] = tuple(sorted(found))
+        return indices
+
+
+@lru_cache(maxsize=64)
+def compile_layout(keys):
+    """
+    The `RouteLayout` for the given route keys. Every connection usually has
+    the same routes, so this is cached and shared, and only the handlers are
+    filled in per router.
+    """
+    return RouteLayout(keys)
+
+
+def from_bare_jid(jid):
+    """
+    A filter for stanzas from the given bare JID, such as a room, whatever
+    their resource.
+    """
+    prefix = jid + "/"
+
+    def filter(stanza):
+        sender = stanza.attributes.get("from")
+        return sender is not None and (
+            sender == jid or sender.startswith(prefix))
+    return filter
+
+
+def with_payload(xmlns):
+    """
+    A filter for stanzas with a child element in the given namespace.
+    """
+    def filter(stanza):
+        for child in stanza.children:
+            if child.xmlns == xmlns:
+                return True
+        return False
+    return filter
@@ -0,0 +1,948 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+import base64
+import hashlib
+import logging
+import sys
+import time
+import uuid
+from collections import deque
+
+import scram
+import streammanagement
+import xmppstanzas
+import xmpptls
+from connectionscheduler import TokenBucket
+from xmppstreamreader import XmppStreamReader
+
+logger = logging.getLogger(__name__)
+
+STREAM_HEADER = b"<?xml version='1.0'?>" \
+                b"<stream:stream xmlns:stream='http://etherx.jabber.org/streams' " \
+                b"version='1.0' from='%s' id='%s' xml:lang='en' " \
+                b"xmlns='jabber:client'>"
+
+COMPONENT_NAMESPACE = "jabber:component:accept"
+
+COMPONENT_STREAM_HEADER = b"<?xml version='1.0'?>" \
+                          b"<stream:stream " \
+                          b"xmlns:stream='http://etherx.jabber.org/streams' " \
+                          b"from='%s' id='%s' xmlns='jabber:component:accept'>"
+
+HANDSHAKE = b"<handshake/>"
+
+NOT_AUTHORIZED = b"<stream:error><not-authorized " \
+                 b"xmlns='urn:ietf:params:xml:ns:xmpp-streams'/>" \
+                 b"</stream:error>"
+
+POLICY_VIOLATION = b"<stream:error><policy-violation " \
+                   b"xmlns='urn:ietf:params:xml:ns:xmpp-streams'/>" \
+                   b"</stream:error>"
+
+STREAM_END = b"</stream:stream>"
+
+FEATURES = b"<stream:features>%s</stream:features>"
+
+MECHANISMS = b"<mechanisms xmlns='urn:ietf:params:xml:ns:xmpp-sasl'>" \
+             b"%s</mechanisms>"
+
+MECHANISM = b"<mechanism>%s</mechanism>"
+
+SUPPORTED_MECHANISMS = ("PLAIN",) + tuple(scram.MECHANISMS)
+
+STARTTLS_FEATURE = b"<starttls xmlns='urn:ietf:params:xml:ns:xmpp-tls'>" \
+                   b"%s</starttls>"
+
+TLS_REQUIRED = b"<required/>"
+
+PROCEED = b"<proceed xmlns='urn:ietf:params:xml:ns:xmpp-tls'/>"
+
+TLS_FAILURE = b"<failure xmlns='urn:ietf:params:xml:ns:xmpp-tls'/>"
+
+BIND_FEATURES = b"<bind xmlns='urn:ietf:params:xml:ns:xmpp-bind'/>" \
+                b"<session xmlns='urn:ietf:params:xml:ns:xmpp-session'>" \
+                b"<optional/></session>"
+
+SM_FEATURE = b"<sm xmlns='urn:xmpp:sm:3'/>"
+
+ENABLED = b"<enabled xmlns='urn:xmpp:sm:3' id='%s' resume='true' max='%d'/>"
+
+ENABLED_WITHOUT_RESUME = b"<enabled xmlns='urn:xmpp:sm:3'/>"
+
+RESUMED = b"<resumed xmlns='urn:xmpp:sm:3' h='%d' previd='%s'/>"
+
+SM_FAILED = b"<failed xmlns='urn:xmpp:sm:3'>" \
+            b"<item-not-found xmlns='urn:ietf:params:xml:ns:xmpp-stanzas'/>" \
+            b"</failed>"
+
+SM_REQUEST = b"<r xmlns='urn:xmpp:sm:3'/>"
+
+SM_ACK = b"<a xmlns='urn:xmpp:sm:3' h='%d'/>"
+
+SUCCESS = b"<success xmlns='urn:ietf:params:xml:ns:xmpp-sasl'/>"
+
+SUCCESS_DATA = b"<success xmlns='urn:ietf:params:xml:ns:xmpp-sasl'>" \
+               b"%s</success>"
+
+CHALLENGE = b"<challenge xmlns='urn:ietf:params:xml:ns:xmpp-sasl'>" \
+            b"%s</challenge>"
+
+FAILURE = b"<failure xmlns='urn:ietf:params:xml:ns:xmpp-sasl'>" \
+          b"<not-authorized/></failure>"
+
+ENCRYPTION_REQUIRED = b"<failure xmlns='urn:ietf:params:xml:ns:xmpp-sasl'>" \
+                      b"<encryption-required/></failure>"
+
+BIND_RESULT = b"<iq id='%s' type='result'>" \
+              b"<bind xmlns='urn:ietf:params:xml:ns:xmpp-bind'>" \
+              b"<jid>%s</jid></bind></iq>"
+
+IQ_RESULT = b"<iq id='%s' type='result' to='%s'/>"
+
+ROSTER_RESULT = b"<iq id='%s' type='result' to='%s'>" \
+                b"<query xmlns='jabber:iq:roster'/></iq>"
+
+IQ_ERROR = b"<iq id='%s' type='error' to='%s'>" \
+           b"<error type='cancel'><service-unavailable " \
+           b"xmlns='urn:ietf:params:xml:ns:xmpp-stanzas'/></error></iq>"
+
+OCCUPANT_PRESENCE = b"<presence from='%s/%s' to='%s'>" \
+                    b"<x xmlns='http://jabber.org/protocol/muc#user'>" \
+                    b"<item affiliation='none' role='participant'/>%s" \
+                    b"</x></presence>"
+
+OCCUPANT_UNAVAILABLE = b"<presence from='%s/%s' to='%s' " \
+                       b"type='unavailable'>" \
+                       b"<x xmlns='http://jabber.org/protocol/muc#user'>" \
+                       b"<item affiliation='none' role='none'/>%s" \
+                       b"</x></presence>"
+
+SELF_PRESENCE = b"<status code='110'/>"
+
+GROUPCHAT = b"<message from='%s/%s' to='%s' type='groupchat'>" \
+            b"<body>%s</body></message>"
+
+HISTORY = b"<message from='%s/%s' to='%s' type='groupchat'>" \
+          b"<body>%s</body>" \
+          b"<delay xmlns='urn:xmpp:delay' from='%s' stamp='%s'/></message>"
+
+CHAT = b"<message from='%s' to='%s' type='%s'><body>%s</body></message>"
+
+
+class MucRoom(object):
+    def __init__(self, jid, history_size):
+        self.jid = jid
+        self.jid_bytes = xmppstanzas.attribute(jid)
+        self.occupants = {}
+        self.history = deque(maxlen=history_size)
+
+
+class ComponentUser(object):
+    """
+    A JID in the domain of a component connection. It joins rooms and
+    receives stanzas just like a client connection, through the component.
+    """
+    __slots__ = ("connection", "jid", "jid_bytes", "rooms")
+
+    def __init__(self, connection, jid):
+        self.connection = connection
+        self.jid = jid
+        self.jid_bytes = xmppstanzas.attribute(jid)
+        self.rooms = {}
+
+    def send(self, package):
+        self.connection.send(package)
+
+
+class XmppServerConnection(asyncio.Protocol):
+    """
+    The server side of one client connection to an `XmppServer`, or of an
+    external component (XEP-0114), whose stanzas may come from any JID in its
+    domain. Each of those JIDs gets a `ComponentUser`.
+
+    Outgoing stanzas are collected and written out in bursts of up to
+    `server.burst_size` stanzas, each write delayed by `server.latency`
+    seconds.
+
+    Once a client enables stream management (XEP-0198), its session
+    outlives the connection for `server.resume_timeout` seconds, still in
+    its rooms, with the stanzas for it kept until they are acked. A client
+    resuming it on a new connection takes over that connection's transport
+    and gets whatever it missed.
+
+    With `server.rate_limit` set, a client sending stanzas faster than that
+    gets a policy-violation stream error and is disconnected, as servers do
+    with their rate limits.
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        self.reader = XmppStreamReader()
+        self.tls_active = False
+        self.authenticated = False
+        self.scram = None
+
+        # Data that arrives over TLS before `start_tls` has the transport to
+        # answer on
+        self.tls_buffer = None
+        self.username = None
+        self.jid = None
+        self.jid_bytes = b""
+        self.rooms = {}
+        self.output = []
+        self.flush_scheduled = False
+
+        # The domain and stream ID, for a component
+        self.component = None
+        self.stream_id = None
+        self.users = {}
+
+        # Stream management, once enabled, and the timer that ends the
+        # session if it isn't resumed in time after the connection is lost
+        self.sm = None
+        self.expiry = None
+
+        # The client's allowance for sending stanzas
+        self.karma = None
+        if server.rate_limit:
+            self.karma = TokenBucket(server.rate_limit, server.rate_burst)
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.server.connections += 1
+
+    def connection_lost(self, exc):
+        self.server.connections -= 1
+        if self.sm is not None and self.sm.resumable:
+            self.transport = None
+            self.server.detached += 1
+            self.expiry = asyncio.get_event_loop().call_later(
+                self.server.resume_timeout, self.expire)
+            return
+        self.end_session()
+
+    def expire(self):
+        self.expiry = None
+        self.server.detached -= 1
+        self.end_session()
+
+    def end_session(self):
+        self.forget_stream()
+        for room_jid in list(self.rooms):
+            self.server.leave_room(self, room_jid)
+        if self.jid is not None:
+            self.server.sessions.pop(self.jid, None)
+        for user in self.users.values():
+            for room_jid in list(user.rooms):
+                self.server.leave_room(user, room_jid)
+            self.server.sessions.pop(user.jid, None)
+        self.users.clear()
+
+    def data_received(self, data):
+        if self.tls_buffer is not None:
+            self.tls_buffer.append(data)
+            return
+        self.reader.feed(data)
+        self.handle_queued()
+
+    def handle_queued(self):
+        queue = self.reader.queue
+        # Until another connection takes over on resuming its stream
+        while len(queue) and self.transport is not None:
+            self.handle_stanza(queue.pop())
+
+    def send(self, package):
+        sm = self.sm
+        request_ack = sm is not None and streammanagement.is_stanza(package) \
+            and sm.sent(package)
+        self.output.append(package)
+        if request_ack:
+            self.output.append(SM_REQUEST)
+        if len(self.output) >= self.server.burst_size:
+            self.flush()
+        elif not self.flush_scheduled:
+            self.flush_scheduled = True
+            asyncio.get_event_loop().call_soon(self.flush)
+
+    def flush(self):
+        self.flush_scheduled = False
+        if not self.output:
+            return
+        data = b"".join(self.output)
+        self.output = []
+        self.server.writes += 1
+        # Not whichever transport there is by the time it is written, which
+        # may have resumed the stream meanwhile
+        if self.server.latency:
+            asyncio.get_event_loop().call_later(
+                self.server.latency, self.write, data, self.transport)
+        else:
+            self.write(data, self.transport)
+
+    def write(self, data, transport):
+        # Without a transport, the stanzas wait to be resent on resuming
+        if transport is not None and not transport.is_closing():
+            transport.write(data)
+
+    def handle_stanza(self, stanza):
+        tag = stanza.tag
+        if self.karma is not None and tag in streammanagement.STANZA_TAGS \
+                and self.karma.take(asyncio.get_event_loop().time()):
+            self.handle_policy_violation()
+            return
+        if tag == "stream:stream":
+            self.handle_stream(stanza)
+        elif tag == "stream:closed":
+            # A clean end, so there is nothing to resume
+            self.forget_stream()
+            self.send(STREAM_END)
+            self.flush()
+            self.transport.close()
+        elif tag == "starttls":
+            self.handle_starttls(stanza)
+        elif tag == "auth":
+            self.handle_auth(stanza)
+        elif tag == "response":
+            self.handle_sasl_response(stanza)
+        elif tag == "handshake":
+            self.handle_handshake(stanza)
+        elif tag == "iq":
+            self.handle_iq(stanza)
+        elif tag == "presence":
+            self.handle_presence(stanza)
+        elif tag == "message":
+            self.handle_message(stanza)
+        elif tag == "r":
+            if self.sm is not None:
+                self.send(SM_ACK % self.sm.handled)
+        elif tag == "a":
+            self.handle_ack(stanza)
+        elif tag == "enable":
+            self.handle_enable(stanza)
+        elif tag == "resume":
+            self.handle_resume(stanza)
+        else:
+            logger.warning("Unexpected stanza: %s", tag)
+        if self.sm is not None and tag in streammanagement.STANZA_TAGS:
+            self.sm.received()
+
+    def handle_policy_violation(self):
+        logger.info("%s is sending too fast", self.jid or self.component)
+        self.server.policy_violations += 1
+        # Not to be resumed either
+        self.forget_stream()
+        self.flush()
+        # Straight away, as delayed writes are dropped once it is closed
+        self.transport.write(POLICY_VIOLATION + STREAM_END)
+        self.transport.close()
+        # Nothing more it sent is handled
+        self.transport = None
+
+    def handle_stream(self, stanza):
+        if stanza.attributes.get("xmlns") == COMPONENT_NAMESPACE:
+            self.component = stanza.attributes.get("to", "")
+            self.stream_id = uuid.uuid4().hex
+            self.send(COMPONENT_STREAM_HEADER % (
+                xmppstanzas.attribute(self.component),
+                self.stream_id.encode()))
+            return
+        self.send(STREAM_HEADER % (
+            xmppstanzas.attribute(self.server.host),
+            uuid.uuid4().hex.encode()))
+        if self.authenticated:
+            self.send(FEATURES % (BIND_FEATURES + SM_FEATURE))
+        elif self.server.tls_context is not None and not self.tls_active:
+            starttls = STARTTLS_FEATURE % (
+                TLS_REQUIRED if self.server.require_tls else b"")
+            if self.server.require_tls:
+                self.send(FEATURES % starttls)
+            else:
+                self.send(FEATURES % (starttls +
+                                      self.server.mechanisms_feature))
+        else:
+            self.send(FEATURES % self.server.mechanisms_feature)
+
+    def handle_starttls(self, stanza):
+        if self.server.tls_context is None or self.tls_active:
+            self.send(TLS_FAILURE)
+            self.send(STREAM_END)
+            self.flush()
+            self.transport.close()
+            return
+        # Straight out, as nothing else may go out over the plain connection
+        self.flush()
+        self.transport.write(PROCEED)
+        self.tls_buffer = []
+        asyncio.get_event_loop().create_task(self.start_tls())
+
+    async def start_tls(self):
+        loop = asyncio.get_event_loop()
+        transport = self.transport
+        try:
+            self.transport = await loop.start_tls(
+                transport, self, self.server.tls_context, server_side=True)
+        except OSError as e:
+            logger.warning("TLS handshake failed: %s", e)
+            self.tls_buffer = None
+            transport.close()
+            return
+        self.tls_active = True
+        if xmpptls.is_resumed(self.transport):
+            self.server.tls_resumed += 1
+        else:
+            self.server.tls_handshakes += 1
+        # The client starts a new stream over TLS, maybe already
+        self.reader.reset()
+        buffered, self.tls_buffer = self.tls_buffer, None
+        for data in buffered:
+            self.data_received(data)
+
+    def handle_auth(self, stanza):
+        if self.server.require_tls and not self.tls_active:
+            self.send(ENCRYPTION_REQUIRED)
+            return
+        mechanism = stanza.attributes.get("mechanism", "PLAIN")
+        if mechanism not in self.server.mechanisms:
+            self.send(FAILURE)
+            return
+        if mechanism in scram.MECHANISMS:
+            self.handle_scram_auth(mechanism, stanza)
+            return
+        try:
+            credentials = base64.b64decode(stanza.text or "").split(b"\0")
+            username = credentials[1].decode()
+        except (ValueError, IndexError):
+            self.send(FAILURE)
+            return
+        self.log_in(username, SUCCESS)
+
+    def handle_scram_auth(self, mechanism, stanza):
+        self.scram = scram.ScramServer(mechanism,
+                                       self.server.scram_iterations)
+        try:
+            username = self.scram.read_first_message(
+                base64.b64decode(stanza.text or ""))
+        except (ValueError, scram.ScramError):
+            self.scram = None
+            self.send(FAILURE)
+            return
+        challenge = self.scram.challenge(self.server.salt(username))
+        self.send(CHALLENGE % base64.b64encode(challenge))
+
+    def handle_sasl_response(self, stanza):
+        server = self.scram
+        if server is None:
+            self.send(FAILURE)
+            return
+        keys_cache = self.server.scram_keys
+        keys = keys_cache.get(server.hash_name, self.server.password,
+                              server.salt, server.iterations)
+        if keys is not None:
+            self.check_scram_proof(server, stanza.text, keys)
+            return
+        future = keys_cache.derive(server.hash_name, self.server.password,
+                                   server.salt, server.iterations)
+        text = stanza.text
+        future.add_done_callback(
+            lambda future: self.check_scram_proof(server, text,
+                                                  future.result()))
+
+    def check_scram_proof(self, server, text, keys):
+        if self.scram is not server or self.transport.is_closing():
+            return
+        self.scram = None
+        try:
+            outcome = server.read_final_message(
+                base64.b64decode(text or ""), keys)
+        except (ValueError, scram.ScramError) as e:
+            logger.info("SCRAM login for %s failed: %s", server.username, e)
+            self.send(FAILURE)
+            return
+        self.log_in(server.username,
+                    SUCCESS_DATA % base64.b64encode(outcome))
+
+    def log_in(self, username, success):
+        self.authenticated = True
+        self.username = username
+        self.server.logins += 1
+        self.send(success)
+        # The client restarts the stream after success
+        self.reader.reset()
+
+    def handle_enable(self, stanza):
+        if self.jid is None or self.sm is not None:
+            self.send(SM_FAILED)
+            return
+        self.sm = streammanagement.StreamManagement(self.server.max_unacked)
+        if not self.server.resume_timeout or \
+                stanza.attributes.get("resume") not in ("true", "1"):
+            self.send(ENABLED_WITHOUT_RESUME)
+            return
+        self.sm.id = uuid.uuid4().hex
+        self.sm.resumable = True
+        self.server.resumable[self.sm.id] = self
+        self.send(ENABLED % (self.sm.id.encode(),
+                             int(self.server.resume_timeout)))
+
+    def handle_ack(self, stanza):
+        if self.sm is None:
+            return
+        h = streammanagement.parse_count(stanza.attributes.get("h"))
+        if h is None or not self.sm.acknowledge(h):
+            logger.warning("Bad ack from %s: %s", self.jid,
+                           stanza.attributes.get("h"))
+
+    def handle_resume(self, stanza):
+        h = streammanagement.parse_count(stanza.attributes.get("h"))
+        previous = self.server.resumable.get(stanza.attributes.get("previd"))
+        if not self.authenticated or h is None or previous is None or \
+                previous is self or previous.username != self.username:
+            self.server.resumes_failed += 1
+            self.send(SM_FAILED)
+            return
+        previous.take_over(self, h)
+
+    def take_over(self, connection, h):
+        """
+        Carries on this connection's stream over the transport of
+        `connection`, which resumed it. `h` is how many stanzas the client
+        says it got, and the ones after that are sent again.
+        """
+        if self.expiry is not None:
+            self.expiry.cancel()
+            self.expiry = None
+            self.server.detached -= 1
+        else:
+            # We haven't noticed the old connection is gone yet
+            self.transport.set_protocol(asyncio.Protocol())
+            self.transport.abort()
+            self.server.connections -= 1
+        self.transport = connection.transport
+        self.transport.set_protocol(self)
+        self.tls_active = connection.tls_active
+        self.reader.reset()
+        self.reader = connection.reader
+        self.output = []
+        # The rate limit is per connection
+        self.karma = connection.karma
+        connection.transport = None
+
+        sm = self.sm
+        if not sm.acknowledge(h):
+            logger.warning("Bad count on resuming %s: %d", self.jid, h)
+        self.server.resumes += 1
+        self.send(RESUMED % (sm.handled, sm.id.encode()))
+        for package in sm.take_unacked():
+            self.send(package)
+        # Anything the client sent after <resume/> in the same read
+        self.handle_queued()
+
+    def forget_stream(self):
+        if self.sm is not None:
+            self.server.resumable.pop(self.sm.id, None)
+            self.sm = None
+
+    def handle_handshake(self, stanza):
+        secret = self.server.component_secret
+        if secret is not None:
+            expected = hashlib.sha1(
+                (self.stream_id + secret).encode()).hexdigest()
+            if (stanza.text or "").strip() != expected:
+                self.send(NOT_AUTHORIZED)
+                self.send(STREAM_END)
+                self.flush()
+                self.transport.close()
+                return
+        self.authenticated = True
+        self.server.logins += 1
+        self.send(HANDSHAKE)
+
+    def sender(self, stanza):
+        """
+        Who a stanza is from: the connection itself, or for a component, the
+        user in its domain the stanza says it is from.
+        """
+        if self.component is None:
+            return self
+        jid = stanza.attributes.get("from")
+        if not jid or not self.authenticated:
+            return None
+        user = self.users.get(jid)
+        if user is None:
+            if jid.split("/")[0].partition("@")[2] != self.component:
+                logger.warning("%s can't send for %s", self.component, jid)
+                return None
+            user = self.users[jid] = ComponentUser(self, jid)
+            self.server.sessions[jid] = user
+        return user
+
+    def handle_iq(self, stanza):
+        request_id = xmppstanzas.attribute(stanza.attributes.get("id", ""))
+        child = stanza.children[0] if stanza.children else None
+        if child is not None and child.tag == "bind":
+            resource = child.find_child_with_tag("resource")
+            self.jid = "{0}@{1}/{2}".format(
+                self.username, self.server.host,
+                resource.text if resource is not None else uuid.uuid4().hex)
+            self.jid_bytes = xmppstanzas.attribute(self.jid)
+            self.server.sessions[self.jid] = self
+            self.send(BIND_RESULT % (request_id, xmppstanzas.text(self.jid)))
+        elif child is not None and child.tag == "query" and \
+                child.attributes.get("xmlns") == "jabber:iq:roster":
+            self.send(ROSTER_RESULT % (request_id, self.jid_bytes))
+        elif child is None or child.tag in ("session", "ping"):
+            self.send(IQ_RESULT % (request_id, self.jid_bytes))
+        else:
+            self.send(IQ_ERROR % (request_id, self.jid_bytes))
+
+    def handle_presence(self, stanza):
+        to = stanza.attributes.get("to")
+        if not to or "/" not in to:
+            # Initial presence, or presence to contacts - nobody to tell
+            return
+        sender = self.sender(stanza)
+        if sender is None:
+            return
+        room_jid, nick = to.split("/", 1)
+        if stanza.attributes.get("type") == "unavailable":
+            self.server.leave_room(sender, room_jid)
+        else:
+            self.server.join_room(sender, room_jid, nick)
+
+    def handle_message(self, stanza):
+        to = stanza.attributes.get("to")
+        if not to:
+            return
+        body = stanza.find_child_with_tag("body")
+        if body is None:
+            return
+        sender = self.sender(stanza)
+        if sender is None:
+            return
+        text = body.text or ""
+        if stanza.attributes.get("type") == "groupchat":
+            self.server.broadcast(sender, to.split("/")[0], text)
+        else:
+            self.server.route_message(sender, to, text,
+                                      stanza.attributes.get("type", "chat"))
+
+
+class XmppServer(object):
+    """
+    A stand-in XMPP server for load tests and benchmarks.
+
+    It speaks just enough XMPP for `XmppHandler`: stream negotiation, SASL
+    PLAIN (any username and password is accepted) and SCRAM (checked against
+    `password`, with a fixed salt per user), resource binding,
+    sessions, presence, and multi-user chat rooms with join, leave,
+    groupchat fan-out and history. Rooms are created when first joined.
+
+    External components (XEP-0114) may connect on the same port, for any
+    domain. Their handshake is checked if `component_secret` is set.
+
+    Given a `tls_context`, clients can upgrade with STARTTLS, and with
+    `require_tls` they must. All connections share the context, so clients
+    can resume their sessions when they reconnect.
+
+    Clients can enable stream management (XEP-0198), and resume their
+    streams within `resume_timeout` seconds of losing the connection, unless
+    that is 0. Up to `max_unacked` stanzas are kept for each until acked.
+
+    With `rate_limit`, each connection may send that many stanzas per second,
+    in bursts of up to `rate_burst`, and is disconnected if it sends more.
+    """
+
+    def __init__(self, host="localhost", latency=0.0, burst_size=1,
+                 history_size=0, component_secret=None, tls_context=None,
+                 require_tls=False, mechanisms=("PLAIN",),
+                 password="jumperbot",
+                 scram_iterations=scram.DEFAULT_ITERATIONS,
+                 resume_timeout=60.0, max_unacked=1000, rate_limit=None,
+                 rate_burst=10):
+        self.host = host
+        self.component_secret = component_secret
+        self.tls_context = tls_context
+        self.require_tls = require_tls and tls_context is not None
+
+        self.mechanisms = tuple(mechanisms)
+        self.mechanisms_feature = MECHANISMS % b"".join(
+            MECHANISM % mechanism.encode() for mechanism in self.mechanisms)
+        self.password = password
+        self.scram_iterations = scram_iterations
+        self.scram_keys = scram.KeyCache()
+        self.latency = latency
+        self.burst_size = max(1, burst_size)
+        self.history_size = history_size
+        self.resume_timeout = resume_timeout
+        self.max_unacked = max_unacked
+        self.rate_limit = rate_limit
+        self.rate_burst = rate_burst
+
+        self.sessions = {}
+        self.rooms = {}
+
+        # Connections with stream management that can be resumed, by stream
+        # ID, whether the client is still connected or not
+        self.resumable = {}
+
+        self.connections = 0
+        self.logins = 0
+        self.messages = 0
+        self.writes = 0
+        self.tls_handshakes = 0
+        self.tls_resumed = 0
+        self.detached = 0
+        self.resumes = 0
+        self.resumes_failed = 0
+        self.policy_violations = 0
+
+    def salt(self, username):
+        # The same for a user every time, as a real server would have stored
+        return hashlib.sha256(
+            "{0}:{1}".format(self.host, username).encode()).digest()[:16]
+
+    def create_connection(self):
+        return XmppServerConnection(self)
+
+    async def start(self, address="127.0.0.1", port=5222):
+        loop = asyncio.get_event_loop()
+        return await loop.create_server(self.create_connection, address, port)
+
+    def join_room(self, connection, room_jid, nick):
+        room = self.rooms.get(room_jid)
+        if room is None:
+            room = MucRoom(room_jid, self.history_size)
+            self.rooms[room_jid] = room
+        if nick in room.occupants:
+            return
+
+        nick_bytes = xmppstanzas.attribute(nick)
+        for occupant_nick, occupant in room.occupants.items():
+            connection.send(OCCUPANT_PRESENCE % (
+                room.jid_bytes, xmppstanzas.attribute(occupant_nick),
+                connection.jid_bytes, b""))
+            occupant.send(OCCUPANT_PRESENCE % (
+                room.jid_bytes, nick_bytes, occupant.jid_bytes, b""))
+
+        room.occupants[nick] = connection
+        connection.rooms[room_jid] = nick
+        connection.send(OCCUPANT_PRESENCE % (
+            room.jid_bytes, nick_bytes, connection.jid_bytes, SELF_PRESENCE))
+
+        for sender_nick, text, stamp in room.history:
+            connection.send(HISTORY % (
+                room.jid_bytes, sender_nick, connection.jid_bytes, text,
+                room.jid_bytes, stamp))
+
+    def leave_room(self, connection, room_jid):
+        nick = connection.rooms.pop(room_jid, None)
+        room = self.rooms.get(room_jid)
+        if nick is None or room is None:
+            return
+        del room.occupants[nick]
+        nick_bytes = xmppstanzas.attribute(nick)
+        connection.send(OCCUPANT_UNAVAILABLE % (
+            room.jid_bytes, nick_bytes, connection.jid_bytes, SELF_PRESENCE))
+        for occupant in room.occupants.values():
+            occupant.send(OCCUPANT_UNAVAILABLE % (
+                room.jid_bytes, nick_bytes, occupant.jid_bytes, b""))
+
+    def broadcast(self, connection, room_jid, text):
+        room = self.rooms.get(room_jid)
+        nick = connection.rooms.get(room_jid)
+        if room is None or nick is None:
+            return
+        self.messages += 1
+        nick_bytes = xmppstanzas.attribute(nick)
+        text_bytes = xmppstanzas.text(text)
+        for occupant in room.occupants.values():
+            occupant.send(GROUPCHAT % (
+                room.jid_bytes, nick_bytes, occupant.jid_bytes, text_bytes))
+        if room.history.maxlen:
+            stamp = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+            room.history.append((nick_bytes, text_bytes, stamp.encode()))
+
+    def route_message(self, connection, to, text, message_type):
+        self.messages += 1
+        recipients = [
+            session for jid, session in self.sessions.items()
+            if jid == to or jid.split("/")[0] == to
+        ]
+        for recipient in recipients:
+            recipient.send(CHAT % (
+                connection.jid_bytes, recipient.jid_bytes,
+                xmppstanzas.attribute(message_type), xmppstanzas.text(text)))
+
+    async def monitor_status(self):
+        template = "{0} connections, {1} logins, {2} rooms, " \
+                   "{3} messages, {4} writes, {5} TLS handshakes, " \
+                   "{6} resumed, {7} detached, {8} streams resumed, " \
+                   "{9} too fast"
+        while True:
+            await asyncio.sleep(1)
+            print(template.format(
+                self.connections, self.logins, len(self.rooms),
+                self.messages, self.writes, self.tls_handshakes,
+                self.tls_resumed, self.detached, self.resumes,
+                self.policy_violations), end="\r")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "-t", "--host-name",
+        default="localhost",
+        help="Host name the server answers for"
+    )
+
+    parser.add_argument(
+        "-a", "--address",
+        default="127.0.0.1",
+        help="Address to listen on"
+    )
+
+    parser.add_argument(
+        "-p", "--port",
+        type=int,
+        default=5222,
+        help="Port to listen on"
+    )
+
+    parser.add_argument(
+        "-l", "--latency",
+        type=float,
+        default=0.0,
+        help="Artificial delay in seconds added to every write"
+    )
+
+    parser.add_argument(
+        "-b", "--burst-size",
+        type=int,
+        default=1,
+        help="Most stanzas to a client that are collected into one write"
+    )
+
+    parser.add_argument(
+        "-y", "--history",
+        type=int,
+        default=0,
+        help="Number of messages of history sent on joining a room"
+    )
+
+    parser.add_argument(
+        "--component-secret",
+        help="The secret external components must log in with (by default, "
+             "any is accepted)"
+    )
+
+    parser.add_argument(
+        "--mechanisms",
+        nargs="+",
+        choices=SUPPORTED_MECHANISMS,
+        default=["PLAIN"],
+        help="The SASL mechanisms to offer, in this order. PLAIN accepts any "
+             "password."
+    )
+
+    parser.add_argument(
+        "--password",
+        default="jumperbot",
+        help="The password SCRAM logins are checked against, for every user"
+    )
+
+    parser.add_argument(
+        "--scram-iterations",
+        type=int,
+        default=scram.DEFAULT_ITERATIONS,
+        help="The PBKDF2 iteration count for SCRAM"
+    )
+
+    parser.add_argument(
+        "--tls-cert",
+        help="A PEM certificate (and key, unless given with --tls-key) to "
+             "offer STARTTLS with"
+    )
+
+    parser.add_argument(
+        "--tls-key",
+        help="The PEM private key for --tls-cert"
+    )
+
+    parser.add_argument(
+        "--require-tls",
+        action="store_true",
+        help="Refuse to log clients in before they have started TLS"
+    )
+
+    parser.add_argument(
+        "--resume-timeout",
+        type=float,
+        default=60.0,
+        help="Seconds a client with stream management has to resume its "
+             "stream after losing the connection (0 to not allow resuming)"
+    )
+
+    parser.add_argument(
+        "--rate-limit",
+        type=float,
+        help="The most stanzas per second a client may send before it is "
+             "disconnected with a policy-violation stream error (by default, "
+             "no limit)"
+    )
+
+    parser.add_argument(
+        "--rate-burst",
+        type=int,
+        default=10,
+        help="How many stanzas a client may send at once under --rate-limit"
+    )
+
+    parser.add_argument(
+        "-v", "--verbose",
+        action="store_true",
+        help="Detailed logging"
+    )
+
+    parser.add_argument(
+        "-m", "--monitor",
+        action="store_true",
+        help="When set, display server statistics"
+    )
+
+    args = parser.parse_args()
+
+    level = logging.INFO
+    if args.verbose:
+        level = logging.DEBUG
+
+    logging.basicConfig(format='%(process)d %(asctime)s %(levelname)s %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p', level=level)
+
+    tls_context = None
+    if args.tls_cert:
+        tls_context = xmpptls.create_server_context(args.tls_cert,
+                                                    args.tls_key)
+    server = XmppServer(args.host_name, args.latency, args.burst_size,
+                        args.history, args.component_secret, tls_context,
+                        args.require_tls, args.mechanisms, args.password,
+                        args.scram_iterations, args.resume_timeout,
+                        rate_limit=args.rate_limit,
+                        rate_burst=args.rate_burst)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(server.start(args.address, args.port))
+    logger.info("Listening on %s:%d", args.address, args.port)
+    if args.monitor:
+        loop.create_task(server.monitor_status())
+
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+
+    loop.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,98 @@
+"""
+Pre-encoded templates for the stanzas `XmppHandler` sends.
+
+The constant parts of each stanza are encoded once, here, and stanzas are
+built with a single bytes %-format from values that have already been
+escaped and encoded. Values that stay the same for the life of a connection
+(such as its JID and nick) should be encoded once and reused.
+"""
+from functools import lru_cache
+from xml.sax.saxutils import escape
+
+ATTRIBUTE_ENTITIES = {"'": "&apos;", "\"": "&quot;"}
+
+STREAM_HEADER = b"<?xml version='1.0'?>" \
+                b"<stream:stream to='%s' version='1.0' " \
+                b"xmlns='jabber:client' " \
+                b"xmlns:stream='http://etherx.jabber.org/streams'>"
+
+# For an external component (XEP-0114), which can send and receive for any
+# JID in its domain
+COMPONENT_STREAM_HEADER = b"<?xml version='1.0'?>" \
+                          b"<stream:stream to='%s' " \
+                          b"xmlns='jabber:component:accept' " \
+                          b"xmlns:stream='http://etherx.jabber.org/streams'>"
+
+HANDSHAKE = b"<handshake>%s</handshake>"
+
+STARTTLS = b"<starttls xmlns='urn:ietf:params:xml:ns:xmpp-tls'/>"
+
+AUTH = b"<auth xmlns='urn:ietf:params:xml:ns:xmpp-sasl' " \
+       b"mechanism='%s'>%s</auth>"
+
+SASL_RESPONSE = b"<response xmlns='urn:ietf:params:xml:ns:xmpp-sasl'>" \
+                b"%s</response>"
+
+BIND = b"<bind xmlns='urn:ietf:params:xml:ns:xmpp-bind'>" \
+       b"<resource>%s</resource>" \
+       b"</bind>"
+
+SESSION = b"<session xmlns='urn:ietf:params:xml:ns:xmpp-session'/>"
+
+# Stream management (XEP-0198)
+ENABLE_SM = b"<enable xmlns='urn:xmpp:sm:3' resume='true'/>"
+
+RESUME_SM = b"<resume xmlns='urn:xmpp:sm:3' h='%d' previd='%s'/>"
+
+SM_REQUEST = b"<r xmlns='urn:xmpp:sm:3'/>"
+
+SM_ACK = b"<a xmlns='urn:xmpp:sm:3' h='%d'/>"
+
+STREAM_END = b"</stream:stream>"
+
+INITIAL_PRESENCE = b"<presence><show/></presence>"
+
+IQ = b"<iq id='%s' type='%s' from='%s'%s>%s</iq>"
+
+IQ_TO = b" to='%s'"
+
+MESSAGE = b"<message from='%s' to='%s' xml:lang='en'>" \
+          b"<body>%s</body>" \
+          b"</message>"
+
+GROUPCHAT = b"<message from='%s' to='%s' " \
+            b"type='groupchat' xml:lang='en'><body>%s</body></message>"
+
+SUBJECT = b"<message from='%s' to='%s' type='groupchat' " \
+          b"xml:lang='en'><subject>%s</subject></message>"
+
+JOIN_ROOM = b"<presence from='%s' id='%s' to='%s/%s'>" \
+            b"<x xmlns='http://jabber.org/protocol/muc'>%s</x>" \
+            b"</presence>"
+
+ROOM_PASSWORD = b"<password>%s</password>"
+
+LEAVE_ROOM = b"<presence from='%s' id='%s' " \
+             b"to='%s/%s' type='unavailable'/>"
+
+CREATE_ROOM = b"<presence from='%s' id='%s' to='%s/%s'>" \
+              b"<x xmlns='http://jabber.org/protocol/muc'/>" \
+              b"</presence>"
+
+
+def text(value):
+    # type: (str) -> bytes
+    """
+    Escapes and encodes a value for use as element text.
+    """
+    return escape(value).encode()
+
+
+@lru_cache(maxsize=4096)
+def attribute(value):
+    # type: (str) -> bytes
+    """
+    Escapes and encodes a value for use in a quoted attribute. These are
+    mostly JIDs and room names, which repeat a lot, so results are cached.
+    """
+    return escape(value, ATTRIBUTE_ENTITIES).encode()
@@ -0,0 +1,280 @@
+import logging
+import re
+from xml.parsers import expat
+
+from parserpool import STREAM_TAG, TAG_NAMES, PooledParserReader
+from xmppcontenthandler import StanzaQueue
+from xmppelement import EMPTY_ATTRIBUTES, StanzaAccessors, XmppElement, \
+    make_attributes
+
+logger = logging.getLogger(__name__)
+
+# Matches a complete start or end tag, skipping over quoted attribute values
+# which may legitimately contain '>'
+TAG_PATTERN = re.compile(rb"<(?:[^>\"']|\"[^\"]*\"|'[^']*')*>")
+
+# The start of the end tag of a stanza, by its name
+END_TAGS = {}
+
+# What may follow the name in an end tag
+END_TAG_FOLLOWERS = (b">", b" ", b"\t", b"\r", b"\n")
+
+
+class XmppStanza(StanzaAccessors):
+    """
+    A lightweight view of a top-level stanza read by `XmppStreamReader`.
+
+    Only the tag and attributes are decoded up front, which is all that is
+    needed to route a stanza. The raw bytes of the stanza are kept, and the
+    full element tree (children and text) is only built the first time
+    someone asks for it.
+    """
+    __slots__ = ("tag", "attributes", "raw", "_element")
+
+    def __init__(self, tag, attributes, raw=None):
+        self.tag = tag
+        self.attributes = attributes
+        self.raw = raw
+        self._element = None
+
+    @property
+    def element(self):
+        # type: () -> XmppElement
+        if self._element is None:
+            if self.raw:
+                self._element = build_element(self.raw)
+            else:
+                self._element = XmppElement(self.tag, self.attributes)
+        return self._element
+
+    @property
+    def children(self):
+        return self.element.children
+
+    @property
+    def text(self):
+        return self.element.text
+
+    def find_child_with_tag(self, tag, xmlns=None):
+        return self.element.find_child_with_tag(tag, xmlns)
+
+    def iter_xml(self, pretty=False, indent=0):
+        return self.element.iter_xml(pretty, indent)
+
+    def write_xml(self, stream, pretty=False):
+        self.element.write_xml(stream, pretty)
+
+    def to_bytes(self):
+        # type: () -> bytes
+        """
+        Returns the stanza as compact, encoded XML. Until the element has
+        been built (and so possibly changed) these are the raw bytes as
+        received, so forwarding a stanza doesn't need to serialize it.
+        """
+        if self._element is None and self.raw:
+            return self.raw
+        return self.element.to_bytes()
+
+    def toXml(self, indent=0):
+        return self.element.toXml(indent)
+
+
+class XmppTreeBuilder(object):
+    """
+    Builds an `XmppElement` tree from a single complete XML fragment.
+    """
+
+    def __init__(self):
+        self.root = None
+        self.element_stack = []
+
+    def start_element(self, name, attrs):
+        element = XmppElement(name, make_attributes(attrs))
+        if self.element_stack:
+            self.element_stack[-1].add_child(element)
+        else:
+            self.root = element
+        self.element_stack.append(element)
+
+    def end_element(self, name):
+        self.element_stack.pop()
+
+    def characters(self, content):
+        element = self.element_stack[-1]
+        if element.text:
+            element.text += content
+        else:
+            element.text = content
+
+
+def build_element(raw):
+    # type: (bytes) -> XmppElement
+    builder = XmppTreeBuilder()
+    parser = expat.ParserCreate(intern=TAG_NAMES)
+    parser.buffer_text = True
+    parser.StartElementHandler = builder.start_element
+    parser.EndElementHandler = builder.end_element
+    parser.CharacterDataHandler = builder.characters
+    parser.Parse(raw, True)
+    return builder.root
+
+
+class XmppStreamReader(PooledParserReader):
+    """
+    An incremental reader for an XMPP stream, built directly on expat.
+
+    This is an alternative to the `XmppTreeReader`. Rather than building a
+    full `XmppElement` tree for every stanza it only tracks nesting depth,
+    and queues an `XmppStanza` view holding the raw bytes of each complete
+    top-level stanza.
+
+    It offers the same `feed`, `reset` and `queue` interface as the tree
+    reader, so `XmppHandler` can use either one. Between stanzas its parser
+    goes back to the pool.
+
+    Building an element on demand parses the stanza a second time, which
+    only pays off for stanzas that are mostly routed on their tag and
+    attributes. While `build_elements` is set, as when the handler is
+    logging in and looks into every stanza, the elements are built as the
+    stanzas are read instead, in the same pass.
+
+    As measured with benchmark.py, reading alone takes about as long as the
+    tree reader for chat and is some 20% faster for presence storms, and
+    each queued stanza takes far less memory. Once handlers look into the
+    stanzas, though, the second parse makes dispatching chat about a third
+    slower than with the tree reader, and logging in about 15% slower, so
+    this is for bots that mostly count or forward what they get.
+    """
+
+    def __init__(self, queue=None, pool=None):
+        PooledParserReader.__init__(self, pool)
+        self.queue = queue if queue is not None else StanzaQueue()
+        self.build_elements = False
+        self.reset()
+
+    def set_handlers(self, parser):
+        parser.StartElementHandler = self.start_element
+        parser.EndElementHandler = self.end_element
+
+    def between_stanzas(self):
+        return self.depth == 1 and self.stanza_start is None and \
+            self.stream_tag == STREAM_TAG
+
+    def reset(self):
+        PooledParserReader.reset(self)
+
+        # Holds the incoming bytes from the start of the current (incomplete)
+        # stanza. `offset` is the position of its first byte in the stream.
+        # A read that starts between stanzas is used as it is, and only
+        # copied into a bytearray for what is left of it.
+        self.buffer = b""
+        self.offset = 0
+
+        # Position in the stream up to which everything has been queued
+        self.consumed = 0
+
+        self.depth = 0
+        self.stream_tag = None
+        self.stanza_tag = None
+        self.stanza_attributes = None
+        self.stanza_start = None
+        self.builder = None
+
+    def feed(self, data):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        if self.buffer:
+            self.buffer += data
+        elif type(data) is bytes:
+            self.buffer = data
+        else:
+            self.buffer = bytearray(data)
+        self.parse(data)
+
+        if self.parser is None:
+            # Everything read has been queued, and the parser is back in the
+            # pool
+            self.buffer = b""
+            self.offset = self.consumed = self.fed
+            return
+
+        if self.stanza_start is not None:
+            keep_from = self.stanza_start
+        else:
+            keep_from = self.consumed
+        buffer = self.buffer
+        if type(buffer) is bytes:
+            self.buffer = bytearray(
+                memoryview(buffer)[keep_from - self.offset:])
+            self.offset = keep_from
+        elif keep_from > self.offset:
+            del buffer[:keep_from - self.offset]
+            self.offset = keep_from
+
+    def start_element(self, name, attrs):
+        depth = self.depth
+        self.depth += 1
+        if depth > 1:
+            if self.builder is not None:
+                self.builder.start_element(name, attrs)
+            return
+
+        start = self.position()
+        if depth == 0:
+            # The stream element won't close until the stream is closed
+            match = TAG_PATTERN.match(self.buffer, start - self.offset)
+            self.stream_tag = name
+            self.queue.push(XmppStanza(name, make_attributes(attrs)))
+            self.consumed = match.end() + self.offset
+            return
+
+        self.stanza_tag = name
+        self.stanza_start = start
+        if self.build_elements:
+            builder = self.builder = XmppTreeBuilder()
+            builder.start_element(name, attrs)
+            self.stanza_attributes = builder.root.attributes
+            self.parser.CharacterDataHandler = builder.characters
+        else:
+            self.stanza_attributes = make_attributes(attrs)
+
+    def end_element(self, name):
+        self.depth -= 1
+        depth = self.depth
+        if depth > 1:
+            if self.builder is not None:
+                self.builder.end_element(name)
+            return
+
+        if depth == 0:
+            self.queue.push(XmppStanza("stream:closed", EMPTY_ATTRIBUTES))
+            return
+
+        # Expat reports the position of the end tag, or the end of the tag
+        # of an empty element. Only the end tag itself can follow with the
+        # same name, as an empty element can only be followed by another
+        # stanza, whitespace or the end of the stream.
+        buffer = self.buffer
+        position = self.position() - self.offset
+        end_tag = END_TAGS.get(name)
+        if end_tag is None:
+            end_tag = END_TAGS[name] = b"</" + name.encode("utf-8")
+        after = position + len(end_tag)
+        if buffer.startswith(end_tag, position) and \
+                buffer[after:after + 1] in END_TAG_FOLLOWERS:
+            end = buffer.index(b">", position) + 1
+        else:
+            end = position
+
+        raw = bytes(memoryview(buffer)[self.stanza_start - self.offset:end])
+        end += self.offset
+        stanza = XmppStanza(self.stanza_tag, self.stanza_attributes, raw)
+        if self.builder is not None:
+            stanza._element = self.builder.root
+            self.builder = None
+            self.parser.CharacterDataHandler = None
+        self.queue.push(stanza)
+        self.consumed = end
+        self.stanza_tag = None
+        self.stanza_attributes = None
+        self.stanza_start = None
@@ -0,0 +1,106 @@
+"""
+TLS for XMPP connections upgraded with STARTTLS.
+
+Clients share one `ResumingContext` per process. It remembers the TLS
+session of the last connection to each server, so reconnecting bots resume
+it rather than doing a full handshake, which saves the key exchange and the
+certificate checks: most of the CPU of a handshake, on both ends.
+`loop.start_tls` has no way to pass a session in, so the context hands it
+to every new connection itself.
+"""
+import asyncio
+import logging
+import ssl
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class ResumingContext(ssl.SSLContext):
+    """
+    A client `SSLContext` that resumes the session last remembered for a
+    server, when there is one.
+    """
+
+    def __new__(cls, protocol=ssl.PROTOCOL_TLS_CLIENT, *args, **kwargs):
+        self = super().__new__(cls, protocol, *args, **kwargs)
+        self.sessions = {}
+        return self
+
+    def wrap_bio(self, incoming, outgoing, server_side=False,
+                 server_hostname=None, session=None):
+        if session is None and not server_side:
+            session = self.sessions.get(server_hostname)
+        return super().wrap_bio(incoming, outgoing, server_side,
+                                server_hostname, session)
+
+    def remember(self, transport, server_hostname):
+        """
+        Keeps the session of `transport` for the next connection to
+        `server_hostname`. With TLS 1.3 the server only sends the ticket to
+        resume a session with after the handshake, so this is best called
+        once some data has come through, e.g. after logging in.
+        """
+        ssl_object = transport.get_extra_info("ssl_object")
+        if ssl_object is None:
+            return
+        session = ssl_object.session
+        if session is not None and (session.has_ticket or session.id):
+            self.sessions[server_hostname] = session
+
+    def forget(self, server_hostname=None):
+        if server_hostname is None:
+            self.sessions.clear()
+        else:
+            self.sessions.pop(server_hostname, None)
+
+
+def create_client_context(cafile=None, verify=True):
+    """
+    The context for bots to share. Certificates are checked against
+    `cafile`, or the system's CAs, unless `verify` is False, e.g. for a test
+    server with a self-signed certificate.
+    """
+    context = ResumingContext()
+    if not verify:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    elif cafile:
+        context.load_verify_locations(cafile)
+    else:
+        context.load_default_certs()
+    return context
+
+
+def create_server_context(certfile, keyfile=None):
+    """
+    A server context for `certfile`. One context keeps the keys of the
+    session tickets it issues, so all the connections to a server must
+    share it for clients to be able to resume their sessions.
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(certfile, keyfile)
+    return context
+
+
+async def start_tls(transport, protocol, context, server_hostname=None,
+                    metrics=None, timeout=None):
+    """
+    Upgrades a client connection to TLS and returns the new transport. The
+    time the handshake took is recorded in `metrics`, by whether the session
+    was resumed.
+    """
+    loop = asyncio.get_event_loop()
+    start = time.perf_counter()
+    tls_transport = await loop.start_tls(
+        transport, protocol, context, server_hostname=server_hostname,
+        ssl_handshake_timeout=timeout)
+    if metrics is not None:
+        metrics.record_tls_handshake(is_resumed(tls_transport),
+                                     time.perf_counter() - start)
+    return tls_transport
+
+
+def is_resumed(transport):
+    ssl_object = transport.get_extra_info("ssl_object")
+    return ssl_object is not None and ssl_object.session_reused
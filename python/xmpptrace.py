@@ -0,0 +1,67 @@
+import logging
+import re
+
+logger = logging.getLogger("xmpptrace")
+
+TAG_PATTERN = re.compile(r"<([^\s/>?]+)")
+
+
+class LazyXml(object):
+    """
+    Defers rendering an element as XML until it is actually logged.
+    """
+    __slots__ = ("element",)
+
+    def __init__(self, element):
+        self.element = element
+
+    def __str__(self):
+        return self.element.toXml()
+
+
+class StanzaTracer(object):
+    """
+    Logs full stanzas going in and out of a single connection.
+
+    Tracing is off by default, and while it is off the only cost is checking
+    `enabled`. It can be switched on and off at any time, limited to a set of
+    stanza tags, and sampled so only every n-th matching stanza is logged.
+
+    Traces go to the "xmpptrace" logger at INFO level, so they show up for
+    the traced connections without turning on DEBUG logging everywhere.
+    """
+
+    def __init__(self, name=None):
+        self.name = name
+        self.enabled = False
+        self.tags = None
+        self.sample = 1
+        self.count = 0
+
+    def enable(self, tags=None, sample=1):
+        self.tags = frozenset(tags) if tags else None
+        self.sample = max(1, sample)
+        self.count = 0
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def should_trace(self, tag):
+        if self.tags is not None and tag not in self.tags:
+            return False
+        self.count += 1
+        return self.count % self.sample == 0
+
+    def trace_received(self, element, state=None):
+        if self.should_trace(element.tag):
+            logger.info("%s: Recv (%s):\n%s", self.name, state,
+                        element.toXml())
+
+    def trace_sent(self, package):
+        if isinstance(package, bytes):
+            package = package.decode("utf-8", "replace")
+        match = TAG_PATTERN.search(package)
+        tag = match.group(1) if match else None
+        if self.should_trace(tag):
+            logger.info("%s: Send: %s", self.name, package)